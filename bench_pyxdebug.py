@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# set encoding=utf-8
+#
+# usage: python bench_pyxdebug.py [n] [repeat]
+#        python bench_pyxdebug.py --suite [-r repeat] [-w workload] [-j json_path]
+
+import sys
+import os
+import time
+import itertools
+import json
+import platform
+import traceback
+from optparse import OptionParser
+try:
+    import resource
+except ImportError:
+    resource = None
+import pyxdebug
+
+
+class Fib(object):
+    def __init__(self):
+        pass
+
+    def calc(self, n):
+        if n<3:
+            return 1
+        return self.calc(n - 1) + self.calc(n - 2)
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def add(self, value):
+        self.value += value
+        return self.value
+
+
+class CountingPyXdebug(pyxdebug.PyXdebug):
+    def initialize(self):
+        super(CountingPyXdebug, self).initialize()
+        self.events = 0
+
+    def trace_dispatch(self, frame, event, arg):
+        if self.trace_lines:
+            self.events += 1
+        return super(CountingPyXdebug, self).trace_dispatch(frame, event, arg)
+
+    def profile_dispatch(self, frame, event, arg):
+        self.events += 1
+        return super(CountingPyXdebug, self).profile_dispatch(frame, event, arg)
+
+
+def count_events(func, *args, **options):
+    xd = CountingPyXdebug()
+    for key, value in options.iteritems():
+        setattr(xd, key, value)
+    xd.run_func(func, *args)
+    return xd.events
+
+
+def count_calls(func, *args, **options):
+    xd = pyxdebug.PyXdebug()
+    for key, value in options.iteritems():
+        setattr(xd, key, value)
+    xd.run_func(func, *args)
+    return len([r for r in xd.result if r.__class__==pyxdebug.CallTrace])
+
+
+def best_time(repeat, func, *args):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed<best:
+            best = elapsed
+    return best
+
+
+def bench_fib(n=20, repeat=5):
+    fib = Fib()
+    events = count_events(fib.calc, n)
+    untraced = best_time(repeat, fib.calc, n)
+    traced = best_time(repeat, pyxdebug.PyXdebug().run_func, fib.calc, n)
+    return {
+        'events': events,
+        'untraced': untraced,
+        'traced': traced,
+        'per_event': (traced - untraced) / events,
+    }
+
+
+def bench_hooks(n=20, repeat=5):
+    fib = Fib()
+    result = {'calls': count_calls(fib.calc, n)}
+    for mode, collect_assignments in (('profile', 0), ('trace', 1)):
+        xd = pyxdebug.PyXdebug()
+        xd.collect_assignments = collect_assignments
+        result[mode + '_events'] = count_events(fib.calc, n, collect_assignments=collect_assignments)
+        result[mode + '_time'] = best_time(repeat, xd.run_func, fib.calc, n)
+    return result
+
+
+def run_sampled(func, *args):
+    xd = pyxdebug.PyXdebug()
+    xd.sample_interval = 0.001
+    xd.run_func(func, *args)
+    return xd
+
+
+def bench_sampling(n=20, repeat=5):
+    fib = Fib()
+    untraced = best_time(repeat, fib.calc, n)
+    traced = best_time(repeat, pyxdebug.PyXdebug().run_func, fib.calc, n)
+    sampled = best_time(repeat, run_sampled, fib.calc, n)
+    return {
+        'untraced': untraced,
+        'traced': traced,
+        'sampled': sampled,
+        'samples': sum(run_sampled(fib.calc, n).samples.itervalues()),
+    }
+
+
+# workloads of the suite, sized so that a traced run takes about 0.1 sec
+def workload_recursion():
+    Fib().calc(16)
+
+
+def workload_loop():
+    total = 0
+    for i in xrange(20000):
+        total += i * 2
+    return total
+
+
+def workload_methods():
+    counter = Counter()
+    for i in xrange(5000):
+        counter.add(1)
+    return counter.value
+
+
+# modules that are not in sys.modules once pyxdebug and this script are
+# loaded (json and textwrap, which optparse imports, are), each run imports
+# them in a fresh child process
+IMPORT_MODULES = ['smtplib', 'decimal', 'fractions', 'csv', 'difflib', 'plistlib', 'xml.dom.minidom', 'email.mime.text', 'urllib2', 'zipfile', 'tarfile', 'argparse', 'logging.handlers', 'ConfigParser', 'cookielib']
+
+
+def workload_imports():
+    for name in IMPORT_MODULES:
+        __import__(name)
+
+
+def take_values(values, mapping, text):
+    return len(values) + len(mapping) + len(text)
+
+
+def workload_values():
+    values = range(1000)
+    mapping = dict((str(i), [i] * 10) for i in xrange(200))
+    text = 'x' * 10000
+    for i in xrange(500):
+        take_values(values, mapping, text)
+
+
+WORKLOADS = [
+    ('recursion', workload_recursion),
+    ('loop', workload_loop),
+    ('methods', workload_methods),
+    ('imports', workload_imports),
+    ('values', workload_values),
+]
+
+SUITE_OPTIONS = ('collect_imports', 'collect_params', 'collect_return', 'collect_assignments')
+
+
+def get_suite_options():
+    # every combination of the collect options
+    for values in itertools.product((0, 1), repeat=len(SUITE_OPTIONS)):
+        yield dict(zip(SUITE_OPTIONS, values))
+
+
+def run_isolated(func, *args):
+    # runs func in a child process, so that every run imports its modules
+    # again and has a peak memory of its own, and returns its json result
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid==0:
+        status = 1
+        try:
+            os.close(read_fd)
+            os.write(write_fd, json.dumps(func(*args)))
+            status = 0
+        except:
+            traceback.print_exc()
+        os._exit(status)
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    pid, status = os.waitpid(pid, 0)
+    if status!=0:
+        raise RuntimeError('benchmark child process failed')
+    return json.loads(''.join(chunks))
+
+
+def get_peak_memory():
+    # peak resident set size in KB, the unit of ru_maxrss on linux
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform=='darwin':
+        peak //= 1024
+    return peak
+
+
+def measure_run(func, options):
+    # options None runs func untraced
+    if options is None:
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        events = 0
+    else:
+        xd = CountingPyXdebug()
+        for key, value in options.iteritems():
+            setattr(xd, key, value)
+        start = time.time()
+        xd.run_func(func)
+        elapsed = time.time() - start
+        events = xd.events
+    return {'time': elapsed, 'events': events, 'peak_memory': get_peak_memory()}
+
+
+def bench_workload(func, options, repeat):
+    # the best time of the runs and the largest peak memory, the events
+    # are counted while timing, as the hooks of the tracer are called
+    # anyway and the counting is a small part of their cost
+    runs = [run_isolated(measure_run, func, options) for i in xrange(repeat)]
+    best = min(runs, key=lambda o: o['time'])
+    peaks = [o['peak_memory'] for o in runs if o['peak_memory'] is not None]
+    return {'time': best['time'], 'events': best['events'], 'peak_memory': max(peaks) if peaks else None}
+
+
+def bench_suite(repeat=3, workloads=None):
+    results = []
+    for name, func in WORKLOADS:
+        if workloads and name not in workloads:
+            continue
+        untraced = bench_workload(func, None, repeat)
+        results.append({'workload': name, 'options': None, 'time': untraced['time'], 'slowdown': 1.0,
+                        'events': 0, 'events_per_sec': 0.0, 'peak_memory': untraced['peak_memory']})
+        for options in get_suite_options():
+            traced = bench_workload(func, options, repeat)
+            results.append({
+                'workload': name,
+                'options': options,
+                'time': traced['time'],
+                'slowdown': traced['time'] / untraced['time'] if untraced['time'] else 0.0,
+                'events': traced['events'],
+                'events_per_sec': traced['events'] / traced['time'] if traced['time'] else 0.0,
+                'peak_memory': traced['peak_memory'],
+            })
+    return {
+        'pyxdebug': pyxdebug.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def format_options(options):
+    if options is None:
+        return 'untraced'
+    # i, p, r and a as the command line options of pyxdebug
+    return ''.join([flag if options[key] else '-' for flag, key in zip('ipra', SUITE_OPTIONS)])
+
+
+def print_suite(suite):
+    print 'pyxdebug %s, %s %s, best of %d' % (suite['pyxdebug'], suite['implementation'], suite['python'], suite['repeat'])
+    print '  %-10s %-8s %10s %9s %10s %12s %10s' % ('workload', 'options', 'sec', 'slowdown', 'events', 'events/sec', 'peak KB')
+    for result in suite['results']:
+        print '  %-10s %-8s %10.4f %9.1f %10d %12.0f %10s' % (result['workload'], format_options(result['options']), result['time'], result['slowdown'], result['events'], result['events_per_sec'], result['peak_memory'])
+
+
+def main():
+    parser = OptionParser(usage='bench_pyxdebug.py [n] [repeat]\n       bench_pyxdebug.py --suite [-r repeat] [-w workload] [-j json_path]')
+    parser.add_option('--suite', action="store_true", dest="suite", default=False,
+                      help="Run every workload untraced and under every combination of collect_imports, collect_params, collect_return and collect_assignments.")
+    parser.add_option('-r', '--repeat', type="int", dest="repeat", default=3,
+                      help="Runs of each workload and options of the suite, the best time is kept.")
+    parser.add_option('-w', '--workload', action="append", dest="workloads", default=[],
+                      choices=[name for name, func in WORKLOADS], type="choice",
+                      help="Run only the given workload of the suite, repeatable.")
+    parser.add_option('-j', '--json', dest="json_path", default=None,
+                      help="Write the results of the suite to <json_path>, - writes them to stdout.")
+    (options, args) = parser.parse_args()
+
+    if options.suite:
+        suite = bench_suite(max(options.repeat, 1), options.workloads)
+        if options.json_path=='-':
+            json.dump(suite, sys.stdout, indent=2, sort_keys=True)
+            print
+            return
+        if options.json_path:
+            with open(options.json_path, 'w') as fileobj:
+                json.dump(suite, fileobj, indent=2, sort_keys=True)
+        print_suite(suite)
+        return
+
+    n = int(args[0]) if len(args)>0 else 20
+    repeat = int(args[1]) if len(args)>1 else 5
+    result = bench_fib(n, repeat)
+    print 'Fib.calc(%d): %d events' % (n, result['events'])
+    print '  untraced  %10.4f sec' % result['untraced']
+    print '  traced    %10.4f sec' % result['traced']
+    print '  per event %10.2f usec' % (result['per_event'] * 1000000)
+
+    result = bench_hooks(n, repeat)
+    print 'Fib.calc(%d): %d calls, events per traced call' % (n, result['calls'])
+    for mode, label in (('profile', 'calls only (setprofile)'), ('trace', 'assignments (settrace)')):
+        events = result[mode + '_events']
+        print '  %-24s %8d events  %5.2f per call  %10.4f sec' % (label, events, float(events) / result['calls'], result[mode + '_time'])
+
+    result = bench_sampling(n, repeat)
+    print 'Fib.calc(%d): trace vs 1 msec sampling' % n
+    print '  untraced  %10.4f sec' % result['untraced']
+    print '  traced    %10.4f sec  x%.1f' % (result['traced'], result['traced'] / result['untraced'])
+    print '  sampled   %10.4f sec  x%.1f (%d samples)' % (result['sampled'], result['sampled'] / result['untraced'], result['samples'])
+
+
+if __name__=='__main__':
+    main()
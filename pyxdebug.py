@@ -6,12 +6,31 @@ import time
 import inspect
 import re
 import linecache
+import dis
+import calendar
+from inspect import CO_VARARGS, CO_VARKEYWORDS
+import threading
+import thread
+import itertools
+import copy
+import collections
+import fnmatch
+import bisect
+import heapq
+import mmap
+import array
+import signal
 from pprint import pformat
 try:
     import resource
 except ImportError:
     resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 import __builtin__
+import ctypes
 
 
 __version__ = '1.2.5'
@@ -19,14 +38,56 @@ __author__ = 'Yoshida Tetsuya'
 __license__ = 'MIT License'
 
 
-this_path = __name__
-if __name__=='__main__':
-    this_path = __file__
-this_path = os.path.splitext(os.path.abspath(this_path))[0]
+# the module path without its .py or .pyc extension, __file__ is relative
+# to the working directory of the import
+this_path = os.path.splitext(os.path.abspath(__file__))[0]
+
+# resolved (class, name) of methods by (code, receiver class)
+METHOD_CACHE_SIZE = 4096
+method_cache = {}
+
+# last instructions of a frame that returns, a frame left at any other
+# instruction is unwound by an exception
+RETURN_OPS = frozenset([dis.opmap['RETURN_VALUE'], dis.opmap['YIELD_VALUE']])
+
+# values captured as they are
+SCALAR_TYPES = (type(None), bool, int, long, float, complex)
+STRING_TYPES = (str, unicode)
+
+# sidecar index of indexed text traces
+INDEX_MAGIC = 'PYXDEBUG INDEX 2'
+
+# binary trace format
+BINARY_MAGIC = 'PYXDEBUG\x01'
+BINARY_STRING = 0
+BINARY_CALL = 1
+BINARY_RETURN = 2
+BINARY_ASSIGNMENT = 3
+BINARY_IMPORT = 4
+BINARY_RELOAD = 5
+BINARY_FINISH = 6
+BINARY_LOG = 7
+BINARY_EXIT = 8
+BINARY_EXCEPTION = 9
+BINARY_UNWIND = 10
+BINARY_PROCESS = 11
+BINARY_END = 0x7f
+
+# no duration of an exit record in the flight recorder
+NO_DURATION = float('nan')
+
+# functions of pyxdebug that run while tracing and are not recorded, the
+# methods arming and disarming tracing are called by the traced code
+HOOK_NAMES = ('__pyxdebug_import_hook', '__pyxdebug_reload_hook', '__pyxdebug_fork_hook', '__pyxdebug_exit_hook', '__pyxdebug_signal_hook', '__pyxdebug_trace_hook')
+ARM_NAMES = ('start', 'stop', '__enter__', '__exit__')
 
 
 class PyXdebug(object):
     def __init__(self):
+        # the original hooks while tracing is armed, the lock serializes
+        # arming and disarming
+        self.hooks = None
+        self.arm_lock = threading.Lock()
         self.initialize()
 
         # collect options
@@ -35,7 +96,71 @@ class PyXdebug(object):
         self.collect_return = 0
         self.collect_assignments = 0
 
+        # durations need exit records
+        self.collect_durations = 0
+
+        # exceptions need the trace hook, as assignments do
+        self.collect_exceptions = 0
+
+        # memory column of the records, 'none' leaves it empty, 'rusage' is
+        # the minor page faults with a system call per record, 'tracemalloc'
+        # the size of the traced allocations (python 3 only) and 'rss' the
+        # resident set size read every memory_interval seconds
+        self.memory_probe = 'none'
+        self.memory_interval = 0.01
+
+        # limits of the captured parameter, return and assignment values,
+        # a negative value is unlimited
+        self.var_display_max_children = 128
+        self.var_display_max_data = 512
+        self.var_display_max_depth = 3
+
+        # trace format, 0 is human readable and 1 is computerized
+        self.trace_format = 0
+
+        # sampling interval in seconds, 0 traces every call
+        self.sample_interval = 0
+
+        # trace the threads started by the traced code as well
+        self.trace_threads = 0
+
+        # trace the child processes forked by the traced code, each child
+        # writes to child_writer(pid, ppid), a new writer of its own
+        self.trace_children = 0
+        self.child_writer = None
+
+        # filters of the recorded functions by module name prefix, file
+        # path glob and function name glob, when an include filter is given
+        # only the functions matching one of them are recorded
+        self.include_modules = []
+        self.exclude_modules = []
+        self.include_files = []
+        self.exclude_files = []
+        self.include_functions = []
+        self.exclude_functions = []
+
+        # limits of the recorded call depth and of the number of records,
+        # 0 is unlimited, tracing stops when the record limit is reached
+        self.max_depth = 0
+        self.max_records = 0
+
+        # output writer, None collects the trace in memory for get_result()
+        self.writer = None
+
+        # triggers of start(), of the context manager and of the decorator,
+        # when an environment variable or a trigger file is given tracing
+        # is only armed while it is set or exists, then only every Nth time
+        self.trigger_env = None
+        self.trigger_file = None
+        self.trigger_every = 0
+        self.trigger_count = 0
+
+        # whether the open blocks of each thread armed tracing
+        self.blocks = {}
+
     def initialize(self):
+        if self.hooks is not None:
+            raise PyXdebugError('PyXdebug is already running')
         self.start_time = None
         self.start_gmtime = None
         self.end_gmtime = None
@@ -43,6 +168,21 @@ class PyXdebug(object):
         self.call_func_name = None
         self.late_dispatch = []
         self.result = []
+        self.code_cache = {}
+        self.call_counter = itertools.count(1)
+        self.call_stack = []
+        self.thread_id = None
+        self.thread_name = None
+        self.thread_lock = None
+        self.run_state = None
+        self.collect_exits = False
+        self.trace_lines = False
+        self.profile_frames = []
+        self.samples = {}
+        self.probe = None
+        self.recorder = None
+        self.writing = False
+        self.module_count = None
 
     def run_func(self, func, *args, **kwds):
         self.initialize()
@@ -66,95 +206,329 @@ class PyXdebug(object):
             globals_ = globals()
         return self._run(execfile, script_path, globals_)
 
+    def start(self):
+        # arms tracing until stop(), from the caller of start() on, when the
+        # triggers fire, no hook is installed otherwise, a start while
+        # tracing is armed or while another thread arms or disarms it does
+        # not arm it
+        if not self.arm_lock.acquire(False):
+            return False
+        try:
+            if self.hooks is not None or not self.is_triggered():
+                return False
+            self.initialize()
+            frame = inspect.currentframe().f_back
+            while self.is_internal(frame):
+                frame = frame.f_back
+            self.start_run(frame)
+            return True
+        finally:
+            self.arm_lock.release()
+
+    def stop(self):
+        # nothing to stop when start() did not arm tracing, the hook of the
+        # arming thread can only be removed by that thread
+        with self.arm_lock:
+            if self.hooks is None:
+                return False
+            if self.hooks['thread_id']!=thread.get_ident():
+                raise PyXdebugError('tracing is stopped by another thread than the one that started it')
+            self.stop_run()
+            return True
+
+    def __enter__(self):
+        # only the outermost block of a thread may arm tracing, the nested
+        # ones follow it
+        blocks = self.blocks.setdefault(thread.get_ident(), [])
+        blocks.append(not blocks and self.start())
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        blocks = self.blocks[thread.get_ident()]
+        armed = blocks.pop()
+        if not blocks:
+            del self.blocks[thread.get_ident()]
+        if armed:
+            if exc_type is not None:
+                self.error_run((exc_type, exc_value, exc_traceback))
+            self.stop()
+        return False
+
+    def trace(self, func):
+        # decorator tracing the calls of func, the calls are recorded as
+        # called by the caller of the decorated function
+        def __pyxdebug_trace_hook(*args, **kwds):
+            with self:
+                return func(*args, **kwds)
+        __pyxdebug_trace_hook.__name__ = func.__name__
+        __pyxdebug_trace_hook.__doc__ = func.__doc__
+        __pyxdebug_trace_hook.__module__ = func.__module__
+        return __pyxdebug_trace_hook
+
+    def is_triggered(self):
+        # the environment variable or the trigger file, when either is
+        # given, then every Nth of the triggered starts
+        if self.trigger_env or self.trigger_file:
+            if not ((self.trigger_env and os.environ.get(self.trigger_env))
+                    or (self.trigger_file and os.path.exists(self.trigger_file))):
+                return False
+        self.trigger_count += 1
+        if self.trigger_every>1 and self.trigger_count % self.trigger_every:
+            return False
+        return True
+
     def _run(self, func, *args, **kwds):
         if not hasattr(func, '__call__'):
             raise PyXdebugError('func is not callable')
 
-        # import hook
-        import_hooked = False
-        if self.collect_imports:
-            import_hooked = True
-            original_import = __builtin__.__import__
-            original_reload = __builtin__.reload
+        with self.arm_lock:
+            self.start_run(inspect.currentframe())
+        try:
+            # call
+            return func(*args, **kwds)
+        except:
+            self.error_run(sys.exc_info())
+            raise
+        finally:
+            with self.arm_lock:
+                self.stop_run()
+
+    def start_run(self, root):
+        if self.hooks is not None:
+            raise PyXdebugError('PyXdebug is already running')
+
+        # start time
+        self.start_time = clock()
+        self.start_gmtime = time.gmtime()
+
+        # exit records are needed by the computerized format and by
+        # writers that measure call durations
+        self.collect_exits = self.trace_format==1 or self.collect_durations or getattr(self.writer, 'collect_exits', False)
+
+        # line and exception events are only needed to collect assignments
+        # and exceptions, otherwise the profile hook reports calls and
+        # returns without any line events
+        self.trace_lines = bool(self.collect_assignments or self.collect_exceptions)
+
+        # per thread state is kept by a tracer for each thread, the
+        # run state is shared by them and the lock serializes their records
+        self.thread_id = thread.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.run_state = {'running': True, 'thread_id': self.thread_id, 'records': 0, 'truncated': False}
+        if self.trace_threads:
+            self.thread_lock = threading.Lock()
+
+        # memory probe
+        self.probe = get_memory_probe(self.memory_probe, self.memory_interval)
+        if self.probe is not None:
+            self.probe.start()
+
+        # start writer
+        if self.writer is not None:
+            self.writer.start(self)
+        self.recorder = self.get_recorder()
+
+        # the traces of the processes are tagged with their pids
+        if self.trace_children:
+            trace = ProcessTrace(None, 0)
+            trace.setvalue(os.getpid(), os.getppid())
+            self.add_trace(trace)
+
+        # the original hooks, restored by stop_run in the arming thread
+        hooks = self.hooks = {}
+        hooks['thread_id'] = thread.get_ident()
+
+        # sampling replaces the trace and import hooks, the stacks are
+        # sampled up to the root frame
+        sampler = None
+        if self.sample_interval:
+            sampler = StackSampler(self, thread.get_ident(), root, self.sample_interval)
+        hooks['sampler'] = sampler
 
-            def __pyxdebug_import_hook(name, globals=None, locals=None, fromlist=None, **kwds):
+        # import hook
+        if self.collect_imports and sampler is None:
+            original_import = hooks['import'] = __builtin__.__import__
+            original_reload = hooks['reload'] = __builtin__.reload
+
+            def __pyxdebug_import_hook(name, globals=None, locals=None, fromlist=None, *args, **kwds):
+                # imports of other threads, of pyxdebug itself and of the
+                # writer while it writes a record are not recorded, nor are
+                # the imports below the deepest allowed call
                 frame = inspect.currentframe()
+                if thread.get_ident()!=self.thread_id or self.writing or self.is_internal(frame.f_back) or self.is_too_deep():
+                    return original_import(name, globals, locals, fromlist, *args, **kwds)
                 self.trace_import(frame, (name, fromlist))
                 result = None
                 try:
-                    result = original_import(name, globals, locals, fromlist, **kwds)
+                    result = original_import(name, globals, locals, fromlist, *args, **kwds)
                     return result
                 finally:
-                    self.trace_return(frame, result)
+                    self.trace_import_return(frame, result)
 
             def __pyxdebug_reload_hook(module):
                 frame = inspect.currentframe()
+                if thread.get_ident()!=self.thread_id or self.writing or self.is_internal(frame.f_back) or self.is_too_deep():
+                    return original_reload(module)
                 self.trace_reload(frame, module)
                 result = None
                 try:
                     result = original_reload(module)
                     return result
                 finally:
-                    self.trace_return(frame, result)
+                    self.trace_import_return(frame, result)
 
             __builtin__.__import__ = __pyxdebug_import_hook
             __builtin__.reload = __pyxdebug_reload_hook
 
-        # profile hook
-        original_trace = sys.gettrace()
-        sys.settrace(self.trace_dispatch)
-
-        # start time
-        self.start_time = time.time()
-        self.start_gmtime = time.gmtime()
+        # fork hook, os._exit skips the finally clause of _run so the
+        # processes finish their trace before they exit
+        if self.trace_children and sampler is None and hasattr(os, 'fork'):
+            original_fork = hooks['fork'] = os.fork
+            original_exit = hooks['exit'] = os._exit
+
+            def __pyxdebug_fork_hook():
+                # the records the parent buffered are written before the
+                # fork, so that the child does not write them again
+                flush_writer(self.writer)
+                ppid = os.getpid()
+                pid = original_fork()
+                if pid==0:
+                    # subprocess execs right after the fork
+                    if is_subprocess_fork(inspect.currentframe().f_back):
+                        os.fork = original_fork
+                        os._exit = original_exit
+                        self.leave_process()
+                    else:
+                        self.fork_process(ppid)
+                return pid
+
+            def __pyxdebug_exit_hook(status):
+                sys.settrace(None)
+                sys.setprofile(None)
+                self.finish_run()
+                original_exit(status)
+
+            os.fork = __pyxdebug_fork_hook
+            os._exit = __pyxdebug_exit_hook
+
+        # profile hook, writers that only need the imports, like the import
+        # profile, leave the calls untraced
+        hooks['trace_calls'] = getattr(self.writer, 'trace_calls', True)
+        hooks['trace'] = sys.gettrace()
+        hooks['profile'] = sys.getprofile()
+        hooks['thread_trace'] = getattr(threading, '_trace_hook', None)
+        hooks['thread_profile'] = getattr(threading, '_profile_hook', None)
+        if sampler is not None:
+            sampler.start()
+        elif hooks['trace_calls'] and self.trace_lines:
+            if self.trace_threads:
+                threading.settrace(self.thread_dispatch)
+            sys.settrace(self.trace_dispatch)
+        elif hooks['trace_calls']:
+            if self.trace_threads:
+                threading.setprofile(self.thread_dispatch)
+            sys.setprofile(self.profile_dispatch)
+
+    def error_run(self, exc_info):
+        # writers may record the exception that escapes
+        if self.writer is not None and hasattr(self.writer, 'error'):
+            self.writer.error(self, exc_info)
+
+    def stop_run(self):
+        # tracing is armed until the finish record is written
+        hooks = self.hooks
+
+        # reset profile hook
+        if hooks['sampler'] is not None:
+            hooks['sampler'].stop()
+        elif hooks['trace_calls'] and self.trace_lines:
+            sys.settrace(hooks['trace'])
+        elif hooks['trace_calls']:
+            sys.setprofile(hooks['profile'])
+        if self.trace_threads and hooks['trace_calls']:
+            threading.settrace(hooks['thread_trace'])
+            threading.setprofile(hooks['thread_profile'])
+
+        # reset import and fork hook
+        if 'import' in hooks:
+            __builtin__.__import__ = hooks['import']
+            __builtin__.reload = hooks['reload']
+        if 'fork' in hooks:
+            os.fork = hooks['fork']
+            os._exit = hooks['exit']
 
         try:
-            # call
-            return func(*args, **kwds)
+            self.finish_run()
         finally:
-            # reset profile hook
-            sys.settrace(original_trace)
-
-            # end time
-            self.end_gmtime = time.gmtime()
+            self.hooks = None
+
+    def finish_run(self):
+        # end time
+        self.end_gmtime = time.gmtime()
+
+        # finish, threads that are still running stop recording
+        trace = FinishTrace(None, 0)
+        trace.setvalue(self.start_time, self.get_memory())
+        trace.thread_id = self.thread_id
+        if self.thread_lock is None:
+            self.run_state['running'] = False
+            self.write_trace(trace)
+        else:
+            with self.thread_lock:
+                self.run_state['running'] = False
+                self.write_trace(trace)
 
-            # reset import hook
-            if import_hooked:
-                __builtin__.__import__ = original_import
-                __builtin__.reload = original_reload
+        # finish writer
+        if self.writer is not None:
+            self.writer.finish(self)
 
-            # finish
-            trace = FinishTrace(None, 0)
-            trace.setvalue(self.start_time)
-            self.result.append(trace)
+        # stop memory probe
+        if self.probe is not None:
+            self.probe.stop()
 
     def trace_dispatch(self, frame, event, arg):
-        # ignore method
-        if frame.f_code.co_name in ('__pyxdebug_import_hook', '__pyxdebug_reload_hook'):
+        code_cache = self.code_cache
+
+        # ignore method, and the code a writer runs while it writes a record
+        info = code_cache.get(id(frame.f_code)) or self.get_code_info(frame.f_code)
+        if info.hook or self.writing:
+            return
+
+        # filtered function, its own line events are disabled as well
+        if info.traced is None:
+            info.traced = self.is_traced(info.code, frame.f_globals.get('__name__'))
+        if not info.traced:
             return
 
         # ignore frame
-        if os.path.splitext(os.path.abspath(frame.f_back.f_code.co_filename))[0]==this_path:
-            if self.call_func_name is None or self.call_func_name!=frame.f_code.co_name:
-                return
+        f_back = frame.f_back
+        if f_back is not None:
+            back_info = code_cache.get(id(f_back.f_code)) or self.get_code_info(f_back.f_code)
+            if back_info.internal and not back_info.wrapper:
+                if self.call_func_name is None or self.call_func_name!=info.code.co_name:
+                    return
 
         # normalize event
         if event[0:2]=='c_':
             event = event[2:]
 
-        # wrap frame
-        frame = FrameWrap(frame)
-        f_back = frame.f_back
-        while f_back:
-            if os.path.splitext(os.path.abspath(f_back.f_code.co_filename))[0]==this_path:
-                f_back = f_back.f_back
-            else:
-                break
-        frame.f_back = FrameWrap(f_back)
-
         # dispatch call
         if event=='call':
-            self.trace_call(frame, arg)
+            # every call made while the deepest allowed call runs is deeper
+            if self.is_too_deep():
+                return
+            while f_back:
+                back_info = code_cache.get(id(f_back.f_code)) or self.get_code_info(f_back.f_code)
+                if back_info.internal:
+                    f_back = f_back.f_back
+                else:
+                    break
+            if self.recorder is not None:
+                self.recorder.record_call(self, frame, f_back)
+                self.call_depth += 1
+            else:
+                caller = FrameSnapshot(f_back, live=False) if f_back else None
+                self.trace_call(FrameSnapshot(frame, caller), arg)
 
             # collect assignments
             if self.collect_assignments:
@@ -164,81 +538,2097 @@ class PyXdebug(object):
         elif event=='return':
             # collect assignments
             if self.collect_assignments:
-                self.trace_line(frame, arg)
+                self.trace_line(FrameSnapshot(frame), arg)
                 self.late_dispatch.pop()
 
-            self.trace_return(frame, arg)
+            self.trace_return(frame, arg, is_unwinding(frame))
 
         # dispatch line
         elif event=='line':
             if self.collect_assignments:
-                self.trace_line(frame, arg)
+                self.trace_line(FrameSnapshot(frame), arg)
+
+        # dispatch exception
+        elif event=='exception':
+            if self.collect_exceptions:
+                self.trace_exception(frame, arg)
 
         return self.trace_dispatch
 
+    def profile_dispatch(self, frame, event, arg):
+        # the profile hook also reports the returns of frames that
+        # trace_dispatch ignored, so only the recorded frames are followed
+        if event=='call':
+            if self.trace_dispatch(frame, event, arg) is not None:
+                self.profile_frames.append(id(frame))
+        elif event=='return':
+            if self.profile_frames and self.profile_frames[-1]==id(frame):
+                self.profile_frames.pop()
+                self.trace_dispatch(frame, event, arg)
+
+    def is_traced(self, code, module):
+        filename = os.path.abspath(code.co_filename)
+        name = code.co_name
+        if self.include_modules or self.include_files or self.include_functions:
+            if not (match_module(module, self.include_modules)
+                    or match_glob(filename, self.include_files)
+                    or match_glob(name, self.include_functions)):
+                return False
+        if match_module(module, self.exclude_modules):
+            return False
+        if match_glob(filename, self.exclude_files):
+            return False
+        if match_glob(name, self.exclude_functions):
+            return False
+        return True
+
+    def is_internal(self, frame):
+        if frame is None:
+            return False
+        info = self.code_cache.get(id(frame.f_code)) or self.get_code_info(frame.f_code)
+        return info.internal
+
+    def get_code_info(self, code):
+        info = CodeInfo(code)
+        self.code_cache[id(code)] = info
+        return info
+
     def trace_call(self, frame, arg):
         trace = CallTrace(frame, self.call_depth)
-        trace.setvalue(self.start_time, self.collect_params)
-        self.result.append(trace)
+        trace.setvalue(self.start_time, self.collect_params, self.get_memory())
+        # resolve everything that needs the locals while the frame is alive
+        trace.callee_name()
+        trace.params = [(key, self.capture_value(value)) for key, value in trace.get_params()]
+        frame.detach()
+        self.push_call(trace)
+        self.add_trace(trace)
         self.call_depth += 1
 
-    def trace_return(self, frame, arg):
+    def trace_return(self, frame, arg, unwinding=False):
         self.call_depth -= 1
-        if self.collect_return:
+        number = self.get_call_number(self.call_depth)
+        if self.collect_exits and self.recorder is not None:
+            self.recorder.record_exit(self, number, unwinding)
+        elif self.collect_exits:
+            trace = ExitTrace(None, self.call_depth)
+            trace.setvalue(self.start_time, self.get_memory())
+            trace.number = number
+            trace.unwinding = unwinding
+            # the duration is also set on the call record
+            call = self.get_open_call(self.call_depth)
+            if call is not None:
+                trace.set_duration(call)
+                call.duration = trace.duration
+                call.memory_delta = trace.memory_delta
+            self.add_trace(trace)
+        # an unwinding frame returns no value
+        if self.collect_return and not unwinding:
             trace = ReturnTrace(None, self.call_depth)
-            trace.setvalue(arg)
-            self.result.append(trace)
+            trace.setvalue(self.capture_value(arg))
+            trace.number = number
+            self.add_trace(trace)
+
+    def trace_exception(self, frame, arg):
+        # the exception event is repeated for every frame it propagates
+        # through, it is recorded where it was raised
+        exc_type, exc_value, exc_traceback = arg
+        raised = exc_traceback is None or exc_traceback.tb_next is None
+        if raised:
+            trace = ExceptionTrace(FrameSnapshot(frame, live=False), self.call_depth)
+            trace.setvalue(get_exception_name(exc_type), get_exception_message(exc_value, self.var_display_max_data))
+            trace.number = self.get_call_number(self.call_depth-1)
+            self.add_trace(trace)
+
+    def capture_value(self, value):
+        return capture_value(value, self.var_display_max_children, self.var_display_max_data, self.var_display_max_depth)
+
+    def get_memory(self):
+        if self.probe is not None:
+            return self.probe.read()
+        return None
+
+    def get_recorder(self):
+        # a flight recorder is fed by the dispatch path without record
+        # objects, unless the records go through the thread lock or the
+        # record limit
+        if self.thread_lock is None and not self.max_records and hasattr(self.writer, 'record_call'):
+            return self.writer
+        return None
+
+    def push_call(self, trace):
+        # records of the open calls, indexed by call depth
+        trace.number = next(self.call_counter)
+        if self.recorder is not None:
+            self.recorder.open_call(self.call_depth, trace.number, trace.time, trace.memory)
+            return
+        del self.call_stack[self.call_depth:]
+        self.call_stack.append(trace)
+
+    def get_open_call(self, call_depth):
+        if 0<=call_depth<len(self.call_stack):
+            return self.call_stack[call_depth]
+        return None
+
+    def get_call_number(self, call_depth):
+        if self.recorder is not None:
+            return self.recorder.get_call_number(call_depth)
+        if 0<=call_depth<len(self.call_stack):
+            return self.call_stack[call_depth].number
+        return 0
 
     def trace_line(self, frame, arg):
         pre_frame = self.late_dispatch[self.call_depth-1]
         self.late_dispatch[self.call_depth-1] = frame
 
+        # pre_frame points at the previous line of the same frame, so its
+        # locals already hold the values assigned by that line
         if pre_frame:
-            frame = FrameWrap(frame)
-            frame.set_position(pre_frame)
-            self._trace_line(frame)
+            self._trace_line(pre_frame)
+            pre_frame.detach()
 
     def _trace_line(self, frame):
-        line = frame.get_line().strip()
-        match = re.compile(r"^([^\+\-\*/=]+)([\+\-\*/]?=[^=])(.+)$").match(line)
-        if match:
-            varnames = match.group(1).strip()
-            try:
-                varnames = re.compile(r"^\((.+)\)$").match(varnames).group(1).strip()
-            except:
-                pass 
-            if re.compile(r"^(([a-zA-Z0-9_]+\.)?[a-zA-Z0-9_]+)(\s*,\s*(([a-zA-Z0-9_]+\.)?[a-zA-Z0-9_]+))*(\s*,\s*)?$").match(varnames):
-                varnames = re.compile(r"\s*,\s*").split(varnames)
-            else:
-                varnames = None
-            if varnames:
-                for varname in varnames:
-                    value = get_frame_var(frame, varname)
-                    trace = AssignmentTrace(frame, self.call_depth)
-                    trace.setvalue(varname, value)
-                    self.result.append(trace)
+        info = self.code_cache.get(id(frame.f_code)) or self.get_code_info(frame.f_code)
+        if info.assignments is None:
+            info.assignments = get_assignments(frame.f_code)
+        varnames = info.assignments.get(frame.f_lineno)
+        if varnames:
+            for varname in varnames:
+                value = self.capture_value(get_frame_var(frame, varname))
+                trace = AssignmentTrace(frame, self.call_depth)
+                trace.setvalue(varname, value)
+                trace.number = self.get_call_number(self.call_depth-1)
+                self.add_trace(trace)
+
+    def is_too_deep(self):
+        return self.max_depth and self.call_depth>=self.max_depth
 
     def trace_import(self, frame, arg):
+        frame = FrameSnapshot(frame, FrameSnapshot(frame.f_back, live=False), live=False)
         trace = ImportTrace(frame, self.call_depth)
-        trace.setvalue(arg[0], arg[1], self.start_time)
-        self.result.append(trace)
+        trace.setvalue(arg[0], arg[1], self.start_time, self.get_memory())
+        trace.modules = self.count_modules()
+        self.push_call(trace)
+        self.add_trace(trace)
         self.call_depth += 1
+        # the import is a level of the assignment state as a call is
+        if self.collect_assignments:
+            self.late_dispatch.append(None)
 
     def trace_reload(self, frame, arg):
+        frame = FrameSnapshot(frame, FrameSnapshot(frame.f_back, live=False), live=False)
         trace = ReloadTrace(frame, self.call_depth)
-        trace.setvalue(arg, self.start_time)
-        self.result.append(trace)
+        trace.setvalue(arg, self.start_time, self.get_memory())
+        trace.modules = self.count_modules()
+        self.push_call(trace)
+        self.add_trace(trace)
         self.call_depth += 1
+        if self.collect_assignments:
+            self.late_dispatch.append(None)
+
+    def trace_import_return(self, frame, arg):
+        if self.collect_assignments:
+            self.late_dispatch.pop()
+        # the number of modules the import loaded, 0 is a cache hit
+        call = self.get_open_call(self.call_depth-1)
+        if getattr(call, 'modules', None) is not None:
+            call.loaded = self.count_modules() - call.modules
+        self.trace_return(frame, arg)
+
+    def count_modules(self):
+        # the modules in sys.modules without the None entries of the failed
+        # relative imports, only counted again when the size of sys.modules
+        # changed, so a None entry replaced by a module, or a module loaded
+        # while another one is removed, is not counted
+        size = len(sys.modules)
+        if self.module_count is None or self.module_count[0]!=size:
+            self.module_count = (size, len([o for o in sys.modules.values() if o is not None]))
+        return self.module_count[1]
+
+    def sample_stack(self, frame, root):
+        code_cache = self.code_cache
+        names = []
+        while frame is not None and frame is not root:
+            info = code_cache.get(id(frame.f_code)) or self.get_code_info(frame.f_code)
+            if not info.internal:
+                names.append(get_method_name(frame))
+            frame = frame.f_back
+        if names:
+            names.reverse()
+            stack = u';'.join(names)
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def get_folded(self):
+        lines = [u'%s %d\n' % (stack, count) for stack, count in sorted(self.samples.iteritems())]
+        return u''.join(lines)
+
+    def thread_dispatch(self, frame, event, arg):
+        # first event of a new thread, hand it over to its own tracer
+        tracer = self.fork_thread()
+        if self.trace_lines:
+            sys.settrace(tracer.trace_dispatch)
+            return tracer.trace_dispatch(frame, event, arg)
+        sys.setprofile(tracer.profile_dispatch)
+        tracer.profile_dispatch(frame, event, arg)
+
+    def fork_thread(self):
+        # options, writer, result and caches are shared with the copy
+        tracer = copy.copy(self)
+        tracer.thread_id = thread.get_ident()
+        tracer.thread_name = threading.current_thread().name
+        tracer.call_depth = 0
+        tracer.writing = False
+        tracer.late_dispatch = []
+        tracer.call_stack = []
+        tracer.profile_frames = []
+        return tracer
+
+    def fork_process(self, ppid):
+        # the child keeps the call depth and the start time of the parent,
+        # so that the times of the process traces can be merged, the
+        # threads of the parent are not copied by fork
+        pid = os.getpid()
+        self.thread_id = thread.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.run_state = {'running': True, 'thread_id': self.thread_id, 'records': 0, 'truncated': False}
+        if self.thread_lock is not None:
+            self.thread_lock = threading.Lock()
+        self.arm_lock = threading.Lock()
+        self.start_gmtime = time.gmtime()
+        self.result = []
+        self.probe = get_memory_probe(self.memory_probe, self.memory_interval)
+        if self.probe is not None:
+            self.probe.start()
+        self.writer = self.child_writer(pid, ppid) if self.child_writer is not None else None
+        if self.writer is not None:
+            self.writer.start(self)
+        self.recorder = self.get_recorder()
+        trace = ProcessTrace(None, self.call_depth)
+        trace.setvalue(pid, ppid)
+        self.add_trace(trace)
+
+    def leave_process(self):
+        # the child is not traced, the hooks pass everything through
+        sys.settrace(None)
+        sys.setprofile(None)
+        self.thread_id = None
+
+    def add_trace(self, trace):
+        trace.thread_id = self.thread_id
+        if self.thread_lock is None:
+            if self.max_records:
+                self.write_limited(trace)
+            else:
+                self.write_trace(trace)
+            return
 
-    def get_result(self):
+        with self.thread_lock:
+            state = self.run_state
+            if not state['running']:
+                # the run is over, stop tracing this thread
+                sys.settrace(None)
+                sys.setprofile(None)
+                return
+            if state['thread_id']!=self.thread_id and not getattr(self.writer, 'split_threads', False):
+                state['thread_id'] = self.thread_id
+                marker = ThreadTrace(None, self.call_depth)
+                marker.setvalue(self.thread_id, self.thread_name)
+                marker.thread_id = self.thread_id
+                self.write_trace(marker)
+            if self.max_records:
+                self.write_limited(trace)
+            else:
+                self.write_trace(trace)
+
+    def write_limited(self, trace):
+        state = self.run_state
+        if state['truncated']:
+            # pending returns of the import hook after the limit
+            return
+        self.write_trace(trace)
+        state['records'] += 1
+        if state['records']>=self.max_records:
+            self.truncate()
+
+    def truncate(self):
+        state = self.run_state
+        state['truncated'] = True
+        state['running'] = False
+        trace = LogTrace(None, self.call_depth)
+        trace.setvalue(u'trace truncated after %d records' % state['records'])
+        trace.thread_id = self.thread_id
+        self.write_trace(trace)
+        # stop tracing, the other threads stop at their next record
+        sys.settrace(None)
+        sys.setprofile(None)
+
+    @property
+    def truncated(self):
+        return bool(self.run_state and self.run_state['truncated'])
+
+    def write_trace(self, trace):
+        if self.writer is None:
+            self.result.append(trace)
+            return
+        # the calls and imports of the writer, like a codec it loads lazily,
+        # are not recorded in the middle of its record, nor do they wait for
+        # the thread lock this thread holds
+        self.writing = True
+        try:
+            self.writer.write(trace)
+        finally:
+            self.writing = False
+
+    def get_header(self):
+        return format_header(self.start_gmtime, self.trace_format)
+
+    def get_footer(self):
+        return format_footer(self.end_gmtime)
+
+    def get_result(self, thread_id=None):
         if self.end_gmtime is None:
             raise PyXdebugError('PyXdebug has not run yet')
-        result = u"TRACE START [%s]\n" % (time.strftime('%Y-%m-%d %H:%M:%S', self.start_gmtime))
-        result += u"\n".join([o.get_result() for o in self.result])
-        result += u"\nTRACE END   [%s]\n\n" % (time.strftime('%Y-%m-%d %H:%M:%S', self.end_gmtime))
+        if self.writer is not None:
+            raise PyXdebugError('PyXdebug trace was written to the writer')
+        traces = self.result
+        if thread_id is not None:
+            traces = [o for o in traces if o.thread_id==thread_id and o.__class__ is not ThreadTrace]
+        result = self.get_header()
+        result += u"\n".join([o.render(self.trace_format) for o in traces])
+        result += u"\n" + self.get_footer()
         return result
 
 
+class StackSampler(threading.Thread):
+    def __init__(self, xd, thread_id, root, interval):
+        super(StackSampler, self).__init__(name='pyxdebug-sampler')
+        self.daemon = True
+        self.xd = xd
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval
+        self.running = True
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None and self.running:
+                self.xd.sample_stack(frame, self.root)
+            frame = None
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class RusageProbe(object):
+    def start(self):
+        pass
+
+    def read(self):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+    def stop(self):
+        pass
+
+
+class TracemallocProbe(object):
+    def __init__(self):
+        self.started = False
+
+    def start(self):
+        # an allocation tracing that is already running is left running
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+
+    def read(self):
+        return tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+
+class RssProbe(threading.Thread):
+    def __init__(self, interval):
+        super(RssProbe, self).__init__(name='pyxdebug-rss')
+        self.daemon = True
+        self.interval = interval
+        self.value = get_rss()
+        self.running = True
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.value = get_rss()
+
+    def read(self):
+        # the value of the last interval, no system call per record
+        return self.value
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class CodeInfo(object):
+    __slots__ = ('code', 'filename', 'internal', 'hook', 'wrapper', 'traced', 'assignments')
+
+    def __init__(self, code):
+        # keep a reference to the code so that its id is not reused during the run
+        self.code = code
+        self.filename = os.path.splitext(os.path.abspath(code.co_filename))[0]
+        self.internal = self.filename==this_path
+        self.hook = code.co_name in HOOK_NAMES or (self.internal and code.co_name in ARM_NAMES)
+        # the calls of the trace decorator are not internal ones
+        self.wrapper = code.co_name=='__pyxdebug_trace_hook'
+        self.traced = None
+        self.assignments = None
+
+
+class TraceWriter(object):
+    def __init__(self, fileobj, buffer_size=1000):
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.trace_format = 0
+
+    def start(self, xd):
+        self.trace_format = xd.trace_format
+        self.fileobj.write(xd.get_header())
+
+    def write(self, trace):
+        self.buffer.append(trace.render(self.trace_format))
+        if len(self.buffer)>=self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.fileobj.write(u"\n".join(self.buffer) + u"\n")
+            del self.buffer[:]
+
+    def finish(self, xd):
+        self.flush()
+        self.fileobj.write(xd.get_footer())
+        self.fileobj.flush()
+
+
+class IndexedTraceWriter(TraceWriter):
+    def __init__(self, fileobj, indexobj, buffer_size=1000, interval=1000):
+        super(IndexedTraceWriter, self).__init__(fileobj, buffer_size)
+        self.indexobj = indexobj
+        self.interval = interval
+        self.offset = 0
+        self.records = 0
+        self.time = 0.0
+        # depth, start offset, time and name of the open calls
+        self.stack = []
+        # name, start offset, end offset and time of the ended calls, up to
+        # interval calls are sorted and written together
+        self.run = []
+
+    def start(self, xd):
+        # offsets are absolute, the trace may be appended to a file, and
+        # so may the index, with a section for each trace
+        try:
+            self.fileobj.seek(0, 2)
+            self.offset = self.fileobj.tell()
+        except (AttributeError, IOError):
+            self.offset = 0
+        self.trace_format = xd.trace_format
+        header = xd.get_header().encode('utf-8')
+        self.fileobj.write(header)
+        self.offset += len(header)
+        self.indexobj.write('%s\nformat %d\ninterval %d\n' % (INDEX_MAGIC, self.trace_format, self.interval))
+
+    def write(self, trace):
+        offset = self.offset
+        line = trace.render(self.trace_format).encode('utf-8')
+        self.buffer.append(line)
+        self.offset += len(line) + 1
+
+        # time checkpoint, the time of the last timed record before it
+        if self.records % self.interval==0:
+            self.indexobj.write('C %d %d %r\n' % (self.records, offset, self.time))
+        self.records += 1
+        if getattr(trace, 'time', None) is not None:
+            self.time = trace.time
+
+        # a call ends with the first record outside its subtree, its exit
+        # and return records are still part of it
+        if isinstance(trace, FinishTrace):
+            self.close_calls(0, offset)
+        elif isinstance(trace, (ExitTrace, ReturnTrace)):
+            self.close_calls(trace.call_depth + 1, offset)
+        else:
+            self.close_calls(trace.call_depth, offset)
+        if isinstance(trace, ImportTrace):
+            self.stack.append((trace.call_depth, offset, trace.time, trace.get_import_str()))
+        elif isinstance(trace, ReloadTrace):
+            self.stack.append((trace.call_depth, offset, trace.time, u'reload(%s)' % trace.module))
+        elif isinstance(trace, CallTrace) and not isinstance(trace, (ExitTrace, FinishTrace)):
+            self.stack.append((trace.call_depth, offset, trace.time, trace.callee_name()))
+
+        if len(self.buffer)>=self.buffer_size:
+            self.flush()
+
+    def close_calls(self, call_depth, offset):
+        stack = self.stack
+        while stack and stack[-1][0]>=call_depth:
+            depth, start, time_, name = stack.pop()
+            self.run.append((flatten_value(name).encode('utf-8'), start, offset, time_ or 0.0))
+        if len(self.run)>=self.interval:
+            self.write_run()
+
+    def write_run(self):
+        # the ended calls sorted by name and start offset, then sorted by
+        # start offset, the reader bisects them through a memory map
+        if not self.run:
+            return
+        self.run.sort()
+        names = ''.join(['F %s\t%d %d %r\n' % o for o in self.run])
+        self.run.sort(key=lambda o: o[1])
+        starts = ''.join(['S %d %d\n' % (start, end) for name, start, end, time_ in self.run])
+        self.indexobj.write('R %d %d\n%s%s' % (len(names), len(starts), names, starts))
+        del self.run[:]
+
+    def flush(self):
+        if self.buffer:
+            self.fileobj.write('\n'.join(self.buffer) + '\n')
+            del self.buffer[:]
+
+    def finish(self, xd):
+        self.close_calls(0, self.offset)
+        self.write_run()
+        self.flush()
+        self.fileobj.write(xd.get_footer().encode('utf-8'))
+        self.fileobj.flush()
+        self.indexobj.write('E %d %d\n' % (self.records, self.offset))
+        self.indexobj.flush()
+
+
+class IndexedTraceReader(object):
+    def __init__(self, trace_path, index_path=None, section=-1):
+        self.trace_path = trace_path
+        self.index_path = index_path or trace_path + '.idx'
+        self.trace_format = 0
+        self.interval = 0
+        self.records = 0
+        self.end = 0
+        # record numbers, offsets and times of the checkpoints
+        self.checkpoints = []
+        self.checkpoint_times = []
+        # index offsets of the runs of ended calls, the start of the calls
+        # sorted by name, of the calls sorted by start offset and the end
+        self.runs = []
+
+        self.indexobj = open(self.index_path, 'rb')
+        if os.fstat(self.indexobj.fileno()).st_size:
+            self.index = mmap.mmap(self.indexobj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.index = ''
+        try:
+            self.read_index(section)
+        except:
+            self.close_index()
+            raise
+
+        self.fileobj = open(trace_path, 'rb')
+        if os.fstat(self.fileobj.fileno()).st_size:
+            self.data = mmap.mmap(self.fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ''
+
+    def read_index(self, section):
+        # a trace appended to a file appends a section to its index
+        index = self.index
+        magic = INDEX_MAGIC + '\n'
+        if index[:len(magic)]!=magic:
+            raise PyXdebugError('not a PyXdebug trace index')
+        sections = [0]
+        while True:
+            pos = index.find('\n' + magic, sections[-1])
+            if pos<0:
+                break
+            sections.append(pos + 1)
+        if section<0:
+            section += len(sections)
+        if not 0<=section<len(sections):
+            raise PyXdebugError('no section %d in the trace index' % section)
+        pos = sections[section]
+        end = sections[section+1] if section+1<len(sections) else len(index)
+
+        pos += len(magic)
+        while pos<end:
+            line_end = index.find('\n', pos, end)
+            if line_end<0:
+                line_end = end
+            kind, value = index[pos:line_end].split(' ', 1)
+            pos = line_end + 1
+            if kind=='C':
+                records, offset, time_ = value.split(' ')
+                self.checkpoints.append((int(records), int(offset)))
+                self.checkpoint_times.append(float(time_))
+            elif kind=='R':
+                # the calls are not read, they are bisected when asked for
+                names, starts = value.split(' ')
+                self.runs.append((pos, pos + int(names), pos + int(names) + int(starts)))
+                pos = self.runs[-1][2]
+            elif kind=='E':
+                records, offset = value.split(' ')
+                self.records = int(records)
+                self.end = int(offset)
+            elif kind=='format':
+                self.trace_format = int(value)
+            elif kind=='interval':
+                self.interval = int(value)
+
+    def close_index(self):
+        if not isinstance(self.index, str):
+            self.index.close()
+        self.indexobj.close()
+
+    def close(self):
+        self.close_index()
+        if not isinstance(self.data, str):
+            self.data.close()
+        self.fileobj.close()
+
+    def get_lines(self, start, end):
+        if start>=end:
+            return []
+        return self.data[start:end].decode('utf-8').rstrip(u'\n').split(u'\n')
+
+    def get_functions(self):
+        # every call of every run is read
+        names = set()
+        for start, middle, end in self.runs:
+            for line in self.index[start:middle].splitlines():
+                names.add(line[2:line.index('\t')])
+        return sorted([name.decode('utf-8') for name in names])
+
+    def get_offsets(self, name):
+        # start offset, end offset and time of the calls of the function
+        index = self.index
+        name = flatten_value(name).encode('utf-8')
+        result = []
+        for start, middle, end in self.runs:
+            pos = bisect_lines(index, start, middle, name, lambda line: line[2:line.index('\t')])
+            while pos<middle:
+                line_end = index.find('\n', pos, middle)
+                line = index[pos:line_end]
+                key, value = line[2:].split('\t', 1)
+                if key!=name:
+                    break
+                call_start, call_end, time_ = value.split(' ')
+                result.append((int(call_start), int(call_end), float(time_)))
+                pos = line_end + 1
+        result.sort()
+        return result
+
+    def get_calls(self, name):
+        # the first line of every call of the function
+        result = []
+        for start, end, time_ in self.get_offsets(name):
+            line_end = self.data.find('\n', start, end)
+            result.append(self.data[start:line_end if line_end>=0 else end].decode('utf-8'))
+        return result
+
+    def get_subtree(self, offset):
+        # a call, its callees and its exit and return records
+        index = self.index
+        for start, middle, end in self.runs:
+            pos = bisect_lines(index, middle, end, offset, lambda line: int(line[2:line.index(' ', 2)]))
+            if pos<end:
+                call_start, call_end = index[pos+2:index.find('\n', pos, end)].split(' ')
+                if int(call_start)==offset:
+                    return self.get_lines(offset, int(call_end))
+        raise PyXdebugError('no call at offset %d' % offset)
+
+    def get_function_subtrees(self, name):
+        return [self.get_lines(start, end) for start, end, time_ in self.get_offsets(name)]
+
+    def get_time_range(self, start_time, end_time):
+        # start from the last checkpoint before the window, then scan
+        index = bisect.bisect_left(self.checkpoint_times, start_time) - 1
+        offset = self.checkpoints[index][1] if index>=0 else (self.checkpoints[0][1] if self.checkpoints else self.end)
+        result = []
+        time_ = None
+        while offset<self.end:
+            line_end = self.data.find('\n', offset, self.end)
+            if line_end<0:
+                line_end = self.end
+            line = self.data[offset:line_end].decode('utf-8')
+            offset = line_end + 1
+            line_time = self.parse_time(line)
+            if line_time is not None:
+                time_ = line_time
+            if time_ is None or time_<start_time:
+                continue
+            if time_>end_time:
+                break
+            result.append(line)
+        return result
+
+    def parse_time(self, line):
+        try:
+            if self.trace_format==1:
+                fields = line.split(u'\t')
+                if len(fields)>4 and fields[3]:
+                    return float(fields[3])
+            elif line[:10].strip():
+                return float(line[:10])
+        except ValueError:
+            pass
+        return None
+
+
+class BinaryTraceWriter(object):
+    def __init__(self, fileobj, buffer_size=65536):
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.strings = {}
+        self.depth = 0
+        self.time = 0
+        self.memory = 0
+        self.encoders = {
+            CallTrace: self.encode_call,
+            ReturnTrace: self.encode_return,
+            AssignmentTrace: self.encode_assignment,
+            ImportTrace: self.encode_import,
+            ReloadTrace: self.encode_reload,
+            ExitTrace: self.encode_exit,
+            FinishTrace: self.encode_finish,
+            LogTrace: self.encode_log,
+            ThreadTrace: self.encode_log,
+            ProcessTrace: self.encode_process,
+            ExceptionTrace: self.encode_exception,
+        }
+
+    def start(self, xd):
+        self.buffer += BINARY_MAGIC
+        self.encode_varint(calendar.timegm(xd.start_gmtime))
+
+    def write(self, trace):
+        encoder = self.encoders.get(trace.__class__)
+        if encoder is None:
+            raise PyXdebugError('%s can not be written to a binary trace' % trace.__class__.__name__)
+        encoder(trace)
+        if len(self.buffer)>=self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.fileobj.write(str(self.buffer))
+            del self.buffer[:]
+
+    def finish(self, xd):
+        self.buffer.append(BINARY_END)
+        self.encode_varint(calendar.timegm(xd.end_gmtime))
+        self.flush()
+        self.fileobj.flush()
+
+    def encode_varint(self, value):
+        buffer = self.buffer
+        while value>0x7f:
+            buffer.append((value & 0x7f) | 0x80)
+            value >>= 7
+        buffer.append(value)
+
+    def encode_signed(self, value):
+        # zigzag encoding keeps small negative deltas small
+        self.encode_varint(value<<1 if value>=0 else ((-value)<<1)-1)
+
+    def encode_bytes(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        self.encode_varint(len(value))
+        self.buffer += value
+
+    def encode_string(self, value):
+        # reference to an interned string, 0 is None
+        self.encode_varint(0 if value is None else self.strings[value])
+
+    def encode_depth(self, trace):
+        self.encode_signed(trace.call_depth - self.depth)
+        self.depth = trace.call_depth
+
+    def encode_time(self, trace):
+        value = int(round((trace.time or 0.0) * 1000000))
+        self.encode_signed(value - self.time)
+        self.time = value
+        memory = trace.memory or 0
+        self.encode_signed(memory - self.memory)
+        self.memory = memory
+
+    # strings are interned before the record tag so that their
+    # definitions never split a record
+    def encode_call(self, trace):
+        name = trace.callee_name()
+        filename = trace.caller_filename()
+        params = trace.get_params()
+        for key, value in params:
+            self.intern(key)
+        self.intern(name)
+        self.intern(filename)
+        self.buffer.append(BINARY_CALL)
+        self.encode_depth(trace)
+        self.encode_time(trace)
+        self.encode_string(name)
+        self.encode_string(filename)
+        self.encode_varint(trace.caller_lineno())
+        self.encode_varint(len(params))
+        for key, value in params:
+            self.encode_string(key)
+            self.encode_bytes(pformat(value))
+
+    def encode_return(self, trace):
+        self.buffer.append(BINARY_RETURN)
+        self.encode_depth(trace)
+        self.encode_bytes(pformat(trace.value))
+
+    def encode_assignment(self, trace):
+        filename = trace.callee_filename()
+        self.intern(trace.varname)
+        self.intern(filename)
+        self.buffer.append(BINARY_ASSIGNMENT)
+        self.encode_depth(trace)
+        self.encode_string(trace.varname)
+        self.encode_bytes(pformat(trace.value))
+        self.encode_string(filename)
+        self.encode_varint(trace.callee_lineno())
+
+    def encode_import(self, trace):
+        filename = trace.caller_filename()
+        fromlist = trace.fromlist or ()
+        for name in fromlist:
+            self.intern(name)
+        self.intern(trace.name)
+        self.intern(filename)
+        self.buffer.append(BINARY_IMPORT)
+        self.encode_depth(trace)
+        self.encode_time(trace)
+        self.encode_string(trace.name)
+        self.encode_varint(len(fromlist))
+        for name in fromlist:
+            self.encode_string(name)
+        self.encode_string(filename)
+        self.encode_varint(trace.caller_lineno())
+
+    def encode_reload(self, trace):
+        filename = trace.caller_filename()
+        self.intern(trace.module)
+        self.intern(filename)
+        self.buffer.append(BINARY_RELOAD)
+        self.encode_depth(trace)
+        self.encode_time(trace)
+        self.encode_string(trace.module)
+        self.encode_string(filename)
+        self.encode_varint(trace.caller_lineno())
+
+    def encode_exit(self, trace):
+        self.buffer.append(BINARY_UNWIND if trace.unwinding else BINARY_EXIT)
+        self.encode_depth(trace)
+        self.encode_time(trace)
+
+    def encode_finish(self, trace):
+        self.buffer.append(BINARY_FINISH)
+        self.encode_time(trace)
+
+    def encode_log(self, trace):
+        self.buffer.append(BINARY_LOG)
+        self.encode_depth(trace)
+        self.encode_bytes(trace.message)
+
+    def encode_process(self, trace):
+        self.buffer.append(BINARY_PROCESS)
+        self.encode_depth(trace)
+        self.encode_varint(trace.pid)
+        self.encode_varint(trace.ppid)
+
+    def encode_exception(self, trace):
+        filename = trace.callee_filename()
+        self.intern(trace.exc_type)
+        self.intern(filename)
+        self.buffer.append(BINARY_EXCEPTION)
+        self.encode_depth(trace)
+        self.encode_string(trace.exc_type)
+        self.encode_bytes(trace.message)
+        self.encode_string(filename)
+        self.encode_varint(trace.callee_lineno())
+
+    def intern(self, value):
+        if value is not None and value not in self.strings:
+            index = len(self.strings) + 1
+            self.strings[value] = index
+            self.buffer.append(BINARY_STRING)
+            self.encode_bytes(value)
+
+
+class FlightRecorder(object):
+    def __init__(self, size=10000, fileobj=None, signum=None, dump_on_error=True, dump_on_finish=False):
+        if size<1:
+            raise PyXdebugError('flight recorder size must be positive')
+        self.size = size
+        self.fileobj = fileobj
+        self.signum = signum
+        self.dump_on_error = dump_on_error
+        self.dump_on_finish = dump_on_finish
+        self.trace_format = 0
+        self.start_gmtime = None
+        self.count = 0
+        self.error_info = None
+        self.original_handler = None
+
+        # preallocated slots of the records, the ring never grows, a kind
+        # of 0 is a slot that is being written
+        self.kinds = array.array('B', [0]) * size
+        self.depths = array.array('l', [0]) * size
+        self.numbers = array.array('l', [0]) * size
+        self.times = array.array('d', [0.0]) * size
+        # -1 is no memory
+        self.memories = array.array('l', [0]) * size
+        self.linenos = array.array('l', [0]) * size
+        # ids of the interned names and filenames, -1 is none
+        self.names = array.array('l', [-1]) * size
+        self.filenames = array.array('l', [-1]) * size
+        # -1 is no thread
+        self.thread_ids = array.array('l', [-1]) * size
+        # nan is no duration
+        self.durations = array.array('d', [NO_DURATION]) * size
+        self.memory_deltas = array.array('l', [0]) * size
+        # the captured values and the messages
+        self.values = [None] * size
+
+        # names and filenames are stored once
+        self.strings = {}
+        self.string_values = []
+
+        # number, time and memory of the open calls, indexed by call depth
+        self.open_numbers = array.array('l')
+        self.open_times = array.array('d')
+        self.open_memories = array.array('l')
+
+        self.storers = {
+            CallTrace: self.store_call,
+            ReturnTrace: self.store_return,
+            AssignmentTrace: self.store_assignment,
+            ImportTrace: self.store_import,
+            ReloadTrace: self.store_reload,
+            ExitTrace: self.store_exit,
+            FinishTrace: self.store_finish,
+            LogTrace: self.store_log,
+            ThreadTrace: self.store_log,
+            ProcessTrace: self.store_log,
+            ExceptionTrace: self.store_exception,
+        }
+
+    def start(self, xd):
+        self.trace_format = xd.trace_format
+        self.start_gmtime = xd.start_gmtime
+        if self.signum is not None:
+            def __pyxdebug_signal_hook(signum, frame):
+                self.dump()
+            self.original_handler = signal.signal(self.signum, __pyxdebug_signal_hook)
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        index = self.strings.get(value)
+        if index is None:
+            # the list first, a dump from a signal handler may read it
+            self.string_values.append(value)
+            index = self.strings[value] = len(self.string_values) - 1
+        return index
+
+    def begin(self, depth, number, thread_id):
+        # the slot is marked as being written until its kind is set
+        index = self.count % self.size
+        self.kinds[index] = 0
+        self.depths[index] = depth
+        self.numbers[index] = number
+        self.thread_ids[index] = -1 if thread_id is None else thread_id
+        self.names[index] = self.filenames[index] = -1
+        self.durations[index] = NO_DURATION
+        self.values[index] = None
+        return index
+
+    def commit(self, index, kind):
+        self.kinds[index] = kind
+        self.count += 1
+
+    def write(self, trace):
+        storer = self.storers.get(trace.__class__)
+        if storer is None:
+            raise PyXdebugError('%s can not be written to a flight recorder' % trace.__class__.__name__)
+        index = self.begin(trace.call_depth, trace.number, trace.thread_id)
+        self.commit(index, storer(index, trace))
+
+    def record_call(self, xd, frame, caller):
+        # a call of the dispatch path, stored without a record object
+        number = next(xd.call_counter)
+        time_ = clock() - xd.start_time
+        memory = xd.get_memory()
+        self.open_call(xd.call_depth, number, time_, memory)
+        index = self.begin(xd.call_depth, number, xd.thread_id)
+        self.times[index] = time_
+        self.memories[index] = -1 if memory is None else memory
+        self.names[index] = self.intern(get_method_name(frame))
+        if caller is not None:
+            self.filenames[index] = self.intern(caller.f_code.co_filename)
+            self.linenos[index] = caller.f_lineno
+        if xd.collect_params:
+            self.values[index] = [(key, xd.capture_value(value)) for key, value in get_frame_params(frame)]
+        self.commit(index, BINARY_CALL)
+
+    def record_exit(self, xd, number, unwinding):
+        # the exit of an open call, xd.call_depth is the depth of the call
+        depth = xd.call_depth
+        time_ = clock() - xd.start_time
+        memory = xd.get_memory()
+        index = self.begin(depth, number, xd.thread_id)
+        self.times[index] = time_
+        self.memories[index] = -1 if memory is None else memory
+        if 0<=depth<len(self.open_numbers) and self.open_numbers[depth]==number:
+            self.durations[index] = time_ - self.open_times[depth]
+            start_memory = self.open_memories[depth]
+            self.memory_deltas[index] = memory - start_memory if memory is not None and start_memory>=0 else 0
+        self.commit(index, BINARY_UNWIND if unwinding else BINARY_EXIT)
+
+    def open_call(self, depth, number, time_, memory):
+        grow = depth + 1 - len(self.open_numbers)
+        if grow>0:
+            self.open_numbers.extend([0] * grow)
+            self.open_times.extend([0.0] * grow)
+            self.open_memories.extend([-1] * grow)
+        self.open_numbers[depth] = number
+        self.open_times[depth] = time_ or 0.0
+        self.open_memories[depth] = -1 if memory is None else memory
+
+    def get_call_number(self, depth):
+        if 0<=depth<len(self.open_numbers):
+            return self.open_numbers[depth]
+        return 0
+
+    def error(self, xd, exc_info):
+        # a failure to record the exception must not replace it
+        self.error_info = exc_info[:2]
+        try:
+            message = get_exception_message(exc_info[1], xd.var_display_max_data)
+            trace = LogTrace(None, xd.call_depth)
+            trace.setvalue(u'exception %s: %s' % (get_exception_name(exc_info[0]), message))
+            trace.thread_id = xd.thread_id
+            self.write(trace)
+        except Exception:
+            pass
+
+    def finish(self, xd):
+        if self.signum is not None:
+            signal.signal(self.signum, self.original_handler or signal.SIG_DFL)
+        if (self.dump_on_error and self.error_info is not None) or self.dump_on_finish:
+            self.dump()
+
+    def store_time(self, index, trace):
+        self.times[index] = trace.time or 0.0
+        self.memories[index] = -1 if trace.memory is None else trace.memory
+
+    def store_call(self, index, trace):
+        self.store_time(index, trace)
+        self.names[index] = self.intern(trace.callee_name())
+        self.filenames[index] = self.intern(trace.caller_filename())
+        self.linenos[index] = trace.caller_lineno()
+        self.values[index] = trace.get_params()
+        return BINARY_CALL
+
+    def store_return(self, index, trace):
+        self.values[index] = trace.value
+        return BINARY_RETURN
+
+    def store_assignment(self, index, trace):
+        self.names[index] = self.intern(trace.varname)
+        self.filenames[index] = self.intern(trace.callee_filename())
+        self.linenos[index] = trace.callee_lineno()
+        self.values[index] = trace.value
+        return BINARY_ASSIGNMENT
+
+    def store_import(self, index, trace):
+        self.store_time(index, trace)
+        self.names[index] = self.intern(trace.name)
+        self.filenames[index] = self.intern(trace.caller_filename())
+        self.linenos[index] = trace.caller_lineno()
+        self.values[index] = trace.fromlist
+        return BINARY_IMPORT
+
+    def store_reload(self, index, trace):
+        self.store_time(index, trace)
+        self.names[index] = self.intern(trace.module)
+        self.filenames[index] = self.intern(trace.caller_filename())
+        self.linenos[index] = trace.caller_lineno()
+        return BINARY_RELOAD
+
+    def store_exit(self, index, trace):
+        self.store_time(index, trace)
+        if trace.duration is not None:
+            self.durations[index] = trace.duration
+            self.memory_deltas[index] = trace.memory_delta or 0
+        return BINARY_UNWIND if trace.unwinding else BINARY_EXIT
+
+    def store_finish(self, index, trace):
+        self.store_time(index, trace)
+        return BINARY_FINISH
+
+    def store_log(self, index, trace):
+        self.values[index] = trace.message
+        return BINARY_LOG
+
+    def store_exception(self, index, trace):
+        self.names[index] = self.intern(trace.exc_type)
+        self.values[index] = trace.message
+        self.filenames[index] = self.intern(trace.callee_filename())
+        self.linenos[index] = trace.callee_lineno()
+        return BINARY_EXCEPTION
+
+    def get_string(self, index):
+        if index<0:
+            return None
+        return self.string_values[index]
+
+    def load(self, index):
+        kind = self.kinds[index]
+        depth = self.depths[index]
+        name = self.get_string(self.names[index])
+        if kind==BINARY_CALL:
+            trace = CallTrace(None, depth)
+            trace.name = name
+            trace.params = self.values[index]
+        elif kind==BINARY_RETURN:
+            trace = ReturnTrace(None, depth)
+            trace.setvalue(self.values[index])
+        elif kind==BINARY_ASSIGNMENT:
+            trace = AssignmentTrace(None, depth)
+            trace.setvalue(name, self.values[index])
+        elif kind==BINARY_IMPORT:
+            trace = ImportTrace(None, depth)
+            trace.name = name
+            trace.fromlist = self.values[index]
+        elif kind==BINARY_RELOAD:
+            trace = ReloadTrace(None, depth)
+            trace.module = name
+        elif kind==BINARY_EXIT or kind==BINARY_UNWIND:
+            trace = ExitTrace(None, depth)
+            trace.unwinding = kind==BINARY_UNWIND
+            duration = self.durations[index]
+            if duration==duration:
+                trace.duration = duration
+                trace.memory_delta = self.memory_deltas[index]
+        elif kind==BINARY_EXCEPTION:
+            trace = ExceptionTrace(None, depth)
+            trace.setvalue(name, self.values[index])
+        elif kind==BINARY_FINISH:
+            trace = FinishTrace(None, depth)
+        else:
+            trace = LogTrace(None, depth)
+            trace.setvalue(self.values[index])
+        if isinstance(trace, CallTrace):
+            trace.time = self.times[index]
+            memory = self.memories[index]
+            trace.memory = None if memory<0 else memory
+        if isinstance(trace, (CallTrace, AssignmentTrace)):
+            trace.filename = self.get_string(self.filenames[index])
+            trace.lineno = self.linenos[index]
+        trace.number = self.numbers[index]
+        thread_id = self.thread_ids[index]
+        trace.thread_id = None if thread_id<0 else thread_id
+        return trace
+
+    def get_traces(self):
+        # the oldest record first, without the slot a signal handler may
+        # interrupt while it is being written
+        start = max(self.count - self.size, 0)
+        indexes = [i % self.size for i in xrange(start, self.count)]
+        return [self.load(index) for index in indexes if self.kinds[index]]
+
+    def get_result(self, trace_format=None):
+        if trace_format is None:
+            trace_format = self.trace_format
+        result = format_header(self.start_gmtime or time.gmtime(), trace_format)
+        result += u"\n".join([o.render(trace_format) for o in self.get_traces()])
+        result += u"\n" + format_footer(time.gmtime())
+        return result
+
+    def dump(self, fileobj=None, trace_format=None):
+        fileobj = fileobj or self.fileobj or sys.stderr
+        fileobj.write(self.get_result(trace_format))
+        fileobj.flush()
+
+
+class BinaryTraceReader(object):
+    def __init__(self, fileobj, chunk_size=65536):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.data = ''
+        self.pos = 0
+        self.strings = [None]
+        self.depth = 0
+        self.time = 0
+        self.memory = 0
+        self.call_count = 0
+        self.call_stack = []
+        self.start_gmtime = None
+        self.end_gmtime = None
+        self.trace_format = 0
+        self.decoders = {
+            BINARY_CALL: self.decode_call,
+            BINARY_RETURN: self.decode_return,
+            BINARY_ASSIGNMENT: self.decode_assignment,
+            BINARY_IMPORT: self.decode_import,
+            BINARY_RELOAD: self.decode_reload,
+            BINARY_EXIT: self.decode_exit,
+            BINARY_FINISH: self.decode_finish,
+            BINARY_LOG: self.decode_log,
+            BINARY_EXCEPTION: self.decode_exception,
+            BINARY_UNWIND: self.decode_unwind,
+            BINARY_PROCESS: self.decode_process,
+        }
+
+        if self.read_bytes(len(BINARY_MAGIC))!=BINARY_MAGIC:
+            raise PyXdebugError('not a PyXdebug binary trace')
+        self.start_gmtime = time.gmtime(self.decode_varint())
+
+    def __iter__(self):
+        while True:
+            tag = self.read_byte()
+            if tag==BINARY_STRING:
+                self.strings.append(self.decode_bytes())
+            elif tag==BINARY_END:
+                self.end_gmtime = time.gmtime(self.decode_varint())
+                return
+            else:
+                decoder = self.decoders.get(tag)
+                if decoder is None:
+                    raise PyXdebugError('unknown binary trace record %d' % tag)
+                yield decoder()
+
+    def get_header(self):
+        return format_header(self.start_gmtime, self.trace_format)
+
+    def get_footer(self):
+        return format_footer(self.end_gmtime)
+
+    def get_result(self):
+        result = [o.render(self.trace_format) for o in self]
+        return self.get_header() + u"\n".join(result) + u"\n" + self.get_footer()
+
+    def convert(self, fileobj, buffer_size=1000):
+        writer = TraceWriter(fileobj, buffer_size)
+        writer.start(self)
+        for trace in self:
+            writer.write(trace)
+        writer.finish(self)
+
+    def read_bytes(self, size):
+        while len(self.data) - self.pos<size:
+            chunk = self.fileobj.read(self.chunk_size)
+            if not chunk:
+                raise PyXdebugError('binary trace is truncated')
+            self.data = self.data[self.pos:] + chunk
+            self.pos = 0
+        value = self.data[self.pos:self.pos+size]
+        self.pos += size
+        return value
+
+    def read_byte(self):
+        if self.pos>=len(self.data):
+            self.read_bytes(1)
+            self.pos -= 1
+        value = ord(self.data[self.pos])
+        self.pos += 1
+        return value
+
+    def decode_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7f) << shift
+            if byte<0x80:
+                return value
+            shift += 7
+
+    def decode_signed(self):
+        value = self.decode_varint()
+        return value>>1 if not value & 1 else -((value+1)>>1)
+
+    def decode_bytes(self):
+        return self.read_bytes(self.decode_varint())
+
+    def decode_string(self):
+        return self.strings[self.decode_varint()]
+
+    def decode_depth(self):
+        self.depth += self.decode_signed()
+        return self.depth
+
+    def decode_number(self, trace, call=False):
+        # function numbers are not stored, they follow from the call depth
+        if call:
+            self.call_count += 1
+            del self.call_stack[trace.call_depth:]
+            self.call_stack.append(trace)
+            trace.number = self.call_count
+        elif 0<=trace.call_depth<len(self.call_stack):
+            trace.number = self.call_stack[trace.call_depth].number
+
+    def decode_time(self, trace):
+        self.time += self.decode_signed()
+        self.memory += self.decode_signed()
+        trace.time = self.time / 1000000.0
+        trace.memory = self.memory
+
+    def decode_call(self):
+        trace = CallTrace(None, self.decode_depth())
+        self.decode_number(trace, True)
+        self.decode_time(trace)
+        trace.name = self.decode_string()
+        trace.filename = self.decode_string()
+        trace.lineno = self.decode_varint()
+        trace.params = [(self.decode_string(), ValueRepr(self.decode_bytes())) for i in xrange(self.decode_varint())]
+        return trace
+
+    def decode_return(self):
+        trace = ReturnTrace(None, self.decode_depth())
+        trace.setvalue(ValueRepr(self.decode_bytes()))
+        self.decode_number(trace)
+        return trace
+
+    def decode_assignment(self):
+        trace = AssignmentTrace(None, self.decode_depth())
+        trace.setvalue(self.decode_string(), ValueRepr(self.decode_bytes()))
+        trace.filename = self.decode_string()
+        trace.lineno = self.decode_varint()
+        if 0<trace.call_depth<=len(self.call_stack):
+            trace.number = self.call_stack[trace.call_depth-1].number
+        return trace
+
+    def decode_import(self):
+        trace = ImportTrace(None, self.decode_depth())
+        self.decode_number(trace, True)
+        self.decode_time(trace)
+        trace.name = self.decode_string()
+        trace.fromlist = [self.decode_string() for i in xrange(self.decode_varint())] or None
+        trace.filename = self.decode_string()
+        trace.lineno = self.decode_varint()
+        return trace
+
+    def decode_reload(self):
+        trace = ReloadTrace(None, self.decode_depth())
+        self.decode_number(trace, True)
+        self.decode_time(trace)
+        trace.module = self.decode_string()
+        trace.filename = self.decode_string()
+        trace.lineno = self.decode_varint()
+        return trace
+
+    def decode_exit(self):
+        trace = ExitTrace(None, self.decode_depth())
+        self.decode_number(trace)
+        self.decode_time(trace)
+        if 0<=trace.call_depth<len(self.call_stack):
+            trace.set_duration(self.call_stack[trace.call_depth])
+        return trace
+
+    def decode_finish(self):
+        trace = FinishTrace(None, 0)
+        self.decode_time(trace)
+        return trace
+
+    def decode_log(self):
+        trace = LogTrace(None, self.decode_depth())
+        trace.setvalue(self.decode_bytes())
+        return trace
+
+    def decode_exception(self):
+        trace = ExceptionTrace(None, self.decode_depth())
+        trace.setvalue(self.decode_string(), self.decode_bytes().decode('utf-8'))
+        trace.filename = self.decode_string()
+        trace.lineno = self.decode_varint()
+        if 0<trace.call_depth<=len(self.call_stack):
+            trace.number = self.call_stack[trace.call_depth-1].number
+        return trace
+
+    def decode_unwind(self):
+        trace = self.decode_exit()
+        trace.unwinding = True
+        return trace
+
+    def decode_process(self):
+        trace = ProcessTrace(None, self.decode_depth())
+        trace.setvalue(self.decode_varint(), self.decode_varint())
+        return trace
+
+
+class TraceMerger(object):
+    def __init__(self, readers):
+        # binary trace readers of a process and of its forked children
+        if not readers:
+            raise PyXdebugError('no traces to merge')
+        self.readers = readers
+        self.start_gmtime = min([o.start_gmtime for o in readers])
+        self.end_gmtime = None
+        self.trace_format = 0
+        self.call_func_name = None
+
+    def __iter__(self):
+        # the traces share the start time of the first parent, a process
+        # marker is written when the merged records switch process and the
+        # last finish record ends the merged trace
+        streams = [self.read_stream(index, reader) for index, reader in enumerate(self.readers)]
+        tags = {}
+        current = None
+        finish = None
+        for time_, index, seq, trace in heapq.merge(*streams):
+            if isinstance(trace, FinishTrace):
+                if finish is None or (trace.time or 0.0)>=(finish.time or 0.0):
+                    finish = trace
+                continue
+            if isinstance(trace, ProcessTrace):
+                tags[index] = trace
+            elif index!=current and index in tags:
+                marker = ProcessTrace(None, trace.call_depth)
+                marker.setvalue(tags[index].pid, tags[index].ppid)
+                marker.thread_id = index
+                yield marker
+            current = index
+            yield trace
+        self.end_gmtime = max([o.end_gmtime for o in self.readers])
+        if finish is not None:
+            yield finish
+
+    def read_stream(self, index, reader):
+        # untimed records keep the time of the record before them, the
+        # leading ones like the process tag take the time of the first
+        # timed record, the records of each process are kept apart as the
+        # threads are
+        time_ = None
+        pending = []
+        for seq, trace in enumerate(reader):
+            trace.thread_id = index
+            if getattr(trace, 'time', None) is not None:
+                time_ = trace.time
+                for item in pending:
+                    yield (time_,) + item
+                del pending[:]
+            if time_ is None:
+                pending.append((index, seq, trace))
+            else:
+                yield time_, index, seq, trace
+        for item in pending:
+            yield (0.0,) + item
+
+    def get_header(self):
+        return format_header(self.start_gmtime, self.trace_format)
+
+    def get_footer(self):
+        return format_footer(self.end_gmtime)
+
+    def get_result(self):
+        result = [o.render(self.trace_format) for o in self]
+        return self.get_header() + u"\n".join(result) + u"\n" + self.get_footer()
+
+    def merge(self, writer):
+        writer.start(self)
+        for trace in self:
+            writer.write(trace)
+        writer.finish(self)
+
+
+class ThreadSplitWriter(object):
+    split_threads = True
+
+    def __init__(self, factory, collect_exits=False):
+        # factory(thread_id) returns the writer of a thread
+        self.factory = factory
+        self.collect_exits = collect_exits
+        self.writers = {}
+        self.xd = None
+
+    def start(self, xd):
+        self.xd = xd
+
+    def write(self, trace):
+        writer = self.writers.get(trace.thread_id)
+        if writer is None:
+            writer = self.writers[trace.thread_id] = self.factory(trace.thread_id)
+            writer.start(self.xd)
+        writer.write(trace)
+
+    def finish(self, xd):
+        for writer in self.writers.itervalues():
+            writer.finish(xd)
+
+
+class CallgrindWriter(object):
+    collect_exits = True
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.functions = {}
+        self.stacks = {}
+        self.main = self.get_function(('{main}', '{main}', 0))
+        self.main_entry = [self.main, 0, 0, 0, 0, 0]
+        self.total_time = 0
+        self.total_memory = 0
+        self.start_memory = None
+
+    def start(self, xd):
+        pass
+
+    def write(self, trace):
+        if not isinstance(trace, CallTrace):
+            return
+        # memory is reported relative to the first record
+        if self.start_memory is None:
+            self.start_memory = trace.memory or 0
+        if isinstance(trace, ExitTrace):
+            self.exit_call(self.stacks.get(trace.thread_id), trace.time, trace.memory)
+        elif isinstance(trace, FinishTrace):
+            self.total_time = self.get_time(trace.time)
+            self.total_memory = (trace.memory or 0) - self.start_memory
+        elif isinstance(trace, CallTrace):
+            self.enter_call(trace)
+
+    def finish(self, xd):
+        # calls that never returned are closed at the end of the trace
+        for stack in self.stacks.itervalues():
+            while stack:
+                self.exit_call(stack, self.total_time / 1000000.0, self.total_memory + self.start_memory)
+        self.main.self_time += self.total_time - self.main_entry[4]
+        self.main.self_memory += self.total_memory - self.main_entry[5]
+        self.fileobj.write(self.get_result(xd))
+        self.fileobj.flush()
+
+    def get_time(self, value):
+        return int(round((value or 0.0) * 1000000))
+
+    def get_function(self, key):
+        function = self.functions.get(key)
+        if function is None:
+            function = self.functions[key] = CallgrindFunction(*key)
+        return function
+
+    def enter_call(self, trace):
+        if isinstance(trace, ImportTrace):
+            key = ('{import}', trace.get_import_str(), 0)
+        elif isinstance(trace, ReloadTrace):
+            key = ('{import}', u'reload(%s)' % trace.module, 0)
+        else:
+            key = (trace.callee_filename(), trace.callee_name(), trace.callee_firstlineno())
+        stack = self.stacks.get(trace.thread_id)
+        if stack is None:
+            stack = self.stacks[trace.thread_id] = []
+        # function, start time, start memory, call line, child time, child memory
+        stack.append([self.get_function(key), self.get_time(trace.time), trace.memory or 0, trace.caller_lineno(), 0, 0])
+
+    def exit_call(self, stack, time_, memory):
+        # exits of calls made before the trace started, as in a forked child
+        if not stack:
+            return
+        function, start_time, start_memory, lineno, child_time, child_memory = stack.pop()
+        parent = stack[-1] if stack else self.main_entry
+        inclusive_time = self.get_time(time_) - start_time
+        inclusive_memory = (memory or 0) - start_memory
+        function.self_time += inclusive_time - child_time
+        function.self_memory += inclusive_memory - child_memory
+        parent[4] += inclusive_time
+        parent[5] += inclusive_memory
+        parent[0].add_call(function, lineno, inclusive_time, inclusive_memory)
+
+    def get_result(self, xd):
+        names = {'fl': {}, 'fn': {}}
+        def compress(kind, name):
+            # name compression, the full name is only written once
+            ids = names[kind]
+            if name in ids:
+                return u'(%d)' % ids[name]
+            ids[name] = len(ids) + 1
+            return u'(%d) %s' % (ids[name], name)
+
+        lines = [
+            u'version: 1',
+            u'creator: pyxdebug-%s' % __version__,
+            u'cmd: %s' % (xd.call_func_name or u' '.join(sys.argv)),
+            u'part: 1',
+            u'positions: line',
+            u'',
+            u'events: Time_(us) Memory',
+            u'',
+        ]
+        for function in sorted(self.functions.itervalues(), key=lambda o: (o.filename, o.lineno, o.name)):
+            lines.append(u'fl=%s' % compress('fl', function.filename))
+            lines.append(u'fn=%s' % compress('fn', function.name))
+            lines.append(u'%d %d %d' % (function.lineno, function.self_time, function.self_memory))
+            for (callee, lineno), (count, inclusive_time, inclusive_memory) in sorted(function.children.iteritems(), key=lambda o: (o[0][0].filename, o[0][0].name, o[0][1])):
+                lines.append(u'cfl=%s' % compress('fl', callee.filename))
+                lines.append(u'cfn=%s' % compress('fn', callee.name))
+                lines.append(u'calls=%d %d' % (count, callee.lineno))
+                lines.append(u'%d %d %d' % (lineno, inclusive_time, inclusive_memory))
+            lines.append(u'')
+        lines.append(u'totals: %d %d' % (self.total_time, self.total_memory))
+        return u'\n'.join(lines) + u'\n'
+
+
+class CallgrindFunction(object):
+    def __init__(self, filename, name, lineno):
+        self.filename = filename
+        self.name = name
+        self.lineno = lineno
+        self.self_time = 0
+        self.self_memory = 0
+        self.children = {}
+
+    def add_call(self, callee, lineno, inclusive_time, inclusive_memory):
+        key = (callee, lineno)
+        cost = self.children.get(key)
+        if cost is None:
+            cost = self.children[key] = [0, 0, 0]
+        cost[0] += 1
+        cost[1] += inclusive_time
+        cost[2] += inclusive_memory
+
+
+class SummaryWriter(object):
+    collect_exits = True
+    sort_keys = ('calls', 'total', 'self', 'memory', 'depth')
+
+    def __init__(self, fileobj=None, top=20, sort='total'):
+        if sort not in self.sort_keys:
+            raise PyXdebugError('unknown sort key %s' % sort)
+        self.fileobj = fileobj
+        self.top = top
+        self.sort = sort
+        self.functions = {}
+        self.edges = {}
+        self.stacks = {}
+        self.main = self.get_function(('{main}', '{main}', 0))
+        # the thread of the first call, or the process of a merged trace
+        self.main_thread = None
+        self.total_time = 0.0
+        self.start_memory = None
+        self.end_memory = None
+
+    def start(self, xd):
+        pass
+
+    def write(self, trace):
+        if not isinstance(trace, CallTrace):
+            return
+        # the memory delta of the run is relative to the first record
+        if self.start_memory is None:
+            self.start_memory = trace.memory
+        if self.main_thread is None:
+            self.main_thread = trace.thread_id
+        if isinstance(trace, ExitTrace):
+            self.exit_call(self.stacks.get(trace.thread_id), trace.time, trace.memory)
+        elif isinstance(trace, FinishTrace):
+            self.total_time = trace.time or 0.0
+            self.end_memory = trace.memory
+        elif isinstance(trace, CallTrace):
+            self.enter_call(trace)
+
+    def finish(self, xd):
+        # calls that never returned are closed at the end of the trace
+        for stack in self.stacks.itervalues():
+            while stack:
+                self.exit_call(stack, self.total_time, self.end_memory)
+        self.main.calls = 1
+        self.main.total_time = self.total_time
+        self.main.self_time += self.total_time
+        if self.start_memory is not None and self.end_memory is not None:
+            self.main.memory_delta = self.end_memory - self.start_memory
+        if self.fileobj is not None:
+            self.fileobj.write(self.get_result())
+            self.fileobj.flush()
+
+    def get_function(self, key):
+        function = self.functions.get(key)
+        if function is None:
+            function = self.functions[key] = SummaryFunction(*key)
+        return function
+
+    def enter_call(self, trace):
+        if isinstance(trace, ImportTrace):
+            key = ('{import}', trace.get_import_str(), 0)
+        elif isinstance(trace, ReloadTrace):
+            key = ('{import}', u'reload(%s)' % trace.module, 0)
+        else:
+            key = (trace.callee_filename(), trace.callee_name(), trace.callee_firstlineno())
+        function = self.get_function(key)
+        function.calls += 1
+        if trace.call_depth>function.max_depth:
+            function.max_depth = trace.call_depth
+        stack = self.stacks.get(trace.thread_id)
+        if stack is None:
+            stack = self.stacks[trace.thread_id] = SummaryStack()
+        stack.active[function] = stack.active.get(function, 0) + 1
+        # function, start time, start memory, child time
+        stack.append([function, trace.time or 0.0, trace.memory, 0.0])
+
+    def exit_call(self, stack, time_, memory):
+        if not stack:
+            return
+        # subclasses may keep more per call after these
+        function, start_time, start_memory, child_time = stack.pop()[:4]
+        parent = stack[-1][0] if stack else self.main
+        inclusive_time = (time_ or 0.0) - start_time
+        active = stack.active.pop(function) - 1
+        if active:
+            stack.active[function] = active
+        function.self_time += inclusive_time - child_time
+        if stack:
+            stack[-1][3] += inclusive_time
+        elif stack is self.stacks.get(self.main_thread):
+            # the other threads and processes run alongside the main one,
+            # their time is not part of the run time of {main}
+            self.main.self_time -= inclusive_time
+        # recursive calls are already part of the outermost call of the
+        # same stack, the calls of other threads and processes are not
+        if not active:
+            function.total_time += inclusive_time
+            if memory is not None and start_memory is not None:
+                function.memory_delta += memory - start_memory
+        edge = self.edges.get((parent, function))
+        if edge is None:
+            edge = self.edges[(parent, function)] = [0, 0.0]
+        edge[0] += 1
+        edge[1] += inclusive_time
+
+    def get_functions(self, top=None, sort=None):
+        sort = sort or self.sort
+        attr = {'calls': 'calls', 'total': 'total_time', 'self': 'self_time', 'memory': 'memory_delta', 'depth': 'max_depth'}[sort]
+        functions = [o for o in self.functions.itervalues() if o.calls]
+        functions.sort(key=lambda o: (-getattr(o, attr), o.name))
+        return functions[:top or self.top]
+
+    def get_edges(self, top=None):
+        edges = sorted(self.edges.iteritems(), key=lambda o: (-o[1][1], o[0][1].name))
+        return edges[:top or self.top]
+
+    def get_result(self, top=None, sort=None):
+        lines = [
+            u'SUMMARY sorted by %s' % (sort or self.sort),
+            u'%10s %12s %12s %6s %12s  %s' % (u'calls', u'total', u'self', u'depth', u'memory', u'function'),
+        ]
+        for function in self.get_functions(top, sort):
+            lines.append(u'%10d %12.6f %12.6f %6d %12d  %s' % (function.calls, function.total_time, function.self_time, function.max_depth, function.memory_delta, function.get_label()))
+        lines.append(u'')
+        lines.append(u'CALLS sorted by total')
+        lines.append(u'%10s %12s  %s' % (u'calls', u'total', u'caller -> callee'))
+        for (caller, callee), (count, inclusive_time) in self.get_edges(top):
+            lines.append(u'%10d %12.6f  %s -> %s' % (count, inclusive_time, caller.name, callee.name))
+        return u'\n'.join(lines) + u'\n'
+
+
+class SummaryStack(list):
+    # the open calls of a thread or of a merged process, with the number
+    # of open calls of each function
+    __slots__ = ('active',)
+
+    def __init__(self):
+        super(SummaryStack, self).__init__()
+        self.active = {}
+
+
+class SummaryFunction(object):
+    __slots__ = ('filename', 'name', 'lineno', 'calls', 'total_time', 'self_time', 'max_depth', 'memory_delta')
+
+    def __init__(self, filename, name, lineno):
+        self.filename = filename
+        self.name = name
+        self.lineno = lineno
+        self.calls = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        self.max_depth = 0
+        self.memory_delta = 0
+
+    def get_label(self):
+        if self.lineno:
+            return u'%s %s:%d' % (self.name, self.filename, self.lineno)
+        return self.name
+
+
+class ImportProfileWriter(object):
+    collect_exits = True
+    # the calls are not traced, so that they do not slow down the imports
+    trace_calls = False
+    sort_keys = ('cumulative', 'self', 'loaded')
+
+    def __init__(self, fileobj=None, top=20, sort='cumulative', show_cached=True, min_time=0.0):
+        if sort not in self.sort_keys:
+            raise PyXdebugError('unknown sort key %s' % sort)
+        self.fileobj = fileobj
+        self.top = top
+        self.sort = sort
+        self.show_cached = show_cached
+        self.min_time = min_time
+        self.root = ImportProfile(None, None, 0)
+        self.stacks = {}
+
+    def start(self, xd):
+        pass
+
+    def write(self, trace):
+        if isinstance(trace, ExitTrace):
+            stack = self.stacks.get(trace.thread_id)
+            if stack:
+                self.exit_import(stack, trace.time)
+        elif isinstance(trace, FinishTrace):
+            pass
+        elif isinstance(trace, CallTrace):
+            stack = self.stacks.get(trace.thread_id)
+            if stack is None:
+                stack = self.stacks[trace.thread_id] = []
+            # the calls are kept as None, so that the exits stay paired
+            if isinstance(trace, (ImportTrace, ReloadTrace)):
+                stack.append(ImportProfile(trace, trace.caller_filename(), trace.caller_lineno()))
+            else:
+                stack.append(None)
+
+    def finish(self, xd):
+        # imports that never returned are left out
+        if self.fileobj is not None:
+            self.fileobj.write(self.get_result())
+            self.fileobj.flush()
+
+    def exit_import(self, stack, time_):
+        profile = stack.pop()
+        if profile is None:
+            return
+        trace = profile.trace
+        profile.cumulative_time = (time_ or 0.0) - (trace.time or 0.0)
+        profile.self_time += profile.cumulative_time
+        profile.loaded = trace.loaded
+        # a reload always runs the module again
+        if isinstance(trace, ReloadTrace):
+            profile.loaded = max(trace.loaded or 0, 1)
+        profile.trace = None
+        # nested imports are not part of the self time of their parent
+        parent = self.root
+        for entry in reversed(stack):
+            if entry is not None:
+                parent = entry
+                entry.self_time -= profile.cumulative_time
+                break
+        parent.children.append(profile)
+
+    def get_children(self, profile, sort=None):
+        attr = {'cumulative': 'cumulative_time', 'self': 'self_time', 'loaded': 'loaded'}[sort or self.sort]
+        children = [o for o in profile.children if o.cumulative_time>=self.min_time and (self.show_cached or o.loaded)]
+        children.sort(key=lambda o: (-(getattr(o, attr) or 0), o.name))
+        return children
+
+    def get_modules(self):
+        # totals by import, a module imported again is a cache hit
+        modules = {}
+        pending = list(self.root.children)
+        while pending:
+            profile = pending.pop()
+            pending.extend(profile.children)
+            total = modules.get(profile.name)
+            if total is None:
+                total = modules[profile.name] = [0, 0, 0.0]
+            total[0] += 1
+            if not profile.loaded:
+                total[1] += 1
+            total[2] += profile.self_time
+        return sorted(modules.iteritems(), key=lambda o: (-o[1][2], o[0]))
+
+    def get_result(self, sort=None, top=None):
+        lines = [
+            u'IMPORTS sorted by %s' % (sort or self.sort),
+            u'%12s %12s %8s  %s' % (u'cumulative', u'self', u'loaded', u'import'),
+        ]
+        pending = [(o, 0) for o in reversed(self.get_children(self.root, sort))]
+        while pending:
+            profile, depth = pending.pop()
+            loaded = u'cached' if not profile.loaded else u'%d' % profile.loaded
+            lines.append(u'%12.6f %12.6f %8s  %s%s %s:%d' % (profile.cumulative_time, profile.self_time, loaded, u'  '*depth, profile.name, profile.filename, profile.lineno))
+            pending.extend([(o, depth+1) for o in reversed(self.get_children(profile, sort))])
+        lines.append(u'')
+        lines.append(u'MODULES sorted by self')
+        lines.append(u'%10s %10s %12s  %s' % (u'imports', u'cached', u'self', u'import'))
+        for name, (count, cached, self_time) in self.get_modules()[:top or self.top]:
+            lines.append(u'%10d %10d %12.6f  %s' % (count, cached, self_time, name))
+        return u'\n'.join(lines) + u'\n'
+
+
+class ImportProfile(object):
+    __slots__ = ('trace', 'name', 'filename', 'lineno', 'cumulative_time', 'self_time', 'loaded', 'children')
+
+    def __init__(self, trace, filename, lineno):
+        # the record is only kept until the import returns
+        self.trace = trace
+        if isinstance(trace, ReloadTrace):
+            self.name = u'reload(%s)' % trace.module
+        elif trace is not None:
+            self.name = trace.get_import_str()
+        else:
+            self.name = u'{main}'
+        self.filename = filename
+        self.lineno = lineno
+        self.cumulative_time = 0.0
+        self.self_time = 0.0
+        self.loaded = None
+        self.children = []
+
+
+class CallPathWriter(SummaryWriter):
+    def __init__(self, fileobj=None, top=20, sort='total'):
+        super(CallPathWriter, self).__init__(fileobj, top, sort)
+        # tree of the call paths, a node per function name under its caller
+        self.root = CallPath(None, u'{main}')
+
+    def enter_call(self, trace):
+        super(CallPathWriter, self).enter_call(trace)
+        stack = self.stacks[trace.thread_id]
+        parent = stack[-2][4] if len(stack)>1 else self.root
+        stack[-1].append(parent.get_child(stack[-1][0].name))
+
+    def exit_call(self, stack, time_, memory):
+        if stack:
+            function, start_time, start_memory, child_time, path = stack[-1]
+            path.calls += 1
+            path.total_time += (time_ or 0.0) - start_time
+            if memory is not None and start_memory is not None:
+                path.memory_delta += memory - start_memory
+        super(CallPathWriter, self).exit_call(stack, time_, memory)
+
+
+class CallPath(object):
+    __slots__ = ('parent', 'name', 'children', 'calls', 'total_time', 'memory_delta')
+
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.name = name
+        self.children = {}
+        self.calls = 0
+        self.total_time = 0.0
+        self.memory_delta = 0
+
+    def get_child(self, name):
+        child = self.children.get(name)
+        if child is None:
+            child = self.children[name] = CallPath(self, name)
+        return child
+
+    def get_label(self):
+        names = []
+        path = self
+        while path.parent is not None:
+            names.append(path.name)
+            path = path.parent
+        names.reverse()
+        return u';'.join(names)
+
+
+class TraceDiff(object):
+    def __init__(self, old, new, threshold=0.1, min_time=0.0001, min_memory=0, top=20):
+        # old and new are the CallPathWriter of the two traces, a time or
+        # memory change is reported when it is above min_time or min_memory
+        # and above threshold times the old value, memory changes alone are
+        # not reported with a min_memory of 0
+        self.old = old
+        self.new = new
+        self.threshold = threshold
+        self.min_time = min_time
+        self.min_memory = min_memory
+        self.top = top
+
+    def get_changes(self, old, new):
+        changes = []
+        if old.calls!=new.calls:
+            changes.append(u'calls')
+        delta = new.total_time - old.total_time
+        if abs(delta)>=self.min_time and abs(delta)>self.threshold * old.total_time:
+            changes.append(u'time')
+        delta = new.memory_delta - old.memory_delta
+        if self.min_memory and abs(delta)>=self.min_memory and abs(delta)>self.threshold * abs(old.memory_delta):
+            changes.append(u'memory')
+        return changes
+
+    def get_paths(self, top=None):
+        # both trees are walked together, a new or removed path is reported
+        # once for its whole subtree
+        rows = []
+        pending = [(self.old.root, self.new.root)]
+        while pending:
+            old_parent, new_parent = pending.pop()
+            for name in set(old_parent.children) | set(new_parent.children):
+                old = old_parent.children.get(name)
+                new = new_parent.children.get(name)
+                if old is None:
+                    rows.append((u'new', new.get_label(), None, new))
+                elif new is None:
+                    rows.append((u'removed', old.get_label(), old, None))
+                else:
+                    changes = self.get_changes(old, new)
+                    if changes:
+                        rows.append((u','.join(changes), old.get_label(), old, new))
+                    pending.append((old, new))
+        return self.sort_rows(rows, top)
+
+    def get_functions(self, top=None):
+        # functions are compared by name, the files of two releases differ
+        old = self.get_function_totals(self.old)
+        new = self.get_function_totals(self.new)
+        rows = []
+        for name in set(old) | set(new):
+            if name not in old:
+                rows.append((u'new', name, None, new[name]))
+            elif name not in new:
+                rows.append((u'removed', name, old[name], None))
+            else:
+                changes = self.get_changes(old[name], new[name])
+                if changes:
+                    rows.append((u','.join(changes), name, old[name], new[name]))
+        return self.sort_rows(rows, top)
+
+    def get_function_totals(self, writer):
+        totals = {}
+        for function in writer.functions.itervalues():
+            if not function.calls:
+                continue
+            total = totals.get(function.name)
+            if total is None:
+                total = totals[function.name] = SummaryFunction(None, function.name, 0)
+            total.calls += function.calls
+            total.total_time += function.total_time
+            total.self_time += function.self_time
+            total.memory_delta += function.memory_delta
+        return totals
+
+    def sort_rows(self, rows, top):
+        def time_delta(row):
+            return (row[3].total_time if row[3] else 0.0) - (row[2].total_time if row[2] else 0.0)
+        rows.sort(key=lambda o: (-abs(time_delta(o)), o[1]))
+        return rows[:top or self.top]
+
+    def get_result(self, top=None):
+        lines = [u'DIFF threshold %g%% min time %.6f min memory %d' % (self.threshold * 100, self.min_time, self.min_memory)]
+        for title, rows in ((u'CALL PATHS', self.get_paths(top)), (u'FUNCTIONS', self.get_functions(top))):
+            lines.append(u'%s sorted by time delta' % title)
+            lines.append(u'%-18s %10s %10s %12s %12s %12s %12s  %s' % (u'change', u'old calls', u'new calls', u'old time', u'new time', u'time delta', u'mem delta', u'name'))
+            for change, name, old, new in rows:
+                old_values = (old.calls, old.total_time, old.memory_delta) if old else (0, 0.0, 0)
+                new_values = (new.calls, new.total_time, new.memory_delta) if new else (0, 0.0, 0)
+                lines.append(u'%-18s %10d %10d %12.6f %12.6f %+12.6f %+12d  %s' % (change, old_values[0], new_values[0], old_values[1], new_values[1], new_values[1] - old_values[1], new_values[2] - old_values[2], name))
+            lines.append(u'')
+        return u'\n'.join(lines)
+
+
 class BaseTrace(object):
     def __init__(self, callee, call_depth):
         if callee:
@@ -248,6 +2638,13 @@ class BaseTrace(object):
             self.callee = None
             self.caller = None
         self.call_depth = call_depth
+        self.number = 0
+        self.thread_id = None
+
+    def render(self, trace_format=0):
+        if trace_format==1:
+            return self.get_computerized_result()
+        return self.get_result()
 
 
 class CallTrace(BaseTrace):
@@ -256,46 +2653,54 @@ class CallTrace(BaseTrace):
         self.time = None
         self.collect_params = None
         self.memory = None
-
-    def setvalue(self, start_time, collect_params=False):
-        self.time = time.time() - start_time
+        self.name = None
+        self.params = None
+        self.filename = None
+        self.lineno = None
+        self.duration = None
+        self.memory_delta = None
+
+    def setvalue(self, start_time, collect_params=False, memory=None):
+        self.time = clock() - start_time
         self.collect_params = collect_params
-        if resource is not None:
-            self.memory = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+        self.memory = memory
 
     def callee_name(self):
-        return get_method_name(self.callee)
+        if self.name is None:
+            self.name = get_method_name(self.callee)
+        return self.name
+
+    def callee_filename(self):
+        # records read back from a trace file have no frame
+        if self.callee is None:
+            return '{unknown}'
+        return self.callee.f_code.co_filename
+
+    def callee_firstlineno(self):
+        if self.callee is None:
+            return 0
+        return self.callee.f_code.co_firstlineno
 
     def caller_filename(self):
-        return self.caller.f_code.co_filename
+        if self.filename is None:
+            self.filename = self.caller.f_code.co_filename
+        return self.filename
 
     def caller_lineno(self):
-        return self.caller.f_lineno
+        if self.lineno is None:
+            self.lineno = self.caller.f_lineno
+        return self.lineno
 
     def get_params(self):
+        if self.params is not None:
+            return self.params
         params = []
         if self.collect_params:
-            arginfo = inspect.getargvalues(self.callee)
-            # args
-            for key in arginfo.args:
-                if isinstance(key, basestring):
-                    params.append((key, arginfo.locals.get(key)))
-                elif isinstance(key, list):
-                    keys = key
-                    for key in keys:
-                        params.append((key, arginfo.locals.get(key)))
-            # varargs
-            if arginfo.varargs:
-                for value in arginfo.locals[arginfo.varargs]:
-                    params.append((None, value))
-            # keywords
-            if arginfo.keywords:
-                kwds = arginfo.locals.get(arginfo.keywords)
-                for key, value in kwds.iteritems():
-                    params.append((key, value))
+            params = get_frame_params(self.callee)
+        self.params = params
         return params
 
-    def get_params_str(self):
+    def get_params_list(self):
         params_str = []
         params = self.get_params()
         for key, value in params:
@@ -304,13 +2709,21 @@ class CallTrace(BaseTrace):
                 prefix = u'%s=' % key
             param_str = u'%s%s' % (prefix, pformat(value))
             params_str.append(param_str)
-        return u', '.join(params_str)
+        return params_str
+
+    def get_params_str(self):
+        return u', '.join(self.get_params_list())
 
     def get_result(self):
         sp = u'  '*self.call_depth
         params = self.get_params_str()
         return u'%10.4f %10d   %s-> %s(%s) %s:%d' % (self.time or 0.0, self.memory or 0, sp, self.callee_name(), params, self.caller_filename(), self.caller_lineno())
 
+    def get_computerized_result(self):
+        params = self.get_params_list()
+        result = u'%d\t%d\t0\t%f\t%d\t%s\t1\t\t%s\t%d\t%d' % (self.call_depth+1, self.number, self.time or 0.0, self.memory or 0, self.callee_name(), self.caller_filename(), self.caller_lineno(), len(params))
+        return result + u''.join([u'\t' + flatten_value(param) for param in params])
+
 
 class ReturnTrace(BaseTrace):
     def setvalue(self, value):
@@ -320,32 +2733,71 @@ class ReturnTrace(BaseTrace):
         sp = u' '*24 + u'  '*self.call_depth
         return u'%s>=> %s' % (sp, pformat(self.value))
 
+    def get_computerized_result(self):
+        return u'%d\t%d\tR\t\t\t%s' % (self.call_depth+1, self.number, flatten_value(pformat(self.value)))
+
 
 class AssignmentTrace(BaseTrace):
     def __init__(self, callee, call_depth):
         super(AssignmentTrace, self).__init__(callee, call_depth)
         self.varname = None
         self.value = None
+        self.filename = None
+        self.lineno = None
 
     def setvalue(self, varname, value):
         self.varname = varname
         self.value = value
 
+    def callee_filename(self):
+        if self.filename is None:
+            self.filename = self.callee.f_code.co_filename
+        return self.filename
+
+    def callee_lineno(self):
+        if self.lineno is None:
+            self.lineno = self.callee.f_lineno
+        return self.lineno
+
     def get_result(self):
         sp = u' '*24 + u'  '*self.call_depth
-        filename =  self.callee.f_code.co_filename
-        lineno = self.callee.f_lineno
+        filename = self.callee_filename()
+        lineno = self.callee_lineno()
         return u'%s=> %s = %s %s:%d' % (sp, self.varname, pformat(self.value), filename, lineno)
 
+    def get_computerized_result(self):
+        value = flatten_value(pformat(self.value))
+        return u'%d\t%d\tA\t\t\t%s\t%d\t%s = %s' % (self.call_depth, self.number, self.callee_filename(), self.callee_lineno(), self.varname, value)
+
+
+class ExceptionTrace(AssignmentTrace):
+    def __init__(self, callee, call_depth):
+        super(ExceptionTrace, self).__init__(callee, call_depth)
+        self.exc_type = None
+        self.message = None
+
+    def setvalue(self, exc_type, message):
+        self.exc_type = exc_type
+        self.message = message
+
+    def get_result(self):
+        sp = u' '*24 + u'  '*self.call_depth
+        return u'%s!> %s: %s %s:%d' % (sp, self.exc_type, self.message, self.callee_filename(), self.callee_lineno())
+
+    def get_computerized_result(self):
+        return u'%d\t%d\tE\t\t\t%s\t%d\t%s: %s' % (self.call_depth, self.number, self.callee_filename(), self.callee_lineno(), self.exc_type, flatten_value(self.message))
+
 
 class ImportTrace(CallTrace):
     def __init__(self, callee, call_depth):
         super(ImportTrace, self).__init__(callee, call_depth)
         self.name = None
         self.fromlist = None
+        self.modules = None
+        self.loaded = None
 
-    def setvalue(self, name, fromlist, start_time):
-        super(ImportTrace, self).setvalue(start_time)
+    def setvalue(self, name, fromlist, start_time, memory=None):
+        super(ImportTrace, self).setvalue(start_time, memory=memory)
         self.name = name
         self.fromlist = fromlist
 
@@ -360,28 +2812,66 @@ class ImportTrace(CallTrace):
         imp = self.get_import_str()
         return u'%10.4f %10d   %s-> %s %s:%d' % (self.time or 0.0, self.memory or 0, sp, imp, self.caller_filename(), self.caller_lineno())
 
+    def get_computerized_result(self):
+        imp = self.get_import_str()
+        return u'%d\t%d\t0\t%f\t%d\t%s\t1\t%s\t%s\t%d\t0' % (self.call_depth+1, self.number, self.time or 0.0, self.memory or 0, imp, self.name, self.caller_filename(), self.caller_lineno())
+
 
 class ReloadTrace(CallTrace):
     def __init__(self, callee, call_depth):
         super(ReloadTrace, self).__init__(callee, call_depth)
         self.module = None
+        self.modules = None
+        self.loaded = None
 
-    def setvalue(self, module, start_time):
-        super(ReloadTrace, self).setvalue(start_time)
+    def setvalue(self, module, start_time, memory=None):
+        super(ReloadTrace, self).setvalue(start_time, memory=memory)
         self.module = getattr(module, '__name__', None)
 
     def get_result(self):
         sp = u'  '*self.call_depth
         return u'%10.4f %10d   %s-> reload(%s) %s:%d' % (self.time or 0.0, self.memory or 0, sp, self.module, self.caller_filename(), self.caller_lineno())
 
+    def get_computerized_result(self):
+        return u'%d\t%d\t0\t%f\t%d\treload(%s)\t1\t%s\t%s\t%d\t0' % (self.call_depth+1, self.number, self.time or 0.0, self.memory or 0, self.module, self.module, self.caller_filename(), self.caller_lineno())
+
+
+class ExitTrace(CallTrace):
+    def __init__(self, callee, call_depth):
+        super(ExitTrace, self).__init__(callee, call_depth)
+        self.unwinding = False
+
+    def setvalue(self, start_time, memory=None):
+        super(ExitTrace, self).setvalue(start_time, memory=memory)
+
+    def set_duration(self, call):
+        self.duration = (self.time or 0.0) - (call.time or 0.0)
+        if self.memory is not None and call.memory is not None:
+            self.memory_delta = self.memory - call.memory
+
+    def get_result(self):
+        sp = u'  '*self.call_depth
+        result = u'%10.4f %10d   %s<-' % (self.time or 0.0, self.memory or 0, sp)
+        if self.duration is not None:
+            result += u' %.6f %+d' % (self.duration, self.memory_delta or 0)
+        if self.unwinding:
+            result += u' (unwind)'
+        return result
+
+    def get_computerized_result(self):
+        return u'%d\t%d\t1\t%f\t%d' % (self.call_depth+1, self.number, self.time or 0.0, self.memory or 0)
+
 
 class FinishTrace(CallTrace):
-    def setvalue(self, start_time):
-        super(FinishTrace, self).setvalue(start_time)
+    def setvalue(self, start_time, memory=None):
+        super(FinishTrace, self).setvalue(start_time, memory=memory)
 
     def get_result(self):
         return u'%10.4f %10d' % (self.time or 0.0, self.memory or 0)
 
+    def get_computerized_result(self):
+        return u'\t\t\t%f\t%d' % (self.time or 0.0, self.memory or 0)
+
 
 class LogTrace(BaseTrace):
     def __init__(self, callee, call_depth):
@@ -395,54 +2885,511 @@ class LogTrace(BaseTrace):
         sp = u' '*24 + u'  '*self.call_depth
         return u'%s*> %s' % (sp, self.message)
 
+    def get_computerized_result(self):
+        return u'%d\t\tL\t\t\t%s' % (self.call_depth+1, flatten_value(self.message))
+
+
+class ThreadTrace(LogTrace):
+    def __init__(self, callee, call_depth):
+        super(ThreadTrace, self).__init__(callee, call_depth)
+        self.thread_name = None
+
+    def setvalue(self, thread_id, thread_name):
+        self.thread_id = thread_id
+        self.thread_name = thread_name
+        self.message = u'thread %s (%s)' % (thread_name, thread_id)
+
+
+class ProcessTrace(LogTrace):
+    def __init__(self, callee, call_depth):
+        super(ProcessTrace, self).__init__(callee, call_depth)
+        self.pid = None
+        self.ppid = None
+
+    def setvalue(self, pid, ppid):
+        self.pid = pid
+        self.ppid = ppid
+        self.message = u'process %d (parent %d)' % (pid, ppid)
+
+
+class ValueRepr(object):
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
 
 class PyXdebugError(Exception):
     pass
 
 
-def get_method_class(frame):
-    arginfo = inspect.getargvalues(frame)
+def get_receiver(frame):
+    code = frame.f_code
+    f_locals = frame.f_locals
+    varnames = code.co_varnames
+    index = code.co_argcount
 
-    obj = None
-    if arginfo.args and len(arginfo.args):
-        key = arginfo.args[0]
-        if isinstance(key, (list, tuple)):
+    if index:
+        # tuple parameters are stored in hidden variables like .0
+        if varnames[0].startswith('.'):
             return None
-        obj = arginfo.locals.get(key)
-    elif arginfo.varargs and len(arginfo.locals[arginfo.varargs]):
-        obj = arginfo.locals[arginfo.varargs][0]
-    elif arginfo.keywords:
-        kwds = arginfo.locals.get(arginfo.keywords)
+        return f_locals.get(varnames[0])
+    if code.co_flags & CO_VARARGS:
+        args = f_locals.get(varnames[index])
+        index += 1
+        if args:
+            return args[0]
+    if code.co_flags & CO_VARKEYWORDS:
+        kwds = f_locals.get(varnames[index]) or {}
         if 'self' in kwds:
-            obj = kwds['self']
-        elif 'cls' in arginfo.keywords:
-            obj = kwds['cls']
+            return kwds['self']
+        return kwds.get('cls')
+    return None
+
+
+def resolve_method(code, cls):
+    method_class = cls
+    if not inspect.isclass(method_class) or str(method_class).startswith("<type '"):
+        method_class = None
+    method = getattr(method_class, code.co_name, None)
+    if not inspect.ismethod(method) and not inspect.isfunction(method):
+        method_class = None
+
+    if method_class is None:
+        return None, code.co_name
+    classname = '%s.%s' % (getattr(method_class, '__module__', None), method_class.__name__)
+    return method_class, classname + '.' + code.co_name
+
+
+def get_method(frame):
+    code = frame.f_code
+    obj = get_receiver(frame)
+    if obj is None:
+        return None, code.co_name
+    cls = obj if inspect.isclass(obj) else obj.__class__
+
+    key = (code, cls)
+    try:
+        return method_cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable class
+        return resolve_method(code, cls)
+
+    if len(method_cache)>=METHOD_CACHE_SIZE:
+        method_cache.clear()
+    result = method_cache[key] = resolve_method(code, cls)
+    return result
 
-    if obj is not None:
-        if not inspect.isclass(obj):
-            obj = obj.__class__
-        if not inspect.isclass(obj) or str(obj).startswith("<type '"):
-            obj = None
-        method = getattr(obj, frame.f_code.co_name, None)
-        if not inspect.ismethod(method) and not inspect.isfunction(method):
-            obj = None
-    return obj
+
+def get_method_class(frame):
+    return get_method(frame)[0]
 
 
 def get_method_name(frame):
-    method_class = get_method_class(frame)
-    classname = ''
-    if method_class is not None:
-        classname = str(method_class)
+    return get_method(frame)[1]
+
+
+def capture_value(value, max_children=128, max_data=512, max_depth=3):
+    """Snapshot a value so that the trace neither keeps it alive nor renders it unbounded."""
+    value_type = type(value)
+    if value_type in SCALAR_TYPES:
+        return value
+    if value_type in STRING_TYPES and (max_data<0 or len(value)<=max_data):
+        return value
+    return ValueRepr(bounded_repr(value, max_children, max_data, max_depth, 0))
+
+
+def bounded_repr(value, max_children, max_data, max_depth, depth, parents=None):
+    value_type = type(value)
+    if value_type in SCALAR_TYPES:
+        return repr(value)
+    if value_type in STRING_TYPES:
+        if max_data<0 or len(value)<=max_data:
+            return repr(value)
+        return repr(value[:max_data]) + '...'
+
+    # only the builtin containers and their subclasses are walked, anything
+    # else keeps its own repr
+    fields = None
+    if isinstance(value, dict):
+        start, end = '{', '}'
+    elif isinstance(value, list):
+        start, end = '[', ']'
+    elif isinstance(value, tuple):
+        start, end = '(', ')'
+        fields = getattr(value, '_fields', None)
+    elif isinstance(value, (set, frozenset)):
+        start, end = '%s([' % value_type.__name__, '])'
+    else:
+        # objects that are not fully constructed yet may fail in __repr__
         try:
-            classname = re.compile(r"<class '([^']+)'>").match(classname).group(1)
-        except:
+            result = repr(value)
+        except Exception:
+            result = '<%s object at 0x%x>' % (value_type.__name__, id(value))
+        if max_data>=0 and len(result)>max_data:
+            result = result[:max_data] + '...'
+        return result
+    # subclasses keep their name, named tuples their field names
+    if fields is not None:
+        start, end = '%s(' % value_type.__name__, ')'
+    elif value_type not in (dict, list, tuple, set, frozenset):
+        start, end = '%s(%s' % (value_type.__name__, start), end + ')'
+
+    if max_depth>=0 and depth>=max_depth:
+        return start + '...' + end
+    if parents is None:
+        parents = []
+    if id(value) in parents:
+        return '<Recursion on %s with id=%s>' % (value_type.__name__, id(value))
+    parents.append(id(value))
+
+    if isinstance(value, dict):
+        # the keys in sorted order, up to the shown ones, ordered
+        # dictionaries keep their own order
+        items = value.iteritems()
+        if not isinstance(value, collections.OrderedDict):
+            try:
+                if max_children<0:
+                    items = sorted(items)
+                else:
+                    items = heapq.nsmallest(max_children+1, items)
+            except Exception:
+                items = value.iteritems()
+    else:
+        items = iter(value)
+    children = []
+    for index, item in enumerate(items):
+        if max_children>=0 and len(children)>=max_children:
+            children.append('...')
+            break
+        if isinstance(value, dict):
+            key, item = item
+            children.append('%s: %s' % (bounded_repr(key, max_children, max_data, max_depth, depth+1, parents), bounded_repr(item, max_children, max_data, max_depth, depth+1, parents)))
+        elif fields is not None and index<len(fields):
+            children.append('%s=%s' % (fields[index], bounded_repr(item, max_children, max_data, max_depth, depth+1, parents)))
+        else:
+            children.append(bounded_repr(item, max_children, max_data, max_depth, depth+1, parents))
+    parents.pop()
+
+    if value_type is tuple and len(children)==1:
+        return '(%s,)' % children[0]
+    return start + ', '.join(children) + end
+
+
+def format_header(start_gmtime, trace_format=0):
+    header = u"TRACE START [%s]\n" % (time.strftime('%Y-%m-%d %H:%M:%S', start_gmtime))
+    if trace_format==1:
+        header = u"Version: %s\nFile format: 4\n" % (__version__,) + header
+    return header
+
+
+def format_footer(end_gmtime):
+    return u"TRACE END   [%s]\n\n" % (time.strftime('%Y-%m-%d %H:%M:%S', end_gmtime))
+
+
+def flatten_value(value):
+    # computerized records must stay on one tab separated line
+    return re.sub(r"[\t\n]\s*", u' ', value)
+
+
+def get_assignments(code):
+    """Map line numbers to the variables the bytecode of the line stores."""
+    opmap = dis.opmap
+    store_name = (opmap['STORE_NAME'], opmap['STORE_GLOBAL'])
+    store_fast = opmap['STORE_FAST']
+    store_deref = opmap['STORE_DEREF']
+    store_attr = opmap['STORE_ATTR']
+    load_name = (opmap['LOAD_NAME'], opmap['LOAD_GLOBAL'])
+    load_fast = opmap['LOAD_FAST']
+    load_deref = opmap['LOAD_DEREF']
+    # stores that are not assignments written by the user
+    skip_ops = (opmap['IMPORT_NAME'], opmap['IMPORT_FROM'], opmap['FOR_ITER'])
+    # def and class statements, their decorators are calls of the result
+    define_ops = (opmap['MAKE_FUNCTION'], opmap['MAKE_CLOSURE'], opmap['BUILD_CLASS'])
+    call_function = opmap['CALL_FUNCTION']
+    load_const = opmap['LOAD_CONST']
+    keep_ops = (opmap['UNPACK_SEQUENCE'], store_fast, store_deref) + store_name
+    derefs = code.co_cellvars + code.co_freevars
+
+    linestarts = dict(dis.findlinestarts(code))
+    co_code = code.co_code
+    assignments = {}
+    lineno = code.co_firstlineno
+    loaded = None
+    dup_loaded = None
+    previous = None
+    const = None
+    skip = False
+    defined = False
+    extended_arg = 0
+    i = 0
+    while i<len(co_code):
+        lineno = linestarts.get(i, lineno)
+        op = ord(co_code[i])
+        arg = None
+        if op>=dis.HAVE_ARGUMENT:
+            arg = ord(co_code[i+1]) + ord(co_code[i+2])*256 + extended_arg
+            extended_arg = 0
+            i += 3
+            if op==dis.EXTENDED_ARG:
+                extended_arg = arg*65536
+                continue
+        else:
+            i += 1
+
+        varname = None
+        if op in store_name:
+            varname = code.co_names[arg]
+        elif op==store_fast:
+            varname = code.co_varnames[arg]
+        elif op==store_deref:
+            varname = derefs[arg]
+        elif op==store_attr:
+            # obj.attr = value, or obj.attr += value which stores after ROT_TWO
+            if previous in load_name + (load_fast, load_deref):
+                varname = '%s.%s' % (loaded, code.co_names[arg])
+            elif previous==opmap['ROT_TWO'] and dup_loaded:
+                varname = '%s.%s' % (dup_loaded, code.co_names[arg])
+
+        if op in store_name and varname in ('__module__', '__doc__'):
+            # set implicitly by class bodies and docstrings
+            varname = None
+
+        if varname and not skip:
+            varnames = assignments.setdefault(lineno, [])
+            if varname not in varnames:
+                varnames.append(varname)
+
+        if op in skip_ops:
+            skip = True
+            defined = False
+        elif op in define_ops:
+            # the code of a lambda, a generator expression or a comprehension
+            # is named in brackets, it is a value the user assigns
+            skip = defined = op==opmap['BUILD_CLASS'] or not getattr(const, 'co_name', '<').startswith('<')
+        elif op==call_function and defined:
             pass
-    if len(classname):
-        methodname = classname + '.' + frame.f_code.co_name
+        elif op not in keep_ops:
+            skip = defined = False
+
+        if op==load_const:
+            const = code.co_consts[arg]
+
+        if op==opmap['DUP_TOP']:
+            dup_loaded = loaded if previous in load_name + (load_fast, load_deref) else None
+        if op in load_name:
+            loaded = code.co_names[arg]
+        elif op==load_fast:
+            loaded = code.co_varnames[arg]
+        elif op==load_deref:
+            loaded = derefs[arg]
+        previous = op
+    return assignments
+
+
+def get_memory_probe(name, interval=0.01):
+    if name=='none':
+        return None
+    elif name=='rusage':
+        if resource is None:
+            return None
+        return RusageProbe()
+    elif name=='tracemalloc':
+        if tracemalloc is None:
+            raise PyXdebugError('tracemalloc is not available')
+        return TracemallocProbe()
+    elif name=='rss':
+        return RssProbe(interval)
+    raise PyXdebugError('unknown memory probe %s' % name)
+
+
+def get_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError, AttributeError):
+        pass
+    # the peak resident set size where /proc is missing
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def get_monotonic_clock():
+    # python 2 has no time.monotonic, the monotonic clock of libc is read
+    # through ctypes and time.time is the last resort
+    try:
+        from time import monotonic
+        return monotonic
+    except ImportError:
+        pass
+    if sys.platform.startswith('linux'):
+        clock_id, libraries = 1, (None, 'librt.so.1')
+    elif sys.platform=='darwin':
+        clock_id, libraries = 6, (None,)
     else:
-        methodname = frame.f_code.co_name
-    return methodname
+        return time.time
+    for library in libraries:
+        try:
+            clock_gettime = ctypes.CDLL(library).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        if clock_gettime(clock_id, ctypes.byref(Timespec()))!=0:
+            continue
+        def monotonic(clock_gettime=clock_gettime, byref=ctypes.byref):
+            # a timespec per call, the threads read the clock concurrently
+            timespec = Timespec()
+            clock_gettime(clock_id, byref(timespec))
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+        return monotonic
+    return time.time
+
+
+clock = get_monotonic_clock()
+
+
+def bisect_lines(data, start, end, target, key):
+    """Find the first line of data[start:end], sorted by key, whose key is not less than target."""
+    # start and end stay at line starts, every line ends with a newline
+    while start<end:
+        middle = data.rfind('\n', start, (start + end) // 2) + 1 or start
+        line_end = data.find('\n', middle, end)
+        if key(data[middle:line_end])<target:
+            start = line_end + 1
+        else:
+            end = middle
+    return start
+
+
+def is_subprocess_fork(frame):
+    # the fork of subprocess.Popen, the child execs right after it
+    subprocess = sys.modules.get('subprocess')
+    execute_child = getattr(getattr(subprocess, 'Popen', None), '_execute_child', None)
+    code = getattr(getattr(execute_child, 'im_func', None), 'func_code', None)
+    return code is not None and frame.f_code is code
+
+
+def is_unwinding(frame):
+    # a return, a re-raise or a finally clause run by an exception all end
+    # with a return event, only the last instruction tells them apart
+    return ord(frame.f_code.co_code[frame.f_lasti]) not in RETURN_OPS
+
+
+def get_exception_name(exc_type):
+    if isinstance(exc_type, basestring):
+        return exc_type
+    return getattr(exc_type, '__name__', None) or repr(exc_type)
+
+
+def get_exception_message(exc_value, max_data=512):
+    # the exception value is not normalized yet for some exceptions
+    # raised by the interpreter
+    if exc_value is None:
+        return u''
+    if isinstance(exc_value, tuple) and len(exc_value)==1:
+        exc_value = exc_value[0]
+    try:
+        if isinstance(exc_value, str):
+            message = unicode(exc_value, 'utf-8', 'replace')
+        else:
+            message = unicode(exc_value)
+    except Exception:
+        # the byte string message of an exception is not ascii
+        try:
+            message = unicode(str(exc_value), 'utf-8', 'replace')
+        except Exception:
+            message = u'<unprintable %s>' % exc_value.__class__.__name__
+    if max_data>=0 and len(message)>max_data:
+        message = message[:max_data] + u'...'
+    return message
+
+
+def match_module(module, prefixes):
+    if not module:
+        return False
+    for prefix in prefixes:
+        if module==prefix or module.startswith(prefix + '.'):
+            return True
+    return False
+
+
+def match_glob(name, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def read_call_paths(reader):
+    # aggregates a trace by call path in one pass, the memory used depends
+    # on the number of call paths and not on the size of the trace, the
+    # calls of a trace without exit records end at the next call made at
+    # their depth
+    writer = CallPathWriter()
+    writer.start(reader)
+    depths = {}
+    for trace in reader:
+        if isinstance(trace, ExitTrace):
+            open_depths = depths.get(trace.thread_id)
+            if open_depths and open_depths[-1]==trace.call_depth:
+                open_depths.pop()
+        elif isinstance(trace, CallTrace):
+            open_depths = depths.setdefault(trace.thread_id, [])
+            while open_depths and open_depths[-1]>=trace.call_depth:
+                exit = ExitTrace(None, open_depths.pop())
+                exit.time = trace.time
+                exit.memory = trace.memory
+                exit.thread_id = trace.thread_id
+                writer.write(exit)
+            if not isinstance(trace, FinishTrace):
+                open_depths.append(trace.call_depth)
+        writer.write(trace)
+    writer.finish(reader)
+    return writer
+
+
+def flush_writer(writer):
+    # writes out the records buffered by a writer and by its files
+    for child in getattr(writer, 'writers', {}).itervalues():
+        flush_writer(child)
+    if hasattr(writer, 'flush'):
+        writer.flush()
+    fileobj = getattr(writer, 'fileobj', None)
+    if fileobj is not None:
+        fileobj.flush()
+
+
+def get_frame_params(frame):
+    """List the (name, value) parameters of the call of a frame."""
+    params = []
+    arginfo = inspect.getargvalues(frame)
+    # args
+    for key in arginfo.args:
+        if isinstance(key, basestring):
+            params.append((key, arginfo.locals.get(key)))
+        elif isinstance(key, list):
+            keys = key
+            for key in keys:
+                params.append((key, arginfo.locals.get(key)))
+    # varargs
+    if arginfo.varargs:
+        for value in arginfo.locals[arginfo.varargs]:
+            params.append((None, value))
+    # keywords
+    if arginfo.keywords:
+        kwds = arginfo.locals.get(arginfo.keywords)
+        for key, value in kwds.iteritems():
+            params.append((key, value))
+    return params
 
 
 def get_frame_var(frame, varname):
@@ -478,6 +3425,33 @@ class FrameWrap(object):
         self.f_lineno = getattr(other, 'f_lineno', None)
 
 
+class FrameSnapshot(object):
+    __slots__ = ('f_code', 'f_lineno', 'f_back', 'frame')
+
+    def __init__(self, frame, f_back=None, live=True):
+        self.f_code = frame.f_code
+        self.f_lineno = frame.f_lineno
+        self.f_back = f_back
+        # the live frame is only kept to read its locals on demand
+        self.frame = frame if live else None
+
+    @property
+    def f_locals(self):
+        if self.frame is None:
+            return {}
+        return self.frame.f_locals
+
+    def detach(self):
+        self.frame = None
+
+    def get_line(self):
+        return linecache.getline(self.f_code.co_filename, self.f_lineno)
+
+    def set_position(self, other):
+        self.f_code = getattr(other, 'f_code', None)
+        self.f_lineno = getattr(other, 'f_lineno', None)
+
+
 #=================================================
 
 
@@ -522,8 +3496,24 @@ def main():
             raise OptionValueError('%s option requires an integer value' % opt_str)
         setattr(parser.values, option.dest, value)
 
+    # parser float option
+    def action_float(option, opt_str, value, parser, *args, **kwargs):
+        rargs = parser.rargs
+
+        arg = rargs[0] if len(rargs) else '---'
+        if (arg[:2] == "--" and len(arg) > 2) or (arg[:1] == "-" and len(arg) > 1 and arg[1] != "-"):
+            raise OptionValueError('%s option requires an argument' % opt_str)
+
+        value = arg
+        del rargs[0]
+        try:
+            value = float(value)
+        except:
+            raise OptionValueError('%s option requires a number' % opt_str)
+        setattr(parser.values, option.dest, value)
+
     # parser
-    usage = 'pyxdebug.py [-o output_file_path] [-i collect_import] [-p collect_params] [-r collect_return] [-a collect_assignments] script_path [args ...]'
+    usage = 'pyxdebug.py [-o output_file_path] [-f output_format] [--top top] [--sort sort] [-b buffer_size] [--index_interval index_interval] [--flight_recorder size] [-t trace_format] [-s sample_interval] [-T trace_threads] [-P trace_children] [-d max_depth] [-n max_records] [--include_module module] [--exclude_module module] [--include_file glob] [--exclude_file glob] [--include_function glob] [--exclude_function glob] [-i collect_import] [-p collect_params] [-r collect_return] [-a collect_assignments] [-x collect_exceptions] [-m memory_probe] [--memory_interval memory_interval] [-e collect_durations] script_path [args ...]\n       pyxdebug.py [-o output_file_path] -c binary_trace_path [...]\n       pyxdebug.py [-o output_file_path] [-f output_format] -M binary_trace_path [...]\n       pyxdebug.py [-o output_file_path] [--top top] [--threshold threshold] [--min_time min_time] [--min_memory min_memory] -D old_binary_trace_path new_binary_trace_path'
     parser = OptionParser(usage=usage)
     parser.allow_interspersed_args = False
 
@@ -536,6 +3526,173 @@ def main():
         help="Save stats to <outfile>",
         default=sys.stdout
     )
+    parser.add_option(
+        '-f',
+        '--output_format',
+        type="choice",
+        choices=['text', 'binary', 'callgrind', 'summary', 'imports'],
+        dest="output_format",
+        help="Write the trace to <outfile> as 'text' (default), in the compact 'binary' format, as a 'callgrind' profile, as a 'summary' table of the functions or as an 'imports' tree with the self and cumulative time of every import.",
+        default='text'
+    )
+    parser.add_option(
+        '--top',
+        action="callback",
+        callback=action_int,
+        dest="top",
+        help="This setting, defaulting to 20, controls how many functions and calls the summary table shows.",
+        default=20
+    )
+    parser.add_option(
+        '--sort',
+        type="choice",
+        choices=['calls', 'total', 'self', 'memory', 'depth', 'cumulative', 'loaded'],
+        dest="sort",
+        help="Sort the summary table by 'calls', 'total' (default), 'self' time, 'memory' delta or max call 'depth', and the imports tree by 'cumulative' (default), 'self' time or 'loaded' modules.",
+        default=None
+    )
+    parser.add_option(
+        '--index_interval',
+        action="callback",
+        callback=action_int,
+        dest="index_interval",
+        help="This setting, defaulting to 0, writes a text trace with an index to <outfile>.idx, with a time checkpoint every <index_interval> records and the offsets of every call. 0 writes no index.",
+        default=0
+    )
+    parser.add_option(
+        '--flight_recorder',
+        action="callback",
+        callback=action_int,
+        dest="flight_recorder",
+        help="This setting, defaulting to 0, keeps only the last <flight_recorder> records in a ring buffer and writes them to <outfile> when an exception escapes the script or on SIGUSR1. 0 writes the whole trace.",
+        default=0
+    )
+    parser.add_option(
+        '-c',
+        '--convert',
+        action="store_true",
+        dest="convert",
+        help="Convert the given binary trace files to text instead of running a script.",
+        default=False
+    )
+    parser.add_option(
+        '-M',
+        '--merge',
+        action="store_true",
+        dest="merge",
+        help="Merge the given binary trace files of a process and of its children into one time ordered trace, or into one profile with -f callgrind or summary, instead of running a script.",
+        default=False
+    )
+    parser.add_option(
+        '-D',
+        '--diff',
+        action="store_true",
+        dest="diff",
+        help="Compare the given old and new binary trace files by call path and by function, and write the changed call counts, the new and removed calls and the time and memory changes to <outfile>, instead of running a script.",
+        default=False
+    )
+    parser.add_option(
+        '--threshold',
+        action="callback",
+        callback=action_float,
+        dest="threshold",
+        help="This setting, defaulting to 10, controls by how many percent of the old value a time or memory change must differ to be written by -D.",
+        default=10
+    )
+    parser.add_option(
+        '--min_time',
+        action="callback",
+        callback=action_float,
+        dest="min_time",
+        help="This setting, defaulting to 0.1, controls how many milliseconds a time change must be at least to be written by -D.",
+        default=0.1
+    )
+    parser.add_option(
+        '--min_memory',
+        action="callback",
+        callback=action_int,
+        dest="min_memory",
+        help="This setting, defaulting to 0, controls how large a memory change must be at least to be written by -D. 0 writes the memory changes only with the other changes.",
+        default=0
+    )
+    parser.add_option(
+        '-b',
+        '--buffer_size',
+        action="callback",
+        callback=action_int,
+        dest="buffer_size",
+        help="This setting, defaulting to 1000, controls how many trace records PyXdebug buffers before writing them to <outfile>.",
+        default=1000
+    )
+    parser.add_option(
+        '-t',
+        '--trace_format',
+        action="callback",
+        callback=action_int,
+        dest="trace_format",
+        help="This setting, defaulting to 0, controls the format of the trace file. 0 is the human readable format and 1 is the computerized format with entry, exit and return records.",
+        default=0
+    )
+    parser.add_option(
+        '-s',
+        '--sample_interval',
+        action="callback",
+        callback=action_float,
+        dest="sample_interval",
+        help="This setting, defaulting to 0, samples the call stack every <sample_interval> milliseconds instead of tracing every call, and writes folded stacks for flamegraph tools to <outfile>.",
+        default=0
+    )
+    parser.add_option(
+        '-T',
+        '--trace_threads',
+        action="callback",
+        callback=action_int,
+        dest="trace_threads",
+        help="This setting, defaulting to 0, controls whether PyXdebug should trace the threads started by the script. 1 interleaves the threads with thread markers and 2 writes one trace per thread to <outfile>.<thread id>.",
+        default=0
+    )
+    parser.add_option(
+        '-P',
+        '--trace_children',
+        action="callback",
+        callback=action_int,
+        dest="trace_children",
+        help="This setting, defaulting to 0, controls whether PyXdebug should trace the child processes forked by the script. Each child writes its own trace to <outfile>.<pid>, tagged with its pid and its parent pid.",
+        default=0
+    )
+    parser.add_option(
+        '-d',
+        '--max_depth',
+        action="callback",
+        callback=action_int,
+        dest="max_depth",
+        help="This setting, defaulting to 0, controls the maximum call depth PyXdebug records. The calls made deeper are not traced. 0 is unlimited.",
+        default=0
+    )
+    parser.add_option(
+        '-n',
+        '--max_records',
+        action="callback",
+        callback=action_int,
+        dest="max_records",
+        help="This setting, defaulting to 0, controls the maximum number of records PyXdebug writes. Tracing stops and the trace is marked as truncated when it is reached. 0 is unlimited.",
+        default=0
+    )
+    for name, metavar, help_text in (
+            ('include_module', 'MODULE', "Record only the functions of modules whose name starts with <include_module>, repeatable."),
+            ('exclude_module', 'MODULE', "Do not record the functions of modules whose name starts with <exclude_module>, repeatable."),
+            ('include_file', 'GLOB', "Record only the functions of files matching the glob <include_file>, repeatable."),
+            ('exclude_file', 'GLOB', "Do not record the functions of files matching the glob <exclude_file>, repeatable."),
+            ('include_function', 'GLOB', "Record only the functions whose name matches the glob <include_function>, repeatable."),
+            ('exclude_function', 'GLOB', "Do not record the functions whose name matches the glob <exclude_function>, repeatable.")):
+        parser.add_option(
+            '--' + name,
+            action="append",
+            dest=name + 's',
+            metavar=metavar,
+            help=help_text,
+            default=[]
+        )
     parser.add_option(
         '-i',
         '--collect_imports',
@@ -572,8 +3729,102 @@ def main():
         help="This setting, defaulting to 0, controls whether PyXdebug should add variable assignments to function traces.",
         default=0
     )
+    parser.add_option(
+        '-x',
+        '--collect_exceptions',
+        action="callback",
+        callback=action_int,
+        dest="collect_exceptions",
+        help="This setting, defaulting to 0, controls whether PyXdebug should write the exceptions raised in functions to the trace files and mark the exits of the functions they unwind.",
+        default=0
+    )
+    parser.add_option(
+        '-m',
+        '--memory_probe',
+        type="choice",
+        choices=['none', 'rusage', 'tracemalloc', 'rss'],
+        dest="memory_probe",
+        help="Write nothing ('none', default), the minor page faults with a getrusage call per record ('rusage'), the size of the allocations traced by 'tracemalloc' (not available on python 2) or the resident set size ('rss') to the memory column of the trace files.",
+        default='none'
+    )
+    parser.add_option(
+        '--memory_interval',
+        action="callback",
+        callback=action_float,
+        dest="memory_interval",
+        help="This setting, defaulting to 10, controls how many milliseconds the 'rss' memory probe waits between reads of the resident set size.",
+        default=10
+    )
+    parser.add_option(
+        '-e',
+        '--collect_durations',
+        action="callback",
+        callback=action_int,
+        dest="collect_durations",
+        help="This setting, defaulting to 0, controls whether PyXdebug should write exit records with the duration and the memory delta of function calls to the trace files.",
+        default=0
+    )
 
     (options, args) = parser.parse_args()
+    if options.trace_format not in (0, 1):
+        parser.error('-t option must be 0 or 1')
+
+    # writer of a trace file
+    def open_writer(fileobj):
+        if options.output_format=='binary':
+            return BinaryTraceWriter(fileobj)
+        if options.output_format=='callgrind':
+            return CallgrindWriter(fileobj)
+        if options.output_format=='summary':
+            return SummaryWriter(fileobj, options.top, options.sort or 'total')
+        if options.output_format=='imports':
+            return ImportProfileWriter(fileobj, options.top, options.sort or 'cumulative')
+        if options.flight_recorder>0:
+            return FlightRecorder(options.flight_recorder, fileobj, getattr(signal, 'SIGUSR1', None))
+        if options.index_interval>0 and hasattr(fileobj, 'name') and fileobj not in (sys.stdout, sys.stderr):
+            return IndexedTraceWriter(fileobj, open(fileobj.name + '.idx', 'a'), max(options.buffer_size, 1), options.index_interval)
+        return TraceWriter(fileobj, max(options.buffer_size, 1))
+
+    # convert binary traces
+    if options.convert:
+        if len(args)==0:
+            parser.print_help()
+            sys.exit(2)
+        for path in args:
+            reader = BinaryTraceReader(open(path, 'rb'))
+            reader.trace_format = options.trace_format
+            reader.convert(options.outfile, max(options.buffer_size, 1))
+        return
+
+    # merge binary traces
+    if options.merge:
+        if len(args)==0:
+            parser.print_help()
+            sys.exit(2)
+        merger = TraceMerger([BinaryTraceReader(open(path, 'rb')) for path in args])
+        merger.trace_format = options.trace_format
+        merger.merge(open_writer(options.outfile))
+        return
+
+    # compare binary traces
+    if options.diff:
+        if len(args)!=2:
+            parser.print_help()
+            sys.exit(2)
+        old, new = [read_call_paths(BinaryTraceReader(open(path, 'rb'))) for path in args]
+        diff = TraceDiff(old, new, options.threshold / 100.0, options.min_time / 1000.0, options.min_memory, options.top)
+        options.outfile.write(diff.get_result())
+        options.outfile.flush()
+        return
+
+    if options.memory_probe=='tracemalloc' and tracemalloc is None:
+        parser.error('tracemalloc is not available')
+    if options.trace_children and options.outfile in (sys.stdout, sys.stderr):
+        parser.error('-P option requires an output file')
+    if options.output_format=='summary' and options.sort not in (None,) + SummaryWriter.sort_keys:
+        parser.error('the summary table can not be sorted by %s' % options.sort)
+    if options.output_format=='imports' and options.sort not in (None,) + ImportProfileWriter.sort_keys:
+        parser.error('the imports tree can not be sorted by %s' % options.sort)
 
     # script_path is this_path
     if len(args)==0 or os.path.splitext(os.path.abspath(args[0]))[0]==this_path:
@@ -590,11 +3841,43 @@ def main():
     xd.collect_params = options.collect_params
     xd.collect_return = options.collect_return
     xd.collect_assignments = options.collect_assignments
+    xd.collect_exceptions = options.collect_exceptions
+    xd.memory_probe = options.memory_probe
+    xd.memory_interval = options.memory_interval / 1000.0
+    xd.collect_durations = options.collect_durations
+    xd.trace_format = options.trace_format
+    xd.trace_threads = options.trace_threads
+    xd.max_depth = options.max_depth
+    xd.max_records = options.max_records
+    xd.include_modules = options.include_modules
+    xd.exclude_modules = options.exclude_modules
+    xd.include_files = options.include_files
+    xd.exclude_files = options.exclude_files
+    xd.include_functions = options.include_functions
+    xd.exclude_functions = options.exclude_functions
+    if options.sample_interval>0:
+        xd.sample_interval = options.sample_interval / 1000.0
+        xd.run_file(script_path)
+        options.outfile.write(xd.get_folded())
+        return
+
+    # one trace per thread
+    def open_process_writer(fileobj):
+        main_writer = open_writer(fileobj)
+        if options.trace_threads==2 and options.output_format in ('text', 'binary'):
+            def open_thread_writer(thread_id):
+                if thread_id==xd.thread_id:
+                    return main_writer
+                return open_writer(open('%s.%s' % (fileobj.name, thread_id), 'a'))
+            return ThreadSplitWriter(open_thread_writer)
+        return main_writer
+    xd.writer = open_process_writer(options.outfile)
+
+    # one trace per child process
+    if options.trace_children:
+        xd.trace_children = options.trace_children
+        xd.child_writer = lambda pid, ppid: open_process_writer(open('%s.%d' % (options.outfile.name, pid), 'a'))
     xd.run_file(script_path)
-    result = xd.get_result()
-
-    # output
-    options.outfile.write(result)
 
 
 if __name__=='__main__':
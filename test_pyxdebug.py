@@ -1,6 +1,8 @@
 import pyxdebug
 import inspect
 import time
+import sys
+from StringIO import StringIO
 
 
 class TestPyXdebug(object):
@@ -44,6 +46,37 @@ class TestPyXdebug(object):
 
         assert len(result)==3
 
+    def test_collect_imports_assignments(self):
+        import os
+        import sys
+        import tempfile
+
+        # class bodies run by nested imports record their assignments
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'pyxdebug_outer.py'), 'w') as fileobj:
+            fileobj.write('import pyxdebug_inner\nclass Outer:\n    value = 1\nname = "outer"\n')
+        with open(os.path.join(directory, 'pyxdebug_inner.py'), 'w') as fileobj:
+            fileobj.write('class Inner:\n    value = 2\n')
+
+        def func():
+            import pyxdebug_outer
+
+        sys.path.insert(0, directory)
+        try:
+            xd = pyxdebug.PyXdebug()
+            xd.collect_assignments = 1
+            xd.run_func(func)
+        finally:
+            sys.path.remove(directory)
+            sys.modules.pop('pyxdebug_outer', None)
+            sys.modules.pop('pyxdebug_inner', None)
+        imports = [r.name for r in xd.result if r.__class__==pyxdebug.ImportTrace]
+        assignments = [r.varname for r in xd.result if r.__class__==pyxdebug.AssignmentTrace]
+
+        assert imports[:2] == ['pyxdebug_outer', 'pyxdebug_inner']
+        assert xd.late_dispatch == []
+        assert assignments.count('value') == 2
+
     def test_collect_return(self):
         def func():
             return 123
@@ -75,6 +108,446 @@ class TestPyXdebug(object):
         assert result[2].varname == 'c'
         assert result[2].value == 123 + 456
 
+    def test_code_cache(self):
+        def func():
+            return 123
+
+        xd = pyxdebug.PyXdebug()
+        xd.run_func(func)
+        info = xd.code_cache[id(func.func_code)]
+
+        assert info.code is func.func_code
+        assert not info.internal
+        assert xd.code_cache[id(pyxdebug.PyXdebug._run.func_code)].internal
+
+    def test_call_trace_detached(self):
+        def func(a):
+            return a
+
+        xd = pyxdebug.PyXdebug()
+        xd.collect_params = 1
+        xd.run_func(func, 123)
+        result = [r for r in xd.result if r.__class__==pyxdebug.CallTrace]
+
+        assert result[0].callee.frame is None
+        assert result[0].get_params() == [('a', 123)]
+
+    def test_trace_format(self):
+        def func(a):
+            b = a
+            return b
+
+        xd = pyxdebug.PyXdebug()
+        xd.trace_format = 1
+        xd.collect_params = 1
+        xd.collect_return = 1
+        xd.collect_assignments = 1
+        xd.run_func(func, 123)
+        result = xd.get_result().splitlines()
+
+        assert result[0] == u'Version: %s' % pyxdebug.__version__
+        assert result[1] == u'File format: 4'
+        assert result[3].split(u'\t')[0:3] == [u'1', u'1', u'0']
+        assert result[3].split(u'\t')[5:] == [u'func', u'1', u'', __file__.replace('.pyc', '.py'), result[3].split(u'\t')[9], u'1', u'a=123']
+        assert result[4].split(u'\t') == [u'1', u'1', u'A', u'', u'', __file__.replace('.pyc', '.py'), result[4].split(u'\t')[6], u'b = 123']
+        assert result[5].split(u'\t')[0:3] == [u'1', u'1', u'1']
+        assert result[6] == u'1\t1\tR\t\t\t123'
+        assert result[7].startswith(u'\t\t\t')
+
+    def test_sample_interval(self):
+        def busy():
+            end = time.time() + 0.05
+            while time.time()<end:
+                pass
+
+        def func():
+            busy()
+
+        xd = pyxdebug.PyXdebug()
+        xd.sample_interval = 0.001
+        xd.run_func(func)
+
+        assert [r.__class__ for r in xd.result] == [pyxdebug.FinishTrace]
+        assert xd.samples.get(u'func;busy', 0) > 0
+        assert u'func;busy %d\n' % xd.samples[u'func;busy'] in xd.get_folded()
+
+    def test_profile_hook(self):
+        def callee():
+            return len([1, 2])
+
+        def func():
+            return callee() + callee()
+
+        xd = pyxdebug.PyXdebug()
+        xd.collect_return = 1
+        xd.run_func(func)
+        result = [r for r in xd.result if r.__class__ in (pyxdebug.CallTrace, pyxdebug.ReturnTrace)]
+
+        assert not xd.trace_lines
+        assert xd.call_depth == 0
+        assert xd.profile_frames == []
+        assert [(r.__class__, r.call_depth) for r in result] == [
+            (pyxdebug.CallTrace, 0), (pyxdebug.CallTrace, 1), (pyxdebug.ReturnTrace, 1),
+            (pyxdebug.CallTrace, 1), (pyxdebug.ReturnTrace, 1), (pyxdebug.ReturnTrace, 0)]
+
+    def test_trace_lines(self):
+        def func():
+            a = 1
+
+        xd = pyxdebug.PyXdebug()
+        xd.collect_assignments = 1
+        xd.run_func(func)
+        assert xd.trace_lines
+
+    def test_trace_threads(self):
+        import threading
+
+        def work():
+            return 1
+
+        def func():
+            t = threading.Thread(target=work)
+            t.start()
+            t.join()
+            work()
+
+        xd = pyxdebug.PyXdebug()
+        xd.trace_threads = 1
+        xd.run_func(func)
+        calls = [r for r in xd.result if r.__class__==pyxdebug.CallTrace and r.callee_name()=='work']
+        markers = [r for r in xd.result if r.__class__==pyxdebug.ThreadTrace]
+
+        assert len(calls) == 2
+        assert calls[0].thread_id != xd.thread_id
+        assert calls[0].call_depth == 1
+        assert calls[1].thread_id == xd.thread_id
+        assert calls[1].call_depth == 1
+        assert markers[0].thread_id == calls[0].thread_id
+        assert u'-> work()' not in xd.get_result(calls[0].thread_id).split(u'\n')[-4]
+        assert u'*> thread' not in xd.get_result(xd.thread_id)
+        assert u'*> thread' not in xd.get_result(calls[0].thread_id)
+
+    def test_trace_threads_disabled(self):
+        import threading
+
+        def work():
+            return 1
+
+        def func():
+            t = threading.Thread(target=work)
+            t.start()
+            t.join()
+
+        xd = pyxdebug.PyXdebug()
+        xd.run_func(func)
+        assert [r for r in xd.result if r.__class__==pyxdebug.CallTrace and r.callee_name()=='work'] == []
+
+    def test_filters(self):
+        def helper():
+            return 1
+
+        def skipped():
+            return helper()
+
+        def func():
+            skipped()
+            return helper()
+
+        def names(xd):
+            return [r.callee_name() for r in xd.result if r.__class__==pyxdebug.CallTrace]
+
+        for collect_assignments in (0, 1):
+            xd = pyxdebug.PyXdebug()
+            xd.collect_assignments = collect_assignments
+            xd.exclude_functions = ['skip*']
+            xd.run_func(func)
+            assert names(xd) == ['func', 'helper', 'helper']
+            assert [r.call_depth for r in xd.result if r.__class__==pyxdebug.CallTrace] == [0, 1, 1]
+            assert not xd.code_cache[id(skipped.func_code)].traced
+
+        xd = pyxdebug.PyXdebug()
+        xd.include_functions = ['helper']
+        xd.run_func(func)
+        assert names(xd) == ['helper', 'helper']
+
+        xd = pyxdebug.PyXdebug()
+        xd.include_modules = ['test_pyxdebug']
+        xd.exclude_files = ['*/pyxdebug.py*']
+        xd.run_func(func)
+        assert names(xd) == ['func', 'skipped', 'helper', 'helper']
+
+        xd = pyxdebug.PyXdebug()
+        xd.exclude_modules = ['test_pyxdebug']
+        xd.run_func(func)
+        assert names(xd) == []
+
+    def test_collect_exceptions(self):
+        def inner(n):
+            if n==0:
+                raise ValueError('bottom')
+            return inner(n - 1)
+
+        def func():
+            try:
+                inner(2)
+            except ValueError:
+                pass
+            return 1
+
+        for collect_assignments in (0, 1):
+            xd = pyxdebug.PyXdebug()
+            xd.collect_exceptions = 1
+            xd.collect_assignments = collect_assignments
+            xd.collect_return = 1
+            xd.collect_durations = 1
+            xd.run_func(func)
+            exceptions = [r for r in xd.result if r.__class__==pyxdebug.ExceptionTrace]
+            exits = [r for r in xd.result if r.__class__==pyxdebug.ExitTrace]
+            returns = [r for r in xd.result if r.__class__==pyxdebug.ReturnTrace]
+
+            assert len(exceptions) == 1
+            assert exceptions[0].exc_type == 'ValueError'
+            assert exceptions[0].message == u'bottom'
+            assert exceptions[0].callee_lineno() == inner.func_code.co_firstlineno + 2
+            assert exceptions[0].call_depth == 4
+            assert [r.unwinding for r in exits] == [True, True, True, False]
+            assert [r.call_depth for r in exits] == [3, 2, 1, 0]
+            assert [r.value for r in returns] == [1]
+            assert xd.call_depth == 0
+            assert xd.late_dispatch == []
+
+        xd = pyxdebug.PyXdebug()
+        xd.run_func(func)
+        assert [r for r in xd.result if r.__class__==pyxdebug.ExceptionTrace] == []
+
+    def test_unwinding(self):
+        def cleanup():
+            try:
+                raise KeyError('k')
+            finally:
+                pass
+
+        def reraise():
+            try:
+                raise KeyError('k')
+            except KeyError:
+                raise
+
+        def handled():
+            try:
+                cleanup()
+            except KeyError:
+                pass
+            return 1
+
+        # the line events of a finally clause or of a re-raise do not end
+        # the unwinding, with or without the trace hook
+        for func in (cleanup, reraise):
+            for collect_exceptions in (0, 1):
+                xd = pyxdebug.PyXdebug()
+                xd.collect_exceptions = collect_exceptions
+                xd.collect_return = 1
+                xd.collect_durations = 1
+                try:
+                    xd.run_func(func)
+                except KeyError:
+                    pass
+                exits = [r for r in xd.result if r.__class__==pyxdebug.ExitTrace]
+
+                assert [r.unwinding for r in exits] == [True]
+                assert [r for r in xd.result if r.__class__==pyxdebug.ReturnTrace] == []
+
+        xd = pyxdebug.PyXdebug()
+        xd.collect_exceptions = 1
+        xd.collect_return = 1
+        xd.collect_durations = 1
+        xd.run_func(handled)
+
+        assert [r.unwinding for r in xd.result if r.__class__==pyxdebug.ExitTrace] == [True, False]
+        assert [r.value for r in xd.result if r.__class__==pyxdebug.ReturnTrace] == [1]
+
+    def test_max_depth(self):
+        for collect_assignments in (0, 1):
+            xd = pyxdebug.PyXdebug()
+            xd.collect_assignments = collect_assignments
+            xd.max_depth = 3
+            xd.run_file("example_run_file.py")
+            depths = [r.call_depth for r in xd.result if r.__class__==pyxdebug.CallTrace]
+            assert max(depths) == 2
+            assert depths.count(2) > 0
+            assert not xd.truncated
+
+    def test_max_depth_imports(self):
+        def func():
+            import xml.dom.minidom
+            return xml.dom.minidom
+
+        # the modules loaded by the import are below the deepest call
+        saved = dict((k, v) for k, v in sys.modules.items() if k=='xml' or k.startswith('xml.'))
+        for name in saved:
+            del sys.modules[name]
+        try:
+            xd = pyxdebug.PyXdebug()
+            xd.max_depth = 2
+            xd.run_func(func)
+        finally:
+            sys.modules.update(saved)
+        imports = [r for r in xd.result if r.__class__==pyxdebug.ImportTrace]
+        assert [r.call_depth for r in imports] == [1]
+        assert imports[0].loaded > 1
+        assert max([r.call_depth for r in xd.result]) == 1
+
+    def test_max_records(self):
+        for collect_assignments in (0, 1):
+            xd = pyxdebug.PyXdebug()
+            xd.collect_assignments = collect_assignments
+            xd.trace_format = 1
+            xd.max_records = 5
+            xd.run_file("example_run_file.py")
+            assert xd.truncated
+            assert len(xd.result) == 7
+            assert xd.result[5].__class__ == pyxdebug.LogTrace
+            assert xd.result[5].message == u'trace truncated after 5 records'
+            assert xd.result[6].__class__ == pyxdebug.FinishTrace
+
+        xd = pyxdebug.PyXdebug()
+        xd.max_records = 1000000
+        xd.run_file("example_run_file.py")
+        assert not xd.truncated
+
+    def test_collect_durations(self):
+        def inner():
+            time.sleep(0.01)
+
+        def func():
+            inner()
+
+        xd = pyxdebug.PyXdebug()
+        xd.collect_durations = 1
+        xd.run_func(func)
+        calls = [r for r in xd.result if r.__class__==pyxdebug.CallTrace]
+        exits = [r for r in xd.result if r.__class__==pyxdebug.ExitTrace]
+
+        assert [r.call_depth for r in exits] == [1, 0]
+        assert exits[0].number == calls[1].number
+        assert calls[1].duration == exits[0].duration
+        assert calls[1].duration >= 0.01
+        assert calls[0].duration >= calls[1].duration
+        assert u'<- %.6f' % calls[1].duration in xd.get_result()
+
+        xd = pyxdebug.PyXdebug()
+        xd.run_func(func)
+        assert [r for r in xd.result if r.__class__==pyxdebug.ExitTrace] == []
+        assert xd.result[0].duration is None
+
+    def test_memory_probe(self):
+        def func():
+            return [0] * 100000
+
+        # no system call per record unless a probe is asked for
+        xd = pyxdebug.PyXdebug()
+        xd.run_func(func)
+        assert xd.memory_probe == 'none'
+        assert [r.memory for r in xd.result] == [None, None]
+
+        if pyxdebug.resource is not None:
+            xd = pyxdebug.PyXdebug()
+            xd.memory_probe = 'rusage'
+            xd.run_func(func)
+            assert xd.result[0].memory > 0
+
+        xd = pyxdebug.PyXdebug()
+        xd.memory_probe = 'rss'
+        xd.memory_interval = 0.001
+        xd.run_func(func)
+        assert xd.result[0].memory > 0
+        assert not xd.probe.is_alive()
+
+        if pyxdebug.tracemalloc is not None:
+            xd = pyxdebug.PyXdebug()
+            xd.memory_probe = 'tracemalloc'
+            xd.collect_durations = 1
+            xd.run_func(func)
+            assert xd.result[1].memory_delta >= 100000 * 4
+            assert not pyxdebug.tracemalloc.is_tracing()
+
+        xd = pyxdebug.PyXdebug()
+        xd.memory_probe = 'unknown'
+        try:
+            xd.run_func(func)
+        except pyxdebug.PyXdebugError:
+            pass
+        else:
+            assert False
+
+    def test_writer(self):
+        def func():
+            return 123
+
+        output = StringIO()
+        xd = pyxdebug.PyXdebug()
+        xd.writer = pyxdebug.TraceWriter(output)
+        xd.run_func(func)
+        result = output.getvalue().splitlines()
+
+        assert xd.result == []
+        assert result[0].startswith(u'TRACE START [')
+        assert result[1][24:].startswith(u'-> func() ')
+        assert result[-2].startswith(u'TRACE END   [')
+
+    def test_writer_imports(self):
+        import threading
+
+        class ImportingWriter(pyxdebug.TraceWriter):
+            def write(self, trace):
+                # a module loaded lazily while a record is written
+                sys.modules.pop('colorsys', None)
+                import colorsys
+                super(ImportingWriter, self).write(trace)
+
+        def func():
+            import json
+            return json
+
+        def run():
+            xd.run_func(func)
+
+        output = StringIO()
+        xd = pyxdebug.PyXdebug()
+        xd.trace_threads = 1
+        xd.writer = ImportingWriter(output)
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        t.join(5)
+        result = output.getvalue()
+
+        assert not t.is_alive()
+        assert u'import json' in result
+        assert u'colorsys' not in result
+
+    def test_capture_values(self):
+        import weakref
+
+        class Value(object):
+            pass
+
+        def func(value):
+            other = value
+            return value
+
+        value = Value()
+        ref = weakref.ref(value)
+        xd = pyxdebug.PyXdebug()
+        xd.collect_params = 1
+        xd.collect_return = 1
+        xd.collect_assignments = 1
+        xd.run_func(func, value)
+        del value
+
+        assert ref() is None
+        assert [r for r in xd.result if r.__class__==pyxdebug.AssignmentTrace][0].varname == 'other'
+
     def test_run_statement(self):
         locals_ = {}
         xd = pyxdebug.PyXdebug()
@@ -82,10 +555,895 @@ class TestPyXdebug(object):
         assert locals_.get('a', None)==123
 
 
+class TestTraceWriter(object):
+    def test_buffer(self):
+        output = StringIO()
+        writer = pyxdebug.TraceWriter(output, 2)
+        trace = pyxdebug.ReturnTrace(None, 0)
+        trace.setvalue(123)
+
+        writer.write(trace)
+        assert output.getvalue() == u''
+        writer.write(trace)
+        assert output.getvalue() == (u' '*24 + u'>=> 123\n')*2
+        assert writer.buffer == []
+
+
+class TestIndexedTrace(object):
+    def write_indexed(self, xd, prefix='', path=None):
+        import tempfile
+        import os
+        if path is None:
+            fd, path = tempfile.mkstemp()
+            os.write(fd, prefix)
+            os.close(fd)
+        with open(path, 'a') as fileobj:
+            with open(path + '.idx', 'a') as indexobj:
+                xd.writer = pyxdebug.IndexedTraceWriter(fileobj, indexobj, interval=4)
+                xd.run_file("example_run_file.py")
+        return path
+
+    def remove(self, reader):
+        import os
+        reader.close()
+        os.remove(reader.trace_path)
+        os.remove(reader.index_path)
+
+    def test_calls(self):
+        xd = pyxdebug.PyXdebug()
+        xd.collect_return = 1
+        reader = pyxdebug.IndexedTraceReader(self.write_indexed(xd, 'previous trace\n'))
+        try:
+            calls = reader.get_calls('pyxdebug.Fib.calc')
+            assert len(calls) == 15
+            assert calls[0][24:].startswith(u'-> pyxdebug.Fib.calc() ')
+            assert u'pyxdebug.Fib.__init__' in reader.get_functions()
+            assert len(reader.checkpoints) == (reader.records + 3) // 4
+
+            # the second call returns 5 and calls calc 8 times
+            start = reader.get_offsets('pyxdebug.Fib.calc')[1][0]
+            subtree = reader.get_subtree(start)
+            assert subtree[0] == calls[1]
+            assert subtree[-1].endswith(u'>=> 5')
+            assert len([line for line in subtree if u'->' in line]) == 9
+            assert len(reader.get_function_subtrees('pyxdebug.Fib.calc')) == 15
+        finally:
+            self.remove(reader)
+
+    def test_sections(self):
+        # every trace appended to the file has an index section of its own
+        xd = pyxdebug.PyXdebug()
+        path = self.write_indexed(xd)
+        xd = pyxdebug.PyXdebug()
+        xd.collect_return = 1
+        self.write_indexed(xd, path=path)
+        first = pyxdebug.IndexedTraceReader(path, section=0)
+        reader = pyxdebug.IndexedTraceReader(path)
+        try:
+            calls = reader.get_offsets('pyxdebug.Fib.calc')
+            assert len(calls) == 15
+            assert calls[0][0] > first.end
+            assert reader.get_subtree(calls[1][0])[-1].endswith(u'>=> 5')
+            assert first.get_offsets('pyxdebug.Fib.calc')[-1][1] < first.end
+            # the first trace has no return records
+            subtree = first.get_subtree(first.get_offsets('pyxdebug.Fib.calc')[1][0])
+            assert len(subtree) == 9
+            assert [line for line in subtree if u'>=>' in line] == []
+            assert first.get_functions() == reader.get_functions()
+            try:
+                pyxdebug.IndexedTraceReader(path, section=2)
+            except pyxdebug.PyXdebugError:
+                pass
+            else:
+                assert False
+        finally:
+            first.close()
+            self.remove(reader)
+
+    def test_time_range(self):
+        xd = pyxdebug.PyXdebug()
+        xd.trace_format = 1
+        reader = pyxdebug.IndexedTraceReader(self.write_indexed(xd))
+        try:
+            calls = reader.get_offsets('pyxdebug.Fib.calc')
+            lines = reader.get_time_range(calls[4][2], calls[10][2])
+            times = [float(line.split(u'\t')[3]) for line in lines]
+            assert len(lines) >= 7
+            assert min(times) >= calls[4][2] - 0.000001
+            assert max(times) <= calls[10][2] + 0.000001
+            assert reader.get_time_range(1000.0, 2000.0) == []
+        finally:
+            self.remove(reader)
+
+    def test_not_index(self):
+        import tempfile
+        import os
+        fd, path = tempfile.mkstemp()
+        os.write(fd, 'TRACE START\n')
+        os.close(fd)
+        try:
+            pyxdebug.IndexedTraceReader(path, path)
+        except pyxdebug.PyXdebugError:
+            pass
+        else:
+            assert False
+        finally:
+            os.remove(path)
+
+
+class TestFlightRecorder(object):
+    def test_render(self):
+        def func(a):
+            b = a
+            import pyxdebug
+            return b
+
+        for trace_format in (0, 1):
+            xd = pyxdebug.PyXdebug()
+            xd.collect_params = 1
+            xd.collect_return = 1
+            xd.collect_assignments = 1
+            xd.trace_format = trace_format
+            xd.run_func(func, 1)
+            recorder = pyxdebug.FlightRecorder(100)
+            recorder.trace_format = trace_format
+            for trace in xd.result:
+                recorder.write(trace)
+
+            assert [o.render(trace_format) for o in recorder.get_traces()] == [o.render(trace_format) for o in xd.result]
+
+    def test_dispatch(self):
+        def func(a, *args, **kwds):
+            b = a
+            import pyxdebug
+            return b
+
+        # the dispatch path records the same calls without record objects
+        results = []
+        for writer in (None, pyxdebug.FlightRecorder(100)):
+            xd = pyxdebug.PyXdebug()
+            xd.collect_params = 1
+            xd.collect_return = 1
+            xd.collect_assignments = 1
+            xd.writer = writer
+            xd.run_func(func, 1, 2, c=3)
+            traces = xd.result if writer is None else writer.get_traces()
+            results.append([o.render()[24:] for o in traces])
+
+        assert xd.recorder is xd.writer
+        assert xd.call_stack == []
+        assert results[0] == results[1]
+
+    def test_partial_slot(self):
+        output = StringIO()
+        recorder = pyxdebug.FlightRecorder(3, output)
+        for message in (u'first', u'second', u'third'):
+            trace = pyxdebug.LogTrace(None, 0)
+            trace.setvalue(message)
+            recorder.write(trace)
+        # a signal handler may dump the slot of the oldest record while the
+        # next record is written to it
+        index = recorder.begin(0, 0, None)
+        recorder.dump()
+        recorder.commit(index, pyxdebug.BINARY_LOG)
+        result = output.getvalue().splitlines()
+
+        assert [line.strip() for line in result[1:3]] == [u'*> second', u'*> third']
+        assert result[3].startswith(u'TRACE END   [')
+        assert len(recorder.get_traces()) == 3
+
+    def test_ring(self):
+        output = StringIO()
+        recorder = pyxdebug.FlightRecorder(5, output)
+        xd = pyxdebug.PyXdebug()
+        xd.writer = recorder
+        xd.run_file("example_run_file.py")
+        traces = recorder.get_traces()
+
+        assert output.getvalue() == u''
+        assert recorder.count > 5
+        assert len(recorder.names) == 5
+        assert len(traces) == 5
+        assert traces[-1].__class__ == pyxdebug.FinishTrace
+        numbers = [o.number for o in traces[:-1]]
+        assert numbers == sorted(numbers)
+        assert len(set(numbers)) == 4
+
+    def test_dump_on_error(self):
+        def func():
+            raise ValueError('bad')
+
+        output = StringIO()
+        xd = pyxdebug.PyXdebug()
+        xd.writer = pyxdebug.FlightRecorder(10, output)
+        try:
+            xd.run_func(func)
+        except ValueError:
+            pass
+        result = output.getvalue().splitlines()
+
+        assert result[0].startswith(u'TRACE START [')
+        assert result[1][24:].startswith(u'-> func() ')
+        assert result[2] == u' '*24 + u'*> exception ValueError: bad'
+        assert result[-2].startswith(u'TRACE END   [')
+
+    def test_error_message(self):
+        def func(message):
+            raise ValueError(message)
+
+        # byte string messages that are not ascii are decoded with
+        # replacements and the exception is raised as it is
+        for message, expected in (('caf\xc3\xa9', u'caf\xe9'), ('\xff', u'\ufffd')):
+            xd = pyxdebug.PyXdebug()
+            xd.writer = pyxdebug.FlightRecorder(10, StringIO())
+            try:
+                xd.run_func(func, message)
+            except ValueError, e:
+                assert e.args == (message,)
+            result = xd.writer.fileobj.getvalue().splitlines()
+
+            assert result[2] == u' '*24 + u'*> exception ValueError: ' + expected
+
+    def test_dump_on_signal(self):
+        import os
+        import signal
+
+        def func():
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+        output = StringIO()
+        original = signal.getsignal(signal.SIGUSR1)
+        xd = pyxdebug.PyXdebug()
+        xd.writer = pyxdebug.FlightRecorder(10, output, signal.SIGUSR1)
+        xd.run_func(func)
+
+        assert signal.getsignal(signal.SIGUSR1) == original
+        assert output.getvalue().splitlines()[1][24:].startswith(u'-> func() ')
+
+
+class TestBinaryTrace(object):
+    def write_binary(self, xd):
+        output = StringIO()
+        writer = pyxdebug.BinaryTraceWriter(output)
+        writer.start(xd)
+        calls = {}
+        for trace in xd.result:
+            # binary traces keep microseconds, round them the same way so
+            # that the 4 digit text columns can be compared
+            if getattr(trace, 'time', None) is not None:
+                trace.time = int(round(trace.time * 1000000)) / 1000000.0
+            # and the reader takes the durations from the rounded times
+            if isinstance(trace, pyxdebug.ExitTrace):
+                if trace.duration is not None:
+                    trace.set_duration(calls[trace.call_depth])
+            elif isinstance(trace, pyxdebug.CallTrace):
+                calls[trace.call_depth] = trace
+            writer.write(trace)
+        writer.finish(xd)
+        return output
+
+    def test_round_trip(self):
+        def func(a, b=[1, 2]):
+            c = a + 1
+            import pyxdebug
+            return c
+
+        xd = pyxdebug.PyXdebug()
+        xd.collect_params = 1
+        xd.collect_return = 1
+        xd.collect_assignments = 1
+        xd.run_func(func, 123)
+        xd.result.append(pyxdebug.LogTrace(None, 1))
+        xd.result[-1].setvalue('message')
+
+        output = self.write_binary(xd)
+
+        reader = pyxdebug.BinaryTraceReader(StringIO(output.getvalue()))
+        assert reader.get_result() == xd.get_result()
+
+    def test_round_trip_trace_format(self):
+        def func(a):
+            import pyxdebug
+            return a
+
+        xd = pyxdebug.PyXdebug()
+        xd.trace_format = 1
+        xd.collect_return = 1
+        xd.collect_assignments = 1
+        xd.run_func(func, 123)
+
+        output = self.write_binary(xd)
+
+        reader = pyxdebug.BinaryTraceReader(StringIO(output.getvalue()))
+        reader.trace_format = 1
+        assert reader.get_result() == xd.get_result()
+
+    def test_round_trip_exceptions(self):
+        def fail():
+            raise ValueError(u'bad \u3042')
+
+        def func():
+            try:
+                fail()
+            except ValueError:
+                pass
+
+        for trace_format in (0, 1):
+            xd = pyxdebug.PyXdebug()
+            xd.trace_format = trace_format
+            xd.collect_exceptions = 1
+            xd.collect_durations = 1
+            xd.run_func(func)
+
+            output = self.write_binary(xd)
+
+            reader = pyxdebug.BinaryTraceReader(StringIO(output.getvalue()))
+            reader.trace_format = trace_format
+            assert reader.get_result() == xd.get_result()
+
+    def test_string_table(self):
+        xd = pyxdebug.PyXdebug()
+        xd.run_file("example_run_file.py")
+
+        output = self.write_binary(xd)
+
+        assert output.getvalue().count('example_run_file.py') == 1
+
+    def test_not_binary(self):
+        try:
+            pyxdebug.BinaryTraceReader(StringIO('TRACE START'))
+        except pyxdebug.PyXdebugError:
+            pass
+        else:
+            assert False
+
+
+class TestThreadSplitWriter(object):
+    def test_split(self):
+        import threading
+
+        def work():
+            return 1
+
+        def func():
+            t = threading.Thread(target=work)
+            t.start()
+            t.join()
+
+        outputs = {}
+        def factory(thread_id):
+            outputs[thread_id] = StringIO()
+            return pyxdebug.TraceWriter(outputs[thread_id])
+
+        xd = pyxdebug.PyXdebug()
+        xd.trace_threads = 1
+        xd.writer = pyxdebug.ThreadSplitWriter(factory)
+        xd.run_func(func)
+
+        assert len(outputs) == 2
+        for thread_id, output in outputs.iteritems():
+            assert u'*> thread' not in output.getvalue()
+            if thread_id!=xd.thread_id:
+                assert u'-> work()' in output.getvalue()
+
+
+class TestProcessTrace(object):
+    def trace_children(self, func):
+        import os
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        def child_writer(pid, ppid):
+            return pyxdebug.BinaryTraceWriter(open(os.path.join(directory, 'trace.%d' % pid), 'wb'))
+
+        xd = pyxdebug.PyXdebug()
+        xd.trace_children = 1
+        xd.child_writer = child_writer
+        xd.collect_durations = 1
+        xd.writer = child_writer(os.getpid(), os.getppid())
+        xd.run_func(func)
+        xd.writer.fileobj.close()
+        paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+        return [pyxdebug.BinaryTraceReader(open(path, 'rb')) for path in paths]
+
+    def test_fork(self):
+        import os
+
+        def work():
+            return 1
+
+        def func():
+            pid = os.fork()
+            if pid==0:
+                try:
+                    work()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            return pid
+
+        readers = self.trace_children(func)
+        traces = dict((o[0].pid, o) for o in [list(reader) for reader in readers])
+        parent_traces = traces.pop(os.getpid())
+        child_pid, child_traces = traces.popitem()
+
+        assert traces == {}
+        assert u'-> work()' not in u''.join(o.render() for o in parent_traces)
+        assert child_traces[0].__class__ == pyxdebug.ProcessTrace
+        assert child_traces[0].ppid == os.getpid()
+        assert child_traces[0].render().endswith(u'*> process %d (parent %d)' % (child_pid, os.getpid()))
+        assert [o.name for o in child_traces if o.__class__==pyxdebug.CallTrace] == ['work']
+        assert child_traces[-1].__class__ == pyxdebug.FinishTrace
+
+    def test_subprocess(self):
+        import subprocess
+
+        def func():
+            subprocess.call(['true'])
+
+        readers = self.trace_children(func)
+
+        assert len(readers) == 1
+
+        # other functions of the subprocess module fork traced children
+        namespace = {'__name__': 'subprocess', 'sys': sys}
+        exec 'def fork():\n    return sys._getframe()' in namespace
+        assert not pyxdebug.is_subprocess_fork(namespace['fork']())
+
+    def test_merge(self):
+        import os
+
+        def work():
+            return 1
+
+        def func():
+            pid = os.fork()
+            if pid==0:
+                try:
+                    work()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            work()
+
+        merger = pyxdebug.TraceMerger(self.trace_children(func))
+        traces = list(merger)
+        times = [o.time for o in traces if isinstance(o, pyxdebug.CallTrace)]
+        markers = [o for o in traces if o.__class__==pyxdebug.ProcessTrace]
+
+        assert times == sorted(times)
+        assert len(set(o.pid for o in markers)) == 2
+        assert len([o for o in traces if o.__class__==pyxdebug.CallTrace and o.name=='work']) == 2
+        assert len([o for o in traces if o.__class__==pyxdebug.FinishTrace]) == 1
+        assert traces[-1].__class__ == pyxdebug.FinishTrace
+        assert merger.get_footer().startswith(u'TRACE END')
+
+        writer = pyxdebug.SummaryWriter()
+        pyxdebug.TraceMerger(self.trace_children(func)).merge(writer)
+        work = [o for o in writer.get_functions() if o.name=='work'][0]
+
+        assert work.calls == 2
+
+    def test_merge_summary(self):
+        import os
+
+        def work():
+            time.sleep(0.05)
+
+        def func():
+            pid = os.fork()
+            if pid==0:
+                try:
+                    work()
+                finally:
+                    os._exit(0)
+            work()
+            os.waitpid(pid, 0)
+
+        # the child runs alongside the parent, its time is not taken out
+        # of the run time of the parent
+        writer = pyxdebug.SummaryWriter()
+        pyxdebug.TraceMerger(self.trace_children(func)).merge(writer)
+        work = [o for o in writer.get_functions() if o.name=='work'][0]
+
+        assert work.calls == 2
+        assert writer.main.self_time >= 0
+        assert writer.main.self_time < writer.main.total_time
+
+
+class TestCallgrindWriter(object):
+    def test_profile(self):
+        def callee():
+            return 1
+
+        def func():
+            callee()
+            callee()
+
+        output = StringIO()
+        xd = pyxdebug.PyXdebug()
+        xd.writer = pyxdebug.CallgrindWriter(output)
+        xd.run_func(func)
+        result = output.getvalue().splitlines()
+
+        assert xd.result == []
+        assert result[0] == u'version: 1'
+        assert u'events: Time_(us) Memory' in result
+        assert u'fn=(1) callee' in result
+        assert u'fn=(2) func' in result
+        assert result.count(u'calls=1 %d' % callee.func_code.co_firstlineno) == 2
+        assert u'calls=1 %d' % func.func_code.co_firstlineno in result
+        assert result[-1].startswith(u'totals: ')
+
+    def test_recursion(self):
+        xd = pyxdebug.PyXdebug()
+        writer = xd.writer = pyxdebug.CallgrindWriter(StringIO())
+        xd.run_file("example_run_file.py")
+        functions = dict([(o.name.split('.')[-1], o) for o in writer.functions.itervalues()])
+
+        calc = functions['calc']
+        assert [cost[0] for cost in calc.children.itervalues()] == [14]
+        assert [cost[0] for (callee, lineno), cost in functions['{main}'].children.iteritems() if callee is calc] == [1]
+        assert calc.self_time <= writer.total_time
+
+
+class TestSummaryWriter(object):
+    def test_summary(self):
+        output = StringIO()
+        writer = pyxdebug.SummaryWriter(output, 10, 'calls')
+        xd = pyxdebug.PyXdebug()
+        xd.writer = writer
+        xd.run_file("example_run_file.py")
+        functions = dict((o.name, o) for o in writer.functions.itervalues())
+        calc = functions['pyxdebug.Fib.calc']
+        edges = dict(((caller.name, callee.name), edge) for (caller, callee), edge in writer.edges.iteritems())
+
+        assert xd.result == []
+        assert writer.stacks[xd.thread_id] == []
+        assert calc.calls == 15
+        assert calc.max_depth == 4
+        assert writer.stacks[xd.thread_id].active == {}
+        assert abs(calc.self_time - calc.total_time) < 0.000001
+        assert calc.total_time <= functions['{main}'].total_time
+        assert edges[('pyxdebug.Fib.calc', 'pyxdebug.Fib.calc')][0] == 14
+        assert edges[('{main}', 'pyxdebug.Fib.calc')][0] == 1
+        assert writer.get_functions(1)[0] is calc
+        assert output.getvalue() == writer.get_result()
+        assert output.getvalue().splitlines()[2].endswith(u'  pyxdebug.Fib.calc example_run_file.py:10')
+
+    def test_self_time(self):
+        def inner():
+            time.sleep(0.01)
+
+        def outer():
+            inner()
+            inner()
+
+        writer = pyxdebug.SummaryWriter()
+        xd = pyxdebug.PyXdebug()
+        xd.writer = writer
+        xd.run_func(outer)
+        functions = dict((o.name, o) for o in writer.functions.itervalues())
+
+        assert functions['inner'].calls == 2
+        assert functions['inner'].total_time >= 0.02
+        assert functions['outer'].self_time < functions['inner'].total_time
+        assert abs(functions['outer'].total_time - functions['outer'].self_time - functions['inner'].total_time) < 0.000001
+
+    def test_threads(self):
+        import threading
+
+        def work():
+            time.sleep(0.05)
+
+        def func():
+            threads = [threading.Thread(target=work) for i in xrange(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        # the calls running at the same time in two threads are not
+        # recursive calls
+        writer = pyxdebug.SummaryWriter()
+        xd = pyxdebug.PyXdebug()
+        xd.writer = writer
+        xd.trace_threads = 1
+        xd.run_func(func)
+        work = [o for o in writer.functions.itervalues() if o.name=='work'][0]
+
+        assert work.calls == 2
+        assert work.total_time >= 0.1
+        assert work.total_time >= work.self_time
+
+    def test_sort(self):
+        try:
+            pyxdebug.SummaryWriter(sort='name')
+        except pyxdebug.PyXdebugError:
+            pass
+        else:
+            assert False
+
+
+class TestTraceDiff(object):
+    def profile(self, func, *args):
+        xd = pyxdebug.PyXdebug()
+        xd.writer = pyxdebug.CallPathWriter()
+        xd.run_func(func, *args)
+        return xd.writer
+
+    def test_call_paths(self):
+        def helper():
+            pass
+
+        def work(n):
+            for i in xrange(n):
+                helper()
+
+        def func():
+            work(3)
+            helper()
+
+        writer = self.profile(func)
+        path = writer.root.children['func']
+
+        assert writer.root.children.keys() == ['func']
+        assert sorted(path.children) == ['helper', 'work']
+        assert path.children['work'].children['helper'].calls == 3
+        assert path.children['work'].children['helper'].get_label() == u'func;work;helper'
+        assert path.children['helper'].calls == 1
+
+    def test_diff(self):
+        def helper():
+            pass
+
+        def removed():
+            pass
+
+        def added():
+            pass
+
+        def func(n, seconds):
+            for i in xrange(n):
+                helper()
+            if seconds:
+                time.sleep(seconds)
+                added()
+            else:
+                removed()
+
+        diff = pyxdebug.TraceDiff(self.profile(func, 3, 0), self.profile(func, 5, 0.02))
+        paths = dict((name, change) for change, name, old, new in diff.get_paths())
+        functions = dict((name, (change, old, new)) for change, name, old, new in diff.get_functions())
+
+        assert paths['func;helper'].startswith('calls')
+        assert paths['func;added'] == 'new'
+        assert paths['func;removed'] == 'removed'
+        assert paths['func'].startswith('time')
+        assert functions['helper'][0].startswith('calls')
+        assert functions['helper'][1].calls == 3
+        assert functions['helper'][2].calls == 5
+        assert functions['added'][1] is None
+        assert functions['removed'][2] is None
+        assert u'func;added' in diff.get_result()
+
+    def test_read_call_paths(self):
+        def helper():
+            pass
+
+        def func():
+            helper()
+            helper()
+
+        # the calls of a trace without exit records end at the next call
+        xd = pyxdebug.PyXdebug()
+        xd.run_func(func)
+        output = StringIO()
+        writer = pyxdebug.BinaryTraceWriter(output)
+        writer.start(xd)
+        for trace in xd.result:
+            writer.write(trace)
+        writer.finish(xd)
+        paths = pyxdebug.read_call_paths(pyxdebug.BinaryTraceReader(StringIO(output.getvalue())))
+
+        assert paths.root.children.keys() == ['func']
+        assert paths.root.children['func'].children.keys() == ['helper']
+        assert paths.root.children['func'].children['helper'].calls == 2
+        assert pyxdebug.TraceDiff(paths, paths).get_paths() == []
+
+
+class TestImportProfileWriter(object):
+    def test_imports(self):
+        import os
+        import sys
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'pyxdebug_outer.py'), 'w') as fileobj:
+            fileobj.write('import pyxdebug_inner\n')
+        with open(os.path.join(directory, 'pyxdebug_inner.py'), 'w') as fileobj:
+            fileobj.write('value = 1\n')
+
+        def func():
+            import pyxdebug_outer
+            import pyxdebug_outer
+
+        sys.path.insert(0, directory)
+        try:
+            xd = pyxdebug.PyXdebug()
+            xd.writer = pyxdebug.ImportProfileWriter(StringIO())
+            xd.run_func(func)
+        finally:
+            sys.path.remove(directory)
+            sys.modules.pop('pyxdebug_outer', None)
+            sys.modules.pop('pyxdebug_inner', None)
+        loaded, cached = xd.writer.root.children
+        inner = loaded.children[0]
+
+        assert loaded.name == 'import pyxdebug_outer'
+        assert loaded.loaded == 2
+        assert cached.name == 'import pyxdebug_outer'
+        assert cached.loaded == 0
+        assert inner.name == 'import pyxdebug_inner'
+        assert inner.loaded == 1
+        assert inner.cumulative_time <= loaded.cumulative_time
+        assert 0 <= loaded.self_time <= loaded.cumulative_time
+        assert 'IMPORTS sorted by cumulative' in xd.writer.fileobj.getvalue()
+
+    def test_trace_calls(self):
+        def helper():
+            pass
+
+        def func():
+            helper()
+            import os
+
+        # the calls are not recorded, only the imports
+        xd = pyxdebug.PyXdebug()
+        xd.writer = pyxdebug.ImportProfileWriter(StringIO())
+        xd.run_func(func)
+        lines = xd.writer.get_result().splitlines()
+
+        assert len(xd.writer.root.children) == 1
+        assert xd.writer.root.children[0].name == 'import os'
+        assert 'cached' in lines[2]
+        assert lines[-1].split()[-1] == 'os'
+
+
+class TestStartStop(object):
+    def test_start_stop(self):
+        def helper():
+            pass
+
+        xd = pyxdebug.PyXdebug()
+        profile = sys.getprofile()
+        helper()
+
+        assert xd.start() is True
+        helper()
+        assert xd.stop() is True
+        helper()
+
+        assert sys.getprofile() is profile
+        assert xd.stop() is False
+        assert [r.callee_name() for r in xd.result if r.__class__==pyxdebug.CallTrace] == ['helper']
+
+    def test_context_manager(self):
+        def helper():
+            raise ValueError('error')
+
+        xd = pyxdebug.PyXdebug()
+        xd.writer = pyxdebug.FlightRecorder(10, StringIO())
+        try:
+            with xd:
+                helper()
+        except ValueError:
+            pass
+
+        assert sys.getprofile() is None
+        assert xd.writer.error_info[0] is ValueError
+        assert [r.callee_name() for r in xd.writer.get_traces() if r.__class__==pyxdebug.CallTrace] == ['helper']
+
+    def test_decorator(self):
+        xd = pyxdebug.PyXdebug()
+
+        @xd.trace
+        def func(n):
+            if n:
+                return func(n - 1)
+
+        func(2)
+        calls = [r for r in xd.result if r.__class__==pyxdebug.CallTrace]
+
+        assert func.__name__ == 'func'
+        assert [r.callee_name() for r in calls] == ['func', 'func', 'func']
+        assert [r.call_depth for r in calls] == [0, 1, 2]
+        assert calls[0].caller_filename().startswith(__file__.rsplit('.', 1)[0])
+
+    def test_threads(self):
+        import threading
+
+        xd = pyxdebug.PyXdebug()
+        errors = []
+
+        @xd.trace
+        def func(n):
+            return n + 1
+
+        def run():
+            try:
+                for i in xrange(300):
+                    func(i)
+            except Exception, e:
+                errors.append(e)
+
+        # the threads that lose the race to arm tracing run untraced
+        threads = [threading.Thread(target=run) for i in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == []
+        assert xd.hooks is None
+        assert xd.blocks == {}
+        assert xd.start() is True
+        assert xd.start() is False
+        assert xd.stop() is True
+
+    def test_stop_other_thread(self):
+        import threading
+
+        def stop():
+            try:
+                xd.stop()
+            except pyxdebug.PyXdebugError, e:
+                errors.append(e)
+
+        # the hook of the arming thread stays until that thread stops it
+        xd = pyxdebug.PyXdebug()
+        errors = []
+        assert xd.start() is True
+        t = threading.Thread(target=stop)
+        t.start()
+        t.join()
+        armed = xd.hooks is not None
+        assert xd.stop() is True
+
+        assert len(errors) == 1
+        assert armed
+
+    def test_triggers(self):
+        import os
+        import tempfile
+
+        xd = pyxdebug.PyXdebug()
+        xd.trigger_env = 'PYXDEBUG_TEST_TRIGGER'
+        xd.trigger_file = os.path.join(tempfile.mkdtemp(), 'trigger')
+        xd.trigger_every = 2
+        os.environ.pop('PYXDEBUG_TEST_TRIGGER', None)
+
+        assert xd.start() is False
+        assert sys.getprofile() is None
+        open(xd.trigger_file, 'w').close()
+        assert xd.start() is False
+        assert xd.start() is True
+        xd.stop()
+        os.remove(xd.trigger_file)
+        os.environ['PYXDEBUG_TEST_TRIGGER'] = '1'
+        try:
+            assert xd.start() is False
+            assert xd.start() is True
+            xd.stop()
+        finally:
+            del os.environ['PYXDEBUG_TEST_TRIGGER']
+        assert xd.trigger_count == 4
+
+
 class TestCallTrace(object):
     def test_trace(self):
         trace = pyxdebug.CallTrace(inspect.currentframe(), 10)
-        trace.setvalue(time.time(), 0)
+        trace.setvalue(pyxdebug.clock(), 0)
         result = trace.get_result()
 
         assert result[24:24+20+2] == u'  '*10 + u'->'
@@ -112,21 +1470,21 @@ class TestAssignmentTrace(object):
 class TestImportTrace(object):
     def test_trace_import(self):
         trace = pyxdebug.ImportTrace(inspect.currentframe(), 10)
-        trace.setvalue("module1", None, time.time())
+        trace.setvalue("module1", None, pyxdebug.clock())
         result = trace.get_result()
 
         assert result[24:24+20+18] == u'  '*10 + u'-> import module1 '
 
     def test_trace_from(self):
         trace = pyxdebug.ImportTrace(inspect.currentframe(), 10)
-        trace.setvalue("module1", ['*'], time.time())
+        trace.setvalue("module1", ['*'], pyxdebug.clock())
         result = trace.get_result()
 
         assert result[24:24+20+25] == u'  '*10 + u'-> from module1 import * '
 
     def test_trace_from2(self):
         trace = pyxdebug.ImportTrace(inspect.currentframe(), 10)
-        trace.setvalue("module1", ['cls1', 'cls2'], time.time())
+        trace.setvalue("module1", ['cls1', 'cls2'], pyxdebug.clock())
         result = trace.get_result()
 
         assert result[24:24+20+34] == u'  '*10 + u'-> from module1 import cls1, cls2 '
@@ -135,16 +1493,59 @@ class TestImportTrace(object):
 class TestReloadTrace(object):
     def test_trace(self):
         trace = pyxdebug.ReloadTrace(inspect.currentframe(), 10)
-        trace.setvalue(pyxdebug, time.time())
+        trace.setvalue(pyxdebug, pyxdebug.clock())
         result = trace.get_result()
 
         assert result[24:24+20+20] == u'  '*10 + u'-> reload(pyxdebug) '
 
 
+class TestExceptionTrace(object):
+    def test_trace(self):
+        trace = pyxdebug.ExceptionTrace(inspect.currentframe(), 10)
+        trace.setvalue('ValueError', u'bad')
+        result = trace.get_result()
+
+        assert result[0:24+20+19] == u' '*24 + u'  '*10 + u'!> ValueError: bad '
+
+    def test_message(self):
+        assert pyxdebug.get_exception_message(ValueError('bad')) == u'bad'
+        assert pyxdebug.get_exception_message('integer division') == u'integer division'
+        assert pyxdebug.get_exception_message(None) == u''
+        assert pyxdebug.get_exception_message('x' * 10, 4) == u'xxxx...'
+        assert pyxdebug.get_exception_name(KeyError) == 'KeyError'
+
+
+class TestExitTrace(object):
+    def test_trace(self):
+        trace = pyxdebug.ExitTrace(None, 10)
+        trace.setvalue(pyxdebug.clock())
+        trace.number = 3
+        result = trace.get_computerized_result()
+
+        assert result.split(u'\t')[0:3] == [u'11', u'3', u'1']
+
+    def test_duration(self):
+        call = pyxdebug.CallTrace(None, 10)
+        call.time = 1.0
+        call.memory = 100
+        trace = pyxdebug.ExitTrace(None, 10)
+        trace.time = 1.5
+        trace.memory = 103
+        assert trace.get_result() == u'    1.5000        103   ' + u'  '*10 + u'<-'
+
+        trace.set_duration(call)
+        assert trace.duration == 0.5
+        assert trace.memory_delta == 3
+        assert trace.get_result() == u'    1.5000        103   ' + u'  '*10 + u'<- 0.500000 +3'
+
+        trace.unwinding = True
+        assert trace.get_result() == u'    1.5000        103   ' + u'  '*10 + u'<- 0.500000 +3 (unwind)'
+
+
 class TestFinishTrace(object):
     def test_trace(self):
         trace = pyxdebug.FinishTrace(None, 0)
-        trace.setvalue(time.time())
+        trace.setvalue(pyxdebug.clock())
         result = trace.get_result()
 
         assert len(result) == 21
@@ -160,6 +1561,104 @@ class TestFunction(object):
         method_name = pyxdebug.get_method_name(inspect.currentframe())
         assert method_name.endswith('.TestFunction.test_get_method_name')
 
+    def test_get_assignments(self):
+        def func(obj, values):
+            a, (b, c) = 1, (2, 3)
+            a += 1
+            obj.attr = a
+            obj.attr += 1
+            d = len([
+                b,
+                c])
+            import os
+            for i in values:
+                pass
+            square = lambda v: v * v
+            g = (v for v in values)
+            @staticmethod
+            def inner():
+                pass
+            @staticmethod
+            class Inner(object):
+                pass
+            return a
+
+        line = func.func_code.co_firstlineno
+        assignments = pyxdebug.get_assignments(func.func_code)
+
+        assert assignments[line+1] == ['a', 'b', 'c']
+        assert assignments[line+2] == ['a']
+        assert assignments[line+3] == ['obj.attr']
+        assert assignments[line+4] == ['obj.attr']
+        assert assignments[line+7] == ['d']
+        assert line+8 not in assignments
+        assert line+9 not in assignments
+        assert assignments[line+11] == ['square']
+        assert assignments[line+12] == ['g']
+        assert [lineno for lineno in assignments if lineno>line+12] == []
+
+    def test_get_method_name_cache(self):
+        pyxdebug.method_cache.clear()
+        frame = inspect.currentframe()
+        method_name = pyxdebug.get_method_name(frame)
+
+        assert pyxdebug.method_cache[(frame.f_code, TestFunction)] == (TestFunction, method_name)
+        assert pyxdebug.get_method_name(frame) is method_name
+
+    def test_get_method_name_cache_size(self):
+        size = pyxdebug.METHOD_CACHE_SIZE
+        try:
+            pyxdebug.METHOD_CACHE_SIZE = 1
+            pyxdebug.method_cache.clear()
+            pyxdebug.get_method_name(inspect.currentframe())
+            pyxdebug.get_method_name(inspect.currentframe().f_back)
+            assert len(pyxdebug.method_cache) <= 1
+        finally:
+            pyxdebug.METHOD_CACHE_SIZE = size
+
+    def test_get_method_name_function(self):
+        def func(value):
+            return pyxdebug.get_method_name(inspect.currentframe())
+
+        assert func(123) == 'func'
+        assert func(self) == 'func'
+
+    def test_capture_value(self):
+        value = 123
+        assert pyxdebug.capture_value(value) is value
+        value = 'abc'
+        assert pyxdebug.capture_value(value) is value
+        assert repr(pyxdebug.capture_value('abcdef', max_data=3)) == "'abc'..."
+        assert repr(pyxdebug.capture_value(range(5), max_children=3)) == '[0, 1, 2, ...]'
+        assert repr(pyxdebug.capture_value({'b': (1,), 'a': [[1]]}, max_depth=2)) == "{'a': [[...]], 'b': (1,)}"
+        assert repr(pyxdebug.capture_value(range(5), -1, -1, -1)) == repr(range(5))
+
+        # subclasses are bounded as well and keep their name, the keys of
+        # a dict are sorted whatever its size
+        import collections
+        Point = collections.namedtuple('Point', 'x y')
+        assert repr(pyxdebug.capture_value(Point(1, range(5)), max_children=3)) == 'Point(x=1, y=[0, 1, 2, ...])'
+        assert repr(pyxdebug.capture_value(collections.OrderedDict([('b', 1), ('a', 2)]))) == "OrderedDict({'b': 1, 'a': 2})"
+        assert repr(pyxdebug.capture_value(collections.defaultdict(list, {'b': [], 'a': []}))) == "defaultdict({'a': [], 'b': []})"
+        assert repr(pyxdebug.capture_value(dict.fromkeys(range(10, 0, -1), 0), max_children=2)) == '{1: 0, 2: 0, ...}'
+
+        class Broken(object):
+            def __repr__(self):
+                raise AttributeError('_sign')
+        value = Broken()
+        assert repr(pyxdebug.capture_value(value)) == '<Broken object at 0x%x>' % id(value)
+
+    def test_match_module(self):
+        assert pyxdebug.match_module('json', ['json'])
+        assert pyxdebug.match_module('json.decoder', ['json'])
+        assert not pyxdebug.match_module('jsonrpc', ['json'])
+        assert not pyxdebug.match_module(None, ['json'])
+
+    def test_match_glob(self):
+        assert pyxdebug.match_glob('/usr/lib/python2.7/re.py', ['/usr/lib/*'])
+        assert pyxdebug.match_glob('skipped', ['foo', 'skip*'])
+        assert not pyxdebug.match_glob('helper', ['skip*'])
+
     def test_get_frame_var(self):
         value = pyxdebug.get_frame_var(inspect.currentframe(), 'self')
         assert value == self
@@ -195,6 +1694,25 @@ class TestFrameWrap(object):
         assert wrap.f_lineno == frame.f_back.f_lineno
 
 
+class TestFrameSnapshot(object):
+    def test_snapshot(self):
+        frame = inspect.currentframe()
+        caller = pyxdebug.FrameSnapshot(frame.f_back, live=False)
+        snapshot, lineno = pyxdebug.FrameSnapshot(frame, caller), frame.f_lineno
+
+        assert snapshot.f_code == frame.f_code
+        assert snapshot.f_lineno == lineno
+        assert snapshot.f_back is caller
+        assert snapshot.f_locals['self'] == self
+        assert caller.f_locals == {}
+
+    def test_detach(self):
+        snapshot = pyxdebug.FrameSnapshot(inspect.currentframe())
+        snapshot.detach()
+        assert snapshot.frame is None
+        assert snapshot.f_locals == {}
+
+
 if __name__ == '__main__':
     import nose
     nose.main()